@@ -0,0 +1,118 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Benchmark of :func:`zvm_exporter.parser.Parser.parse_disk_hosts`.
+
+Synthetic ``Image_Volume_Space_Query_DM`` responses with 100, 1k, 10k and
+100k free extents are parsed, and the parse time, the peak memory and the
+memory held by the results are reported::
+
+    $ python benchmarks/parse_disk.py
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from zvm_exporter.parser import Parser  # noqa: E402
+
+EXTENTS_PER_VOLUME = 4
+
+
+def make_response(lines):
+    """Wrap lines of dsh output into an xCAT response message."""
+    return '{"data":[{"data":["' + '\\n'.join(lines) + \
+        '",null]},{"errorcode":["0"]}]}'
+
+
+def make_disk_responses(extents, zhcpnode="zhcpos2"):
+    """Generate the responses of the disk definition and free space
+    queries of a node with ``extents`` free extents.
+
+    :returns: a tuple of the definition and the free space responses.
+    :rtype: tuple
+
+    """
+    volumes = max(1, extents // EXTENTS_PER_VOLUME)
+    def_lines = []
+    free_lines = []
+    for v in range(volumes):
+        def_lines.append("{}: V{:05X} 3390-64K 65520 V{:05X}".format(
+            zhcpnode, v, v))
+    for e in range(extents):
+        v = e % volumes
+        start = 1 + (e // volumes) * 1000
+        free_lines.append("{}: V{:05X} 3390-64K {} 500 * *".format(
+            zhcpnode, v, start))
+    return make_response(def_lines), make_response(free_lines)
+
+
+def measure(extents, repeat):
+    """Parse a synthetic response and return the best time in seconds, the
+    peak memory and the memory held by the results in bytes (``None``
+    without tracemalloc)."""
+    def_response, free_response = make_disk_responses(extents)
+    timer = timeit.Timer(lambda: Parser.parse_disk_hosts(def_response,
+                                                         free_response))
+    best = min(timer.repeat(repeat=repeat, number=1))
+
+    peak = held = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        results = Parser.parse_disk_hosts(def_response, free_response)
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert results
+    return best, peak, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of timed runs per size. (defaults to 5)")
+    parser.add_argument("sizes", type=int, nargs="*",
+                        default=[100, 1000, 10000, 100000],
+                        help="Numbers of free extents to parse.")
+    args = parser.parse_args()
+
+    print("{:>10} {:>12} {:>14} {:>12} {:>12}".format(
+        "extents", "parse (ms)", "us / extent", "peak (KiB)", "held (KiB)"))
+    for extents in args.sizes:
+        best, peak, held = measure(extents, args.repeat)
+        print("{:>10} {:>12.2f} {:>14.2f} {:>12} {:>12}".format(
+            extents, best * 1000, best * 1e6 / extents,
+            "-" if peak is None else "{:.0f}".format(peak / 1024.0),
+            "-" if held is None else "{:.0f}".format(held / 1024.0)))
+
+
+if __name__ == "__main__":
+    main()
@@ -43,9 +43,13 @@ setup(
         ]
     },
     install_requires=[
-        "prometheus_client>=0.0.13",
+        "prometheus_client>=0.4.0",
         "requests",
+        "futures; python_version < '3'",
     ],
+    extras_require={
+        "async": ["aiohttp; python_version >= '3.5'"],
+    },
     setup_requires=['pytest-runner'],
     tests_require=['pytest', 'httpretty'],
     license="MIT",
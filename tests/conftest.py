@@ -0,0 +1,6 @@
+import sys
+
+# Coroutines are a syntax error before Python 3.5
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append("test_aio.py")
@@ -43,3 +43,34 @@ disk_free_data = r'{"data":[{"data":["zhcpos2: $$$$$$ ???? 1 500 * *\n' \
 emptyData1 = r'{"data":[{"data":["",null]},{"errorcode":["1"]}]}'
 
 emptyData2 = r'{"data":[{"data":["",""]},{"errorcode":[""]}]}'
+
+# Responses of a query sent to the noderange zhcpos2,zhcpos3
+page_hosts_data = r'{"data":[{"data":["zhcpos2: Total allocated: 93920K\n' \
+                  r'zhcpos3: Total allocated: 2560K\nzhcpos2: Total used: ' \
+                  r'33106\nzhcpos3: Total used: 834\nzhcpos2: Available ' \
+                  r'percentage: 1\nzhcpos3: Available percentage: 7\n' \
+                  r'zhcpos2: Volume ID: OSPA35\nzhcpos3: Volume ID: OSPA36' \
+                  r'\nzhcpos2: Volume total pages: 2560K",null]},' \
+                  r'{"errorcode":["0"]}]}'
+
+disk_def_hosts_data = r'{"data":[{"data":["zhcpos2: OS2P01 3390-64K 65520 ' \
+                      r'OS2P01\nzhcpos3: OS3P01 3390-64K 10017 OS3P01",' \
+                      r'null]},{"errorcode":["0"]}]}'
+
+disk_free_hosts_data = r'{"data":[{"data":["zhcpos3: OS3P01 3390-64K 1 ' \
+                       r'10016 * *\nzhcpos2: OS2P01 3390-64K 6677 58843 * ' \
+                       r'*"]},{"errorcode":["0"]}]}'
+
+# Response of two commands sent in one request to zhcpos2,zhcpos3, each
+# followed by an END marker
+combined_data = r'{"data":[{"data":["zhcpos2: Total allocated: 93920K\n' \
+                r'zhcpos3: Total allocated: 2560K\nzhcpos2: END\nzhcpos2: ' \
+                r'Total allocated: 12001K\nzhcpos3: END\nzhcpos3: Total ' \
+                r'allocated: 4837K\nzhcpos3: END\nzhcpos2: END",null]},' \
+                r'{"errorcode":["0"]}]}'
+
+# Response with several data chunks and escaped characters
+chunked_data = r'{"data":[{"data":["zhcpos2: Total allocated: 93920K\n' \
+               r'zhcpos2: Total used: 33106","zhcpos2: Available ' \
+               r'percentage: 1\nzhcpos2: Name: \"OS\\PA\""]},' \
+               r'{"errorcode":["4"]}]}'
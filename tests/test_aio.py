@@ -0,0 +1,147 @@
+import asyncio
+import pytest
+from data import page_data, cpu_memory_data
+from utils import FakeRequester
+from zvm_exporter.collector import QUERIES, ZVMCollector
+from zvm_exporter.requester import COMMANDS
+from zvm_exporter.targets import Targets
+
+aio = pytest.importorskip("zvm_exporter.aio")
+
+
+class FakeResponse(object):
+    def __init__(self, status, text):
+        self.status = status
+        self.reason = "Fake"
+        self.content = text.encode("utf-8")
+
+    async def read(self):
+        return self.content
+
+    async def text(self, errors="strict"):
+        return self.content.decode("utf-8", errors)
+
+
+class FakeClient(object):
+    """aiohttp session stand-in answering by SMAPI command."""
+    def __init__(self, responses, delay=0, statuses=None, errors=None):
+        self.responses = responses
+        self.delay = delay
+        self.statuses = list(statuses or [])
+        self.errors = list(errors or [])
+        self.sent = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def put(self, url, data=None, **kwargs):
+        self.sent.append(data)
+        return self.respond(data)
+
+    def respond(self, data):
+        client = self
+
+        class Response(object):
+            async def __aenter__(self):
+                client.in_flight += 1
+                client.max_in_flight = max(client.max_in_flight,
+                                           client.in_flight)
+                await asyncio.sleep(client.delay)
+                client.in_flight -= 1
+                if client.errors:
+                    raise client.errors.pop(0)
+                status = client.statuses.pop(0) if client.statuses else 200
+                text = ""
+                for f, command in COMMANDS.items():
+                    if command in data:
+                        text = client.responses.get(f, "")
+                return FakeResponse(status, text)
+
+            async def __aexit__(self, *args):
+                pass
+
+        return Response()
+
+
+def make_requester(client, **options):
+    session = aio.AsyncSession(limit_per_node=options.pop("limit", 2))
+    session.client = lambda: client
+    return aio.AsyncRequester("zhcpos2", "user", "password", "example.com",
+                              session=session, backoff_factor=0, **options)
+
+
+def test_async_requester():
+    client = FakeClient({"query_page_info": page_data}, delay=0.05)
+    requester = make_requester(client)
+
+    async def query():
+        return await asyncio.gather(*[
+            getattr(requester, f)() for f in QUERIES + ("query_page_info",)])
+
+    responses = asyncio.run(query())
+    assert responses[0] == responses[-1] == page_data
+    # Identical queries in flight share a request
+    assert len(client.sent) == len(QUERIES)
+    assert requester.coalesced == 1
+    # and no more than limit_per_node requests are in flight to the node
+    assert client.max_in_flight == 2
+    assert requester.statuses[("page_info", "200")] == 1
+
+
+def test_async_requester_retries():
+    client = FakeClient({"query_page_info": page_data}, statuses=[503, 503])
+    requester = make_requester(client, retries=1)
+    assert asyncio.run(requester.query_page_info()) == ""
+    assert asyncio.run(requester.query_page_info()) == page_data
+    assert requester.statuses[("page_info", "503")] == 2
+
+    # A request that timed out waiting for xCAT is not sent again
+    client = FakeClient({"query_page_info": page_data},
+                        errors=[asyncio.TimeoutError()])
+    requester = make_requester(client, retries=1)
+    assert asyncio.run(requester.query_page_info()) == ""
+    assert len(client.sent) == 1
+
+
+def test_async_refresh():
+    responses = {"query_page_info": page_data,
+                 "query_cpu_memory_info": cpu_memory_data}
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     requester_class=aio.AsyncRequester,
+                     session=aio.AsyncSession(), retries=0)
+    c.requester.session.client = lambda: FakeClient(responses)
+    snapshot = asyncio.run(aio.refresh(c))
+
+    reference = ZVMCollector("zhcpos2", "user", "password", "example.com",
+                             443)
+    reference.requester = FakeRequester(dict(
+        (f, responses.get(f, "")) for f in QUERIES))
+    expected = reference.refresh()
+    assert [m.name for m in snapshot.metrics] == \
+        [m.name for m in expected.metrics]
+    assert [[s.value for s in m.samples] for m in snapshot.metrics] == \
+        [[s.value for s in m.samples] for m in expected.metrics]
+    assert c.success["query_page_info"]
+    assert not c.success["query_disk_def"]
+
+
+def test_async_targets():
+    with pytest.raises(ValueError):
+        Targets("user", "password", "example.com", 443, asynchronous=True)
+    # Streamed responses are refused up front, not on refresh
+    with pytest.raises(ValueError):
+        Targets("user", "password", "example.com", 443, asynchronous=True,
+                interval=60, stream=True)
+    with pytest.raises(ValueError):
+        ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     requester_class=aio.AsyncRequester, stream=True,
+                     session=aio.AsyncSession())
+
+    t = Targets("user", "password", "example.com", 443, asynchronous=True,
+                limit_per_node=3, interval=60)
+    a = t.add("zhcp1")
+    b = t.add("zhcp2")
+    assert isinstance(a.requester, aio.AsyncRequester)
+    assert a.requester.session is b.requester.session
+    assert a.requester.session.limit_per_node == 3
+    # Probed targets are queried on the worker pool
+    assert not isinstance(t.get("zhcp3").requester, aio.AsyncRequester)
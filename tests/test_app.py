@@ -1,3 +1,32 @@
+import argparse
+import pytest
+from zvm_exporter.__main__ import (collector_budget, query_ttl, read_budgets,
+                                   read_ttls)
+
+
 def test_app():
     pass
     # TODO: write app test
+
+
+def test_query_ttl():
+    assert query_ttl("disk_def=3600") == ("query_disk_def", 3600)
+    with pytest.raises(argparse.ArgumentTypeError):
+        query_ttl("unknown=10")
+    with pytest.raises(argparse.ArgumentTypeError):
+        query_ttl("disk_def=never")
+
+
+def test_read_ttls(tmpdir):
+    config = tmpdir.join("zvm_exporter.ini")
+    config.write("[ttl]\ndisk_def = 3600\ncpu_memory_info = 15\n")
+    assert read_ttls(str(config)) == {"query_disk_def": 3600,
+                                      "query_cpu_memory_info": 15}
+
+
+def test_read_budgets(tmpdir):
+    config = tmpdir.join("zvm_exporter.ini")
+    config.write("[budget]\ndisk = 20\n")
+    assert read_budgets(str(config)) == {"disk": 20}
+    with pytest.raises(argparse.ArgumentTypeError):
+        collector_budget("cpu=10")
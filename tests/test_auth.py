@@ -0,0 +1,82 @@
+import json
+import time
+import httpretty
+from zvm_exporter.auth import EXPIRE_FORMAT, TokenAuth
+from zvm_exporter.requester import Requester
+
+TOKENS = "http://example.com:443/xcatws/tokens"
+DSH = "http://example.com:443/xcatws/nodes/{}/dsh"
+
+
+def token(token_id, expires_in):
+    expire = time.strftime(EXPIRE_FORMAT,
+                           time.localtime(time.time() + expires_in))
+    return json.dumps({"token": {"id": token_id, "expire": expire}})
+
+
+def make_auth(**options):
+    return TokenAuth("user", "password", "example.com", 443,
+                     Requester.create_session(retries=0), **options)
+
+
+def posts():
+    return [r for r in httpretty.latest_requests() if r.method == "POST"]
+
+
+@httpretty.activate
+def test_token_auth():
+    httpretty.register_uri(httpretty.POST, TOKENS, status=201,
+                           body=token("abc", 3600))
+    for node in ("zhcp1", "zhcp2"):
+        httpretty.register_uri(httpretty.PUT, DSH.format(node), body="test")
+    auth = make_auth()
+    requesters = [Requester(node, "user", "password", "example.com", 443,
+                            session=auth.session, auth=auth)
+                  for node in ("zhcp1", "zhcp2")]
+
+    for r in requesters:
+        assert r.query_page_info() == "test"
+        last_request = httpretty.last_request()
+        # The token replaces the credentials
+        assert last_request.headers["X-Auth-Token"] == "abc"
+        assert "password" not in last_request.querystring
+        assert "userName" not in last_request.querystring
+    # and is requested once for all requesters
+    assert auth.tokens == 1
+    assert json.loads(posts()[-1].body.decode()) == {
+        "userName": "user", "userPW": "password"}
+
+
+@httpretty.activate
+def test_token_refresh():
+    httpretty.register_uri(httpretty.POST, TOKENS, responses=[
+        httpretty.Response(token("old", 60)),
+        httpretty.Response(token("new", 3600))])
+    auth = make_auth(margin=120)
+    assert auth.token() == "old"
+    # A token about to expire is still used while a new one is requested
+    # in the background
+    assert auth.token() == "old"
+    for _ in range(50):
+        if auth.id == "new":
+            break
+        time.sleep(0.1)
+    assert auth.token() == "new"
+    assert auth.tokens == 2
+
+
+@httpretty.activate
+def test_token_refused():
+    httpretty.register_uri(httpretty.POST, TOKENS, responses=[
+        httpretty.Response(token("revoked", 3600)),
+        httpretty.Response(token("abc", 3600))])
+    httpretty.register_uri(httpretty.PUT, DSH.format("zhcp1"), responses=[
+        httpretty.Response("", status=401),
+        httpretty.Response("test")])
+    auth = make_auth()
+    r = Requester("zhcp1", "user", "password", "example.com", 443,
+                  session=auth.session, auth=auth)
+    # A refused token is replaced and the request sent again
+    assert r.query_page_info() == "test"
+    assert httpretty.last_request().headers["X-Auth-Token"] == "abc"
+    assert r.statuses[("page_info", "401")] == 1
@@ -0,0 +1,32 @@
+from zvm_exporter.breaker import CircuitBreaker
+
+
+def test_breaker_backoff():
+    b = CircuitBreaker(threshold=2, backoff=10, max_backoff=30)
+    b.failure(now=0)
+    # Below the threshold the breaker stays closed
+    assert b.allow(now=0)
+    b.failure(now=0)
+    assert not b.allow(now=5)
+    assert b.allow(now=10)
+    # Every further failure doubles the backoff, up to max_backoff
+    b.failure(now=10)
+    assert b.open_until == 30
+    b.failure(now=30)
+    assert b.open_until == 60
+    b.success()
+    assert b.allow(now=30)
+
+
+def test_breaker_call():
+    b = CircuitBreaker(threshold=1, backoff=60)
+    calls = []
+
+    def fail():
+        calls.append(1)
+        return ""
+
+    assert b.call(fail) == ""
+    # The breaker is open, so the function is not called anymore
+    assert b.call(fail) == ""
+    assert len(calls) == 1
@@ -0,0 +1,35 @@
+from zvm_exporter.cache import ResponseCache
+
+
+def test_cache_lru():
+    c = ResponseCache(maxsize=2)
+    assert c.get("disk", "a") is None
+    c.put("disk", "a", 1)
+    c.put("disk", "b", 2)
+    # "a" is used, so "b" is the least recently used entry
+    assert c.get("disk", "a") == 1
+    c.put("disk", "c", 3)
+    assert c.get("disk", "b") is None
+    assert c.get("disk", "a") == 1
+    assert c.get("disk", "c") == 3
+    assert len(c) == 2
+    assert (c.hits, c.misses) == (3, 2)
+
+
+def test_cache_groups():
+    c = ResponseCache()
+    c.put("page", "a", 1)
+    c.put("disk", "b", 2)
+    # A new entry of a group replaces its last one, not those of the others
+    c.put("disk", "c", 3)
+    assert c.get("disk", "b") is None
+    assert c.get("disk", "c") == 3
+    assert c.get("page", "a") == 1
+    assert len(c) == 2
+
+
+def test_cache_key():
+    assert ResponseCache.key("disk", "a", "b") == \
+        ResponseCache.key("disk", "a", "b")
+    assert ResponseCache.key("disk", "ab", "") != \
+        ResponseCache.key("disk", "a", "b")
@@ -1,9 +1,16 @@
+import time
 import httpretty
-from utils import compare_lists
-from zvm_exporter.collector import ZVMCollector
-from prometheus_client.core import GaugeMetricFamily
+import pytest
+from utils import compare_lists, FakeRequester
+from zvm_exporter.collector import ZVMCollector, QUERIES
+from zvm_exporter.parser import Parser
+from zvm_exporter.requester import ResponseStream
+from zvm_exporter.scrape import scrape_collectors
+from prometheus_client.core import (CounterMetricFamily, GaugeMetricFamily,
+                                    HistogramMetricFamily)
 from data import (page_data, spool_data, cpu_memory_data, disk_def_data,
-                  disk_free_data)
+                  disk_free_data, page_hosts_data, disk_def_hosts_data,
+                  disk_free_hosts_data, emptyData2)
 
 
 def request_callback(request, uri, headers):
@@ -122,4 +129,430 @@ def test_collect():
 
     # Check that all metrics have the right type
     for value in c.collect():
-        assert type(value) == GaugeMetricFamily
+        if value.name in ("zvm_exporter_requests_coalesced",
+                          "zvm_exporter_metrics_cache_hits",
+                          "zvm_exporter_metrics_cache_misses",
+                          "zvm_exporter_response_bytes",
+                          "zvm_exporter_responses",
+                          "zvm_exporter_hedged_requests",
+                          "zvm_exporter_hedge_wins",
+                          "zvm_exporter_hedges_over_budget"):
+            assert type(value) == CounterMetricFamily
+        elif value.name in ("zvm_exporter_request_duration_seconds",
+                            "zvm_exporter_parse_duration_seconds"):
+            assert type(value) == HistogramMetricFamily
+        else:
+            assert type(value) == GaugeMetricFamily
+
+
+class SlowRequester(object):
+    """Requester stand-in whose queries take a given time to return."""
+    def __init__(self, delays):
+        self.delays = delays
+
+    def __getattr__(self, name):
+        def query(deadline=None):
+            time.sleep(self.delays[name])
+            return name
+        return query
+
+
+def test_fetch_concurrent():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     workers=5)
+    c.requester = SlowRequester(dict((q, 0.2) for q in QUERIES))
+
+    start = time.time()
+    responses = c.fetch(QUERIES)
+
+    # Queries run in parallel, so the fetch takes about as long as one query
+    assert time.time() - start < 0.2 * len(QUERIES) / 2
+    assert responses == dict((q, q) for q in QUERIES)
+
+
+def test_fetch_timeout():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443)
+    c.requester = SlowRequester({"query_page_info": 0,
+                                 "query_disk_def": 1})
+
+    responses = c.fetch(["query_page_info", "query_disk_def"], timeout=0.2)
+
+    # A query that misses the deadline is returned as an empty response
+    assert responses == {"query_page_info": "query_page_info",
+                         "query_disk_def": ""}
+
+
+@httpretty.activate
+def test_collect_snapshot():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     interval=60)
+    # HTTP mocker that sends response in place of xCAT
+    httpretty.register_uri(
+        httpretty.PUT, "http://example.com:443/xcatws/nodes/zhcpos2/dsh",
+        body=request_callback, content_type='text/plain')
+
+    # Nothing is served before the first refresh
+    assert list(c.collect()) == []
+
+    snapshot = c.refresh()
+    request_count = len(httpretty.latest_requests())
+    metrics = list(c.collect())
+
+    # Scrapes are served from the snapshot without querying xCAT
+    assert len(httpretty.latest_requests()) == request_count
+    assert metrics[:len(snapshot.metrics)] == list(snapshot.metrics)
+    for metric in snapshot.metrics:
+        for sample in metric.samples:
+            assert sample.timestamp == snapshot.timestamp
+    assert "zvm_exporter_snapshot_timestamp_seconds" in [m.name
+                                                         for m in metrics]
+
+
+def test_fetch_ttl():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     ttls={"query_page_info": 60})
+    c.requester = SlowRequester({"query_page_info": 0,
+                                 "query_spool_info": 0})
+
+    c.fetch(["query_page_info", "query_spool_info"])
+    c.requester = SlowRequester({"query_spool_info": 0})
+    # query_page_info has not expired yet, so it must not be sent again
+    responses = c.fetch(["query_page_info", "query_spool_info"])
+    assert responses == {"query_page_info": "query_page_info",
+                         "query_spool_info": "query_spool_info"}
+    assert not c.expired("query_page_info")
+    assert c.expired("query_spool_info")
+
+
+def test_fetch_stale():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443)
+    c.requester = SlowRequester({"query_page_info": 0})
+    c.fetch(["query_page_info"])
+
+    # The query fails: its last good response is served
+    c.requester = SlowRequester({})
+    responses = c.fetch(["query_page_info"])
+    assert responses == {"query_page_info": "query_page_info"}
+
+    up, age, _ = c.collect_queries()
+    assert [s.value for s in up.samples] == [0]
+    assert [s.labels["query"] for s in age.samples] == ["page_info"]
+
+
+def test_collect_noderange():
+    c = ZVMCollector("zhcpos2,zhcpos3", "user", "password", "example.com",
+                     443)
+    c.requester = FakeRequester({"query_page_info": page_hosts_data,
+                                 "query_disk_def": disk_def_hosts_data,
+                                 "query_disk_free": disk_free_hosts_data})
+
+    # A single response holds the samples of every node
+    metrics = c.collect_page()
+    samples = metrics["used_total"]["value"].samples
+    assert dict((s.labels["host"], s.value) for s in samples) == {
+        "zhcpos2": 33106, "zhcpos3": 834}
+
+    metrics = c.collect_disk()
+    samples = metrics["space_free"]["value"].samples
+    assert dict((s.labels["volume"], s.labels["host"]) for s in samples) == {
+        "OS2P01": "zhcpos2", "OS3P01": "zhcpos3"}
+
+
+def test_fetch_combine():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     combine=True)
+    sent = []
+
+    def query_combined(query_fn, deadline=None):
+        sent.append(query_fn)
+        return dict((f, f) for f in query_fn)
+
+    c.requester.query_combined = query_combined
+    responses = c.fetch(QUERIES)
+
+    # All the queries are sent in a single request
+    assert sent == [list(QUERIES)]
+    assert responses == dict((q, q) for q in QUERIES)
+
+
+class StreamedResponse(object):
+    """requests.Response stand-in sending its body in small chunks."""
+    def __init__(self, body):
+        self.body = body.encode("utf-8")
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), 100):
+            yield self.body[i:i + 100]
+
+    def close(self):
+        self.closed = True
+
+
+class StreamRequester(FakeRequester):
+    """Requester stand-in streaming its responses."""
+    def __init__(self, responses):
+        FakeRequester.__init__(self, responses)
+        self.sent = []
+
+    def stream(self, query_fn, deadline=None):
+        response = StreamedResponse(self.responses[query_fn])
+        self.sent.append(response)
+        return ResponseStream(response)
+
+
+def test_collect_stream():
+    responses = {"query_page_info": page_data,
+                 "query_spool_info": spool_data,
+                 "query_cpu_memory_info": cpu_memory_data,
+                 "query_disk_def": disk_def_data,
+                 "query_disk_free": disk_free_data}
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     stream=True)
+    c.requester = StreamRequester(responses)
+
+    # The streamed responses give the same samples as the whole ones
+    streamed = c.collect_disk()
+    r = ZVMCollector("zhcpos2", "user", "password", "example.com", 443)
+    r.requester = FakeRequester(responses)
+    read = r.collect_disk()
+    for name in read:
+        assert (streamed[name]["value"].samples ==
+                read[name]["value"].samples)
+
+    snapshot = c.refresh()
+    assert compare_lists(set(m.name for m in snapshot.metrics),
+                         ["zvm_page_allocated_total", "zvm_page_used_total",
+                          "zvm_spool_allocated_total", "zvm_spool_used_total",
+                          "zvm_system_cpu_count", "zvm_system_cpu_in_use",
+                          "zvm_system_memory_in_use",
+                          "zvm_system_memory_total", "zvm_disk_status",
+                          "zvm_disk_space_total", "zvm_disk_space_free"])
+
+
+def test_collect_stream_malformed():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     stream=True)
+    c.requester = StreamRequester({
+        "query_disk_def": '{"data": [["zhcpos2: \\uZZZZ"]]}',
+        "query_disk_free": disk_free_data})
+
+    # The response can't be decoded: every stream is released and the
+    # partial results are not kept
+    assert not c.collect_disk()
+    assert all(response.closed for response in c.requester.sent)
+    assert c.success == {"query_disk_def": False, "query_disk_free": True}
+    assert "disk" not in c.parsed
+
+    # Whatever the parse function raises, the streams are released
+    c.requester = StreamRequester({"query_disk_def": disk_def_data,
+                                   "query_disk_free": disk_free_data})
+    c.ttls = {}
+    parse = Parser.parse_disk_hosts
+    Parser.parse_disk_hosts = staticmethod(lambda *streams: 1 / 0)
+    try:
+        with pytest.raises(ZeroDivisionError):
+            c.collect_disk()
+    finally:
+        Parser.parse_disk_hosts = staticmethod(parse)
+    assert all(response.closed for response in c.requester.sent)
+
+
+def test_collect_stream_stale():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     stream=True)
+    c.parsed["page"] = {"zhcpos2": [{"total_allocated": 1, "total_used": 2}]}
+    c.requester.stream = lambda f, deadline=None: None
+
+    # The query fails: the last good results are served
+    metrics = c.collect_page()
+    assert [s.value for s in metrics["used_total"]["value"].samples] == [2]
+    assert c.success == {"query_page_info": False}
+
+
+def test_build_metrics_cache():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443)
+    c.requester = FakeRequester({"query_disk_def": disk_def_data,
+                                 "query_disk_free": disk_free_data})
+
+    first = c.collect_disk(timestamp=1)
+    # The responses are unchanged: the metrics are reused and restamped
+    second = c.collect_disk(timestamp=2)
+    assert (c.metrics_cache.hits, c.metrics_cache.misses) == (1, 1)
+    for name in first:
+        samples = first[name]["value"].samples
+        assert second[name]["value"].samples == [
+            s._replace(timestamp=2) for s in samples]
+
+    c.requester = FakeRequester({"query_disk_def": disk_def_data,
+                                 "query_disk_free": emptyData2})
+    c.collect_disk()
+    assert c.metrics_cache.misses == 2
+    # The changed response replaces the cached metrics instead of adding to
+    # them
+    assert len(c.metrics_cache) == 1
+    c.requester = FakeRequester({"query_disk_def": disk_def_data,
+                                 "query_disk_free": disk_free_data})
+    c.collect_disk()
+    assert (c.metrics_cache.hits, c.metrics_cache.misses) == (1, 3)
+
+
+def test_collect_disk_columns():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443)
+    c.requester = FakeRequester({"query_disk_def": disk_def_data,
+                                 "query_disk_free": disk_free_data})
+
+    # The samples are emitted from the columns of the disk results
+    metrics = c.collect_disk()
+    samples = metrics["space_free"]["value"].samples
+    assert dict((s.labels["volume"], s.value) for s in samples) == {
+        "OS2P01": 58843, "OS2P02": 65519, "OS2P03": 0}
+    samples = metrics["status"]["value"].samples
+    assert [s.labels for s in samples][1] == {"host": "zhcpos2",
+                                              "volume": "OS2P02"}
+
+
+@httpretty.activate
+def test_collect_stats():
+    # httpretty mixes up the responses of concurrent requests
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     workers=1)
+    httpretty.register_uri(
+        httpretty.PUT, "http://example.com:443/xcatws/nodes/zhcpos2/dsh",
+        body=request_callback, content_type='text/plain')
+    c.refresh()
+
+    stats = dict((m.name, m) for m in c.collect_stats())
+    samples = stats["zvm_exporter_responses"].samples
+    assert compare_lists([(s.labels["query"], s.labels["code"], s.value)
+                          for s in samples],
+                         [(q[len("query_"):], "200", 1) for q in QUERIES])
+    samples = stats["zvm_exporter_response_bytes"].samples
+    assert dict((s.labels["query"], s.value) for s in samples)[
+        "page_info"] == len(page_data)
+    samples = stats["zvm_exporter_request_duration_seconds"].samples
+    assert len([s for s in samples if s.name.endswith("_count")]) == 5
+    samples = stats["zvm_exporter_parse_duration_seconds"].samples
+    assert compare_lists([s.labels["collector"] for s in samples
+                          if s.name.endswith("_count")],
+                         ["page", "spool", "system", "disk"])
+    samples = stats["zvm_exporter_collector_success"].samples
+    assert [s.value for s in samples] == [1, 1, 1, 1]
+    assert stats["zvm_exporter_scrape_duration_seconds"].samples[0].value > 0
+
+
+class SlowFakeRequester(FakeRequester):
+    """FakeRequester whose queries take a given time to return."""
+    def __init__(self, responses, delays):
+        FakeRequester.__init__(self, responses)
+        self.delays = delays
+
+    def __getattr__(self, name):
+        def query(deadline=None):
+            time.sleep(self.delays.get(name, 0))
+            return self.responses[name]
+        return query
+
+
+def test_fetch_budgets():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443)
+    c.requester = SlowRequester({"query_page_info": 0.3,
+                                 "query_disk_def": 1})
+
+    # Each query is waited for its own budget
+    responses = c.fetch(["query_page_info", "query_disk_def"],
+                        budgets={"query_disk_def": 0.1})
+    assert responses == {"query_page_info": "query_page_info",
+                         "query_disk_def": ""}
+
+
+def test_wait_order():
+    now = time.time()
+    order = ZVMCollector.wait_order(
+        ["query_page_info", "query_spool_info", "query_disk_def"], None,
+        {"query_disk_def": 0.1, "query_spool_info": 20}, now + 10, now)
+    assert order == [("query_disk_def", 0.1), ("query_page_info", 10),
+                     ("query_spool_info", 10)]
+
+
+def test_refresh_budgets():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     budgets={"disk": 0.2})
+    responses = {"query_page_info": page_data, "query_spool_info": spool_data,
+                 "query_cpu_memory_info": cpu_memory_data,
+                 "query_disk_def": disk_def_data,
+                 "query_disk_free": disk_free_data}
+    c.requester = SlowFakeRequester(responses, {})
+    c.refresh()
+    assert c.collector_success == {"page": True, "spool": True,
+                                   "system": True, "disk": True}
+
+    # The disk query misses its budget: the other groups are not held up
+    # and the last good disk metrics are served
+    c.requester = SlowFakeRequester(responses, {"query_disk_free": 1})
+    c.cache.clear()
+    start = time.time()
+    snapshot = c.refresh()
+    assert time.time() - start < 0.8
+    names = set(m.name for m in snapshot.metrics)
+    assert "zvm_page_used_total" in names
+    assert "zvm_disk_space_free" in names
+    assert c.collector_success["disk"] is False
+    assert c.collector_success["page"] is True
+    assert c.success["query_disk_free"] is False
+
+
+def test_collect_collectors():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443,
+                     collectors=["page", "system", "disk"])
+    sent = []
+
+    def query(name):
+        def send(deadline=None):
+            sent.append(name)
+            return {"query_page_info": page_data,
+                    "query_cpu_memory_info": cpu_memory_data}.get(name, "")
+        return send
+
+    c.requester = FakeRequester({})
+    for f in QUERIES:
+        setattr(c.requester, f, query(f))
+
+    # Only the queries of the requested and enabled groups are sent
+    with scrape_collectors(["system", "spool"]):
+        names = set(m.name for m in c.collect())
+    assert sent == ["query_cpu_memory_info"]
+    assert "zvm_system_cpu_count" in names
+    assert not [n for n in names if n.startswith("zvm_page_")]
+
+    del sent[:]
+    names = set(m.name for m in c.collect())
+    assert compare_lists(sent, ["query_page_info", "query_cpu_memory_info",
+                                "query_disk_def", "query_disk_free"])
+    assert "zvm_page_used_total" in names
+    assert not [n for n in names if n.startswith("zvm_spool_")]
+
+
+def test_collect_warm_up():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443)
+    c.requester = FakeRequester({"query_page_info": page_data})
+    assert not c.ready()
+
+    # The warm-up refreshes in the background and fills the cache
+    c.warm_up().join(5)
+    assert c.ready()
+    assert "query_page_info" in c.cache
+
+
+def test_collect_ready_failed():
+    c = ZVMCollector("zhcpos2", "user", "password", "example.com", 443)
+    c.requester = FakeRequester({})
+
+    # Every group failed: the snapshot is empty and not ready
+    c.refresh()
+    assert c.snapshot is not None
+    assert not c.ready()
+
+    c.requester = FakeRequester({"query_page_info": page_data})
+    c.refresh()
+    assert c.ready()
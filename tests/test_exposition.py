@@ -0,0 +1,46 @@
+import gzip
+import io
+from prometheus_client.core import CollectorRegistry, GaugeMetricFamily
+from prometheus_client.exposition import choose_encoder
+from zvm_exporter.exposition import ExpositionCache
+
+
+class CountingCollector(object):
+    def __init__(self):
+        self.calls = 0
+
+    def collect(self):
+        self.calls += 1
+        metric = GaugeMetricFamily("calls", "Number of collect calls")
+        metric.add_metric([], self.calls)
+        yield metric
+
+
+def test_exposition_cache():
+    registry = CollectorRegistry()
+    collector = CountingCollector()
+    registry.register(collector)
+    version = [(1.0,)]
+    cache = ExpositionCache(registry, lambda: version[0])
+    encoder, content_type = choose_encoder(None)
+
+    first = cache.get(encoder, content_type)
+    assert b"calls 1.0" in first.plain
+    assert gzip.GzipFile(fileobj=io.BytesIO(first.gzip)).read() == \
+        first.plain
+    assert first.last_modified == "Thu, 01 Jan 1970 00:00:01 GMT"
+
+    # The data has not changed: the exposition is not rendered again
+    assert cache.get(encoder, content_type) is first
+    assert collector.calls == 1
+
+    version[0] = (2.0,)
+    second = cache.get(encoder, content_type)
+    assert b"calls 2.0" in second.plain
+    assert second.etag != first.etag
+
+    # Without a version, the exposition is rendered every time
+    version[0] = None
+    cache.get(encoder, content_type)
+    cache.get(encoder, content_type)
+    assert collector.calls == 4
@@ -0,0 +1,75 @@
+import threading
+import time
+from zvm_exporter.hedge import HedgePolicy
+from zvm_exporter.requester import Requester
+
+
+class SlowRequester(Requester):
+    """Requester whose first request is slow."""
+    def __init__(self, *args, **kwargs):
+        Requester.__init__(self, *args, **kwargs)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def do_request(self, query_name, deadline=None):
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        if call == 1:
+            time.sleep(0.5)
+            return "first"
+        return "second"
+
+
+def make_requester(**options):
+    r = SlowRequester("zhcp", "user", "password", "example.com", 443,
+                      hedge=90, **options)
+    for _ in range(20):
+        r.hedging.observe("page_info", 0.05)
+    return r
+
+
+def test_hedge_policy():
+    policy = HedgePolicy(percentile=90, budget=0.5, min_samples=10, burst=1)
+    for i in range(1, 10):
+        policy.observe("page_info", i / 10.0)
+    # Not enough samples yet
+    assert policy.delay("page_info") is None
+    policy.observe("page_info", 1.0)
+    assert policy.delay("page_info") == 0.9
+    assert policy.delay("spool_info") is None
+
+    # Two requests earn a hedge, and no more than burst are saved up
+    assert not policy.spend()
+    for _ in range(4):
+        policy.earn()
+    assert policy.spend()
+    assert not policy.spend()
+
+
+def test_hedge_win():
+    r = make_requester()
+    r.hedging.tokens = 1
+
+    start = time.time()
+    assert r.query_page_info() == "second"
+    assert time.time() - start < 0.4
+    assert r.calls == 2
+    assert r.hedged == {"page_info": 1}
+    assert r.hedge_wins == {"page_info": 1}
+    assert r.hedges_denied == {}
+
+
+def test_hedge_over_budget():
+    r = make_requester(hedge_budget=0)
+
+    # The slow request is waited for
+    assert r.query_page_info() == "first"
+    assert r.calls == 1
+    assert r.hedged == {}
+    assert r.hedges_denied == {"page_info": 1}
+
+    # Without latency history, requests are not hedged
+    r.hedging.latencies.clear()
+    assert r.query_page_info() == "second"
+    assert r.hedges_denied == {"page_info": 1}
@@ -1,7 +1,10 @@
-from utils import compare_lists_of_dict
-from zvm_exporter.parser import Parser
+import re
+from utils import compare_lists, compare_lists_of_dict
+from zvm_exporter.parser import Parser, StreamDecoder
 from data import (page_data, spool_data, cpu_memory_data, disk_def_data,
-                  disk_free_data, emptyData1, emptyData2)
+                  disk_free_data, emptyData1, emptyData2, page_hosts_data,
+                  disk_def_hosts_data, disk_free_hosts_data, combined_data,
+                  chunked_data)
 
 
 def test_make_snake_case():
@@ -63,3 +66,114 @@ def test_parse_disk():
          {'space_free': 0,     'space_total': 65520, 'status': 0,
           'volume': 'OS2P03'}],
         key='volume')
+    # The sizes are counts of extents, as ints
+    assert all(type(volume[key]) is int for volume in parse
+               for key in ('space_free', 'space_total', 'status'))
+
+
+def test_parse_page_hosts():
+    p = Parser()
+    parse = p.parse_page_hosts(page_hosts_data)
+    assert compare_lists(parse.keys(), ["zhcpos2", "zhcpos3"])
+    assert parse["zhcpos2"] == [{"total_allocated": 93920,
+                                 "total_used": 33106,
+                                 "available_percentage": 1}]
+    assert parse["zhcpos3"] == [{"total_allocated": 2560,
+                                 "total_used": 834,
+                                 "available_percentage": 7}]
+    assert p.parse_page("zhcpos3", page_hosts_data) == parse["zhcpos3"]
+    assert p.parse_page("zhcpos4", page_hosts_data) == [{}]
+
+
+def test_parse_disk_hosts():
+    p = Parser()
+    parse = p.parse_disk_hosts(disk_def_hosts_data, disk_free_hosts_data)
+    assert parse["zhcpos2"].volume == ["OS2P01"]
+    assert list(parse["zhcpos2"].space_free) == [58843]
+    parse = dict((host, list(volumes)) for host, volumes in parse.items())
+    assert parse == {
+        "zhcpos2": [{'space_free': 58843, 'space_total': 65520, 'status': 0,
+                     'volume': 'OS2P01'}],
+        "zhcpos3": [{'space_free': 10016, 'space_total': 10017, 'status': 1,
+                     'volume': 'OS3P01'}]}
+
+
+def test_split_commands():
+    p = Parser()
+    responses = p.split_commands(combined_data, "END", 2)
+    assert p.get_data(responses[0]) == ["zhcpos2: Total allocated: 93920K",
+                                        "zhcpos3: Total allocated: 2560K"]
+    assert p.get_data(responses[1]) == ["zhcpos2: Total allocated: 12001K",
+                                        "zhcpos3: Total allocated: 4837K"]
+    assert p.parse_page("zhcpos3", responses[1]) == [
+        {"total_allocated": 4837}]
+    # A failed request gives an empty response for every command
+    assert p.split_commands("", "END", 2) == ["", ""]
+
+
+def test_parse_disk_regex_compat():
+    # Reference implementation of the free space line parsing, as it was
+    # done with a regex before
+    free_rx = re.compile(
+        r'(?P<host>[^:]+): (?P<volid>.+) (?P<devtype>.+) (?P<start>.+) '
+        r'(?P<size>.+) (?P<group_name>.+) (?P<region_name>.+)')
+    lines = ["zhcpos2: OS2P01 3390-64K 6677 58843 * *",
+             "zhcpos2: $$$$$$ ???? 1 500 * *",
+             "zhcpos2: OS2 P01 3390-64K 1 58843 * *",
+             "zhcpos2: OS2P01 3390-64K 1 58843 *",
+             "zhcpos2 OS2P01 3390-64K 1 58843 * *",
+             "zhcpos2:OS2P01 3390-64K 1 58843 * *"]
+    for line in lines:
+        match = free_rx.match(line)
+        host, rest = Parser.split_host(line)
+        fields = rest.rsplit(' ', 5) if rest else []
+        if not match:
+            assert host is None or len(fields) < 6
+            continue
+        assert host == match.group('host').strip()
+        assert fields[0] == match.group('volid')
+        assert fields[2] == match.group('start')
+        assert fields[3] == match.group('size')
+
+
+def test_decode():
+    p = Parser()
+    chunks, errorcode = p.decode(chunked_data)
+    assert len(chunks) == 2
+    assert errorcode == "4"
+    assert p.get_data(chunked_data) == [
+        "zhcpos2: Total allocated: 93920K",
+        "zhcpos2: Total used: 33106",
+        "zhcpos2: Available percentage: 1",
+        'zhcpos2: Name: "OS\\PA"']
+    assert p.parse_page("zhcpos2", chunked_data)[0]["total_used"] == 33106
+    assert p.get_errorcode(chunked_data) == 4
+    assert p.get_errorcode(emptyData2) is None
+    assert p.decode("not json") == ([], None)
+
+
+def test_iter_stream():
+    p = Parser()
+    for response in (page_data, spool_data, cpu_memory_data, disk_def_data,
+                     disk_free_data, emptyData1, emptyData2, combined_data,
+                     chunked_data):
+        # The lines do not depend on where the response is cut
+        for size in range(1, 8):
+            chunks = [response[i:i + size].encode()
+                      for i in range(0, len(response), size)]
+            assert list(p.iter_stream(chunks)) == p.get_data(response)
+
+    # Surrogate pairs give the same characters as json, wherever the
+    # response is cut
+    response = ('{"data": [{"data": ["h: \\ud83d\\ude00 \\ud83d", '
+                '"h: \\ude00\\ud83d\\u0041\\ud83d\\nh: x"]}]}')
+    for size in range(1, 14):
+        chunks = [response[i:i + size]
+                  for i in range(0, len(response), size)]
+        assert list(p.iter_stream(chunks)) == list(p.iter_lines(response))
+    assert list(p.iter_lines(response))[0] == u"h: \U0001f600 \ud83d"
+
+    decoder = StreamDecoder()
+    lines = list(p.iter_stream([chunked_data], decoder))
+    assert decoder.errorcode == "4"
+    assert p.parse_page("zhcpos2", lines)[0]["total_used"] == 33106
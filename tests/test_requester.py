@@ -1,16 +1,175 @@
+import threading
+import time
 import httpretty
-from zvm_exporter.requester import Requester
+from utils import compare_lists
+from zvm_exporter.parser import Parser
+from zvm_exporter.requester import Attempts, Requester
+from data import combined_data, chunked_data
 
 
 @httpretty.activate
 def test_requester():
     r = Requester("dummy", "user", "password", "example.com", 443)
-    httpretty.register_uri(httpretty.PUT, "http://example.com:443",
+    httpretty.register_uri(httpretty.PUT,
+                           "http://example.com:443/xcatws/nodes/dummy/dsh",
                            status=200, body="test", content_type='text/plain')
-    r.send_request("test text")
+    assert r.send_request("test text") == "test"
     last_request = httpretty.last_request()
     assert last_request.querystring["userName"] == ["user"]
     assert last_request.querystring["password"] == ["password"]
     assert last_request.headers['content-type'] == 'text/plain'
     assert last_request.headers['content-length'] != 0
     assert last_request.parsed_body == '["command=smcli test text"]'
+
+
+@httpretty.activate
+def test_requester_session():
+    r = Requester("dummy", "user", "password", "example.com", 443,
+                  pool_size=4, retries=2)
+    httpretty.register_uri(httpretty.PUT,
+                           "http://example.com:443/xcatws/nodes/dummy/dsh",
+                           status=200, body="test", content_type='text/plain')
+    session = r.session
+    r.query_page_info()
+    r.query_spool_info()
+    # All queries of a requester share the same pooled session
+    assert r.session is session
+    adapter = session.get_adapter("https://example.com:443")
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 2
+    # A request xCAT may have run already is not sent again
+    assert adapter.max_retries.read == 0
+
+
+def test_requester_coalesce():
+    r = Requester("dummy", "user", "password", "example.com", 443)
+    sent = []
+
+    def do_request(query_name, deadline=None):
+        sent.append(query_name)
+        time.sleep(0.2)
+        return "response"
+
+    r.do_request = do_request
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(r.query_page_info()))
+        for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sent == ["System_Page_Utilization_Query -T ZHCP"]
+    assert results == ["response"] * 3
+    assert r.coalesced == 2
+
+
+@httpretty.activate
+def test_requester_retries():
+    r = Requester("dummy", "user", "password", "example.com", 443,
+                  retries=2, backoff_factor=0.5)
+    statuses = [503, 503, 200]
+
+    def callback(request, uri, headers):
+        return statuses.pop(0), headers, "test"
+
+    httpretty.register_uri(httpretty.PUT,
+                           "http://example.com:443/xcatws/nodes/dummy/dsh",
+                           body=callback)
+    assert r.query_page_info() == "test"
+    assert statuses == []
+
+    # No retry is made past the deadline
+    statuses[:] = [503, 503, 200]
+    start = time.time()
+    assert r.send_request("query_spool_info", time.time() + 0.2) == ""
+    assert time.time() - start < 0.2
+    assert statuses == [503, 200]
+
+
+def test_attempts():
+    class Auth(object):
+        refused = []
+
+        def invalidate(self, token):
+            self.refused.append(token)
+
+    auth = Auth()
+    a = Attempts(2, 0.5, auth)
+    # A refused token is replaced once, without counting as a retry
+    assert a.next(401, {"X-Auth-Token": "token"}) == 0
+    assert auth.refused == ["token"]
+    assert a.next(503) == 0.5
+    assert a.next() == 1
+    assert a.next(503) is None
+    assert Attempts(2, 0.5, auth).next(404) is None
+
+    # No retry is made past the deadline
+    assert Attempts(2, 0.5, deadline=time.time() + 0.2).next(503) is None
+
+
+@httpretty.activate
+def test_requester_breaker():
+    r = Requester("dummy", "user", "password", "example.com", 443,
+                  retries=0, backoff=60)
+    httpretty.register_uri(httpretty.PUT,
+                           "http://example.com:443/xcatws/nodes/dummy/dsh",
+                           status=500, body="error")
+    for _ in range(2):
+        assert r.query_page_info() == ""
+    request_count = len(httpretty.latest_requests())
+
+    # The breaker of the query is open, no request is sent
+    assert r.query_page_info() == ""
+    assert len(httpretty.latest_requests()) == request_count
+
+
+@httpretty.activate
+def test_requester_combined():
+    r = Requester("dummy", "user", "password", "example.com", 443)
+    httpretty.register_uri(httpretty.PUT,
+                           "http://example.com:443/xcatws/nodes/dummy/dsh",
+                           status=200, body=combined_data)
+    responses = r.query_combined(["query_page_info", "query_spool_info"])
+
+    # A single request runs both commands
+    assert httpretty.last_request().parsed_body == (
+        '["command=smcli System_Page_Utilization_Query -T ZHCP; echo '
+        'ZVM_EXPORTER_END_OF_COMMAND; smcli System_Spool_Utilization_Query '
+        '-T ZHCP; echo ZVM_EXPORTER_END_OF_COMMAND"]')
+    assert compare_lists(responses.keys(),
+                         ["query_page_info", "query_spool_info"])
+
+
+@httpretty.activate
+def test_requester_stream():
+    r = Requester("dummy", "user", "password", "example.com", 443)
+    httpretty.register_uri(httpretty.PUT,
+                           "http://example.com:443/xcatws/nodes/dummy/dsh",
+                           status=200, body=chunked_data)
+    stream = r.stream("query_page_info")
+    assert list(stream) == Parser.get_data(chunked_data)
+    assert stream.errorcode == 4
+
+    httpretty.register_uri(httpretty.PUT,
+                           "http://example.com:443/xcatws/nodes/dummy/dsh",
+                           status=500, body="error")
+    assert Requester("dummy", "user", "password", "example.com", 443,
+                     retries=0).stream("query_page_info") is None
+
+
+@httpretty.activate
+def test_requester_deadline():
+    r = Requester("dummy", "user", "password", "example.com", 443)
+    httpretty.register_uri(httpretty.PUT,
+                           "http://example.com:443/xcatws/nodes/dummy/dsh",
+                           status=200, body="response")
+    assert r.query_page_info(deadline=time.time() + 10) == "response"
+    request_count = len(httpretty.latest_requests())
+
+    # Once the deadline has passed, the query is not sent and does not count
+    # as a failure
+    assert r.query_page_info(deadline=time.time() - 1) == ""
+    assert len(httpretty.latest_requests()) == request_count
+    assert r.breaker("System_Page_Utilization_Query -T ZHCP").failures == 0
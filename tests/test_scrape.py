@@ -0,0 +1,27 @@
+from zvm_exporter.scrape import (current_collectors, current_deadline,
+                                 scrape_collectors, scrape_deadline,
+                                 shortest, time_left)
+
+
+def test_scrape_deadline():
+    assert current_deadline() is None
+    with scrape_deadline(10):
+        assert current_deadline() == 10
+        with scrape_deadline(5):
+            assert current_deadline() == 5
+        assert current_deadline() == 10
+    assert current_deadline() is None
+
+
+def test_time_left():
+    assert time_left(None) is None
+    assert time_left(10, now=4) == 6
+    assert time_left(10, now=12) == 0
+    assert shortest(None, 3, 2) == 2
+    assert shortest(None, None) is None
+
+
+def test_scrape_collectors():
+    with scrape_collectors(["disk"]):
+        assert current_collectors() == ["disk"]
+    assert current_collectors() is None
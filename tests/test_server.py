@@ -0,0 +1,129 @@
+import time
+import requests
+from utils import FakeRequester
+from zvm_exporter.collector import Snapshot
+from zvm_exporter.server import start_http_server
+from zvm_exporter.targets import Targets
+from prometheus_client.core import CollectorRegistry
+from data import page_data
+
+
+def test_server_probe():
+    t = Targets("user", "password", "example.com", 443)
+    t.get("zhcpos2").requester = FakeRequester(
+        {"query_page_info": page_data})
+    server = start_http_server(0, t, addr="127.0.0.1",
+                               registry=CollectorRegistry())
+    url = "http://127.0.0.1:{}".format(server.server_port)
+    try:
+        response = requests.get(url + "/probe", params={"target": "zhcpos2"})
+        assert response.status_code == 200
+        assert 'zvm_page_used_total{host="zhcpos2"} 33106.0' in response.text
+
+        # A probe without target is rejected
+        assert requests.get(url + "/probe").status_code == 400
+        # The static targets are exported on /metrics
+        assert requests.get(url + "/metrics").status_code == 200
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_conditional():
+    t = Targets("user", "password", "example.com", 443, interval=60)
+    t.add("zhcpos2").snapshot = Snapshot(1.0, ())
+    registry = CollectorRegistry()
+    registry.register(t)
+    server = start_http_server(0, t, addr="127.0.0.1", registry=registry)
+    url = "http://127.0.0.1:{}/metrics".format(server.server_port)
+    try:
+        response = requests.get(url)
+        assert response.headers["Content-Encoding"] == "gzip"
+        # The time of the snapshot stays right in the cached exposition
+        assert ('zvm_exporter_snapshot_timestamp_seconds{host="zhcpos2"} 1.0'
+                in response.text)
+        etag = response.headers["ETag"]
+
+        # The snapshot has not changed: the exposition is not sent again
+        response = requests.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        response = requests.get(url, headers={
+            "If-Modified-Since": response.headers["Last-Modified"]})
+        assert response.status_code == 304
+
+        t.static["zhcpos2"].snapshot = Snapshot(2.0, ())
+        response = requests.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        assert server.RequestHandlerClass.exposition.renders == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_scrape_timeout():
+    t = Targets("user", "password", "example.com", 443)
+    received = []
+
+    def query_page_info(deadline=None):
+        received.append(deadline)
+        time.sleep(2)
+        return page_data
+
+    t.get("zhcpos2").requester = FakeRequester({})
+    t.get("zhcpos2").requester.query_page_info = query_page_info
+    server = start_http_server(0, t, addr="127.0.0.1",
+                               registry=CollectorRegistry())
+    url = "http://127.0.0.1:{}/probe".format(server.server_port)
+    try:
+        start = time.time()
+        response = requests.get(url, params={"target": "zhcpos2"}, headers={
+            "X-Prometheus-Scrape-Timeout-Seconds": "1"})
+        # The scrape does not wait for the query past the scrape timeout
+        assert response.status_code == 200
+        assert time.time() - start < 1.5
+        assert start < received[0] < start + 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_collect_params():
+    t = Targets("user", "password", "example.com", 443)
+    t.get("zhcpos2").requester = FakeRequester(
+        {"query_page_info": page_data, "query_spool_info": page_data})
+    server = start_http_server(0, t, addr="127.0.0.1",
+                               registry=CollectorRegistry())
+    url = "http://127.0.0.1:{}/probe".format(server.server_port)
+    try:
+        response = requests.get(url, params={"target": "zhcpos2",
+                                             "collect[]": ["spool"]})
+        assert "zvm_spool_used_total" in response.text
+        assert "zvm_page_used_total" not in response.text
+
+        response = requests.get(url, params={"target": "zhcpos2",
+                                             "collect[]": ["cpu"]})
+        assert response.status_code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_ready():
+    t = Targets("user", "password", "example.com", 443, interval=60)
+    collector = t.add("zhcpos2")
+    server = start_http_server(0, t, addr="127.0.0.1",
+                               registry=CollectorRegistry())
+    url = "http://127.0.0.1:{}/ready".format(server.server_port)
+    try:
+        assert requests.get(url).status_code == 503
+        # A first refresh that collected nothing
+        collector.requester = FakeRequester({})
+        collector.refresh()
+        assert requests.get(url).status_code == 503
+        collector.requester = FakeRequester({"query_page_info": page_data})
+        collector.refresh()
+        assert requests.get(url).status_code == 200
+    finally:
+        server.shutdown()
+        server.server_close()
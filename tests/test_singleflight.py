@@ -0,0 +1,44 @@
+import threading
+import time
+import pytest
+from zvm_exporter.singleflight import SingleFlight
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    calls = []
+
+    def slow(value):
+        calls.append(value)
+        time.sleep(0.2)
+        return value
+
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(flight.do("key", slow, "value")))
+        for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Only the first caller runs the function, the others share its result
+    assert calls == ["value"]
+    assert results == ["value"] * 3
+    assert flight.coalesced == 2
+
+    # Once the call has returned, the next one runs the function again
+    assert flight.do("key", slow, "again") == "again"
+    assert calls == ["value", "again"]
+
+
+def test_single_flight_error():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        flight.do("key", fail)
+    # A failed call is not kept in flight
+    assert flight.do("key", lambda: "ok") == "ok"
@@ -0,0 +1,127 @@
+import socket
+import pytest
+from data import page_data, cpu_memory_data, disk_def_data, disk_free_data
+from utils import FakeRequester
+from zvm_exporter.collector import QUERIES, ZVMCollector
+from zvm_exporter.fakesmapi import FakeSMAPIServer
+from zvm_exporter.parser import Parser
+from zvm_exporter.smapi import (SMAPIRequester, SMAPISession, encode_records,
+                                encode_request, encode_strings,
+                                encode_utilization, unpack_int,
+                                unpack_string)
+from zvm_exporter.targets import Targets
+
+
+def lines(response):
+    return [line.split(": ", 1)[1] for line in Parser.iter_lines(response)]
+
+
+def outputs():
+    return {
+        "System_Page_Utilization_Query": (
+            0, 0, encode_utilization(93920, 33106, 1)),
+        "System_Performance_Information_Query": (
+            0, 0, encode_strings(lines(cpu_memory_data))),
+        "Image_Volume_Space_Query_DM": (
+            0, 0, encode_records(lines(disk_def_data))),
+    }
+
+
+def make_requester(server, zhcpnode="localhost", password="password"):
+    session = SMAPISession(server.server_address[1])
+    return SMAPIRequester(zhcpnode, "user", password, session=session)
+
+
+def test_smapi_encode_request():
+    request = encode_request("Function", "user", "pw", "ZHCP", b"\x01")
+    length, offset = unpack_int(request)
+    assert length == len(request) - 4
+    fields = []
+    for _ in range(4):
+        field, offset = unpack_string(request, offset)
+        fields.append(field)
+    assert fields == ["Function", "user", "pw", "ZHCP"]
+    assert request[offset:] == b"\x01"
+
+
+def test_smapi_requester():
+    server = FakeSMAPIServer(outputs(), ("user", "password")).start()
+    try:
+        requester = make_requester(server)
+        response = requester.query_page_info()
+        assert Parser.parse_page("localhost", response) == [{
+            "total_allocated": 93920, "total_used": 33106,
+            "available_percentage": 1}]
+        assert Parser.parse_cpu_memory("localhost",
+                                       requester.query_cpu_memory_info()) == \
+            Parser.parse_cpu_memory("zhcpos2", cpu_memory_data)
+        assert Parser.get_errorcode(response) == 0
+        # The queries share a persistent connection
+        assert server.connections == 1
+        assert server.calls[-1] == ("System_Performance_Information_Query",
+                                    b"DETAILED_CPU=SHOW=NO\0")
+        assert requester.statuses[("page_info", "0")] == 1
+
+        # Unknown functions and failed authentications are failures
+        assert requester.query_spool_info() == ""
+        requester = make_requester(server, password="wrong")
+        assert requester.query_page_info() == ""
+        assert requester.statuses[("page_info", "100")] == 1
+    finally:
+        server.stop()
+
+
+def test_smapi_reconnect():
+    server = FakeSMAPIServer(outputs()).start()
+    try:
+        requester = make_requester(server)
+        assert requester.query_page_info()
+        # A connection closed by the server is replaced
+        connection = requester.session.idle["localhost"][0]
+        connection.sock.shutdown(socket.SHUT_RDWR)
+        assert requester.do_request(
+            "System_Page_Utilization_Query -T ZHCP")
+        assert server.connections == 2
+    finally:
+        server.stop()
+
+
+def test_smapi_collector():
+    server = FakeSMAPIServer(outputs()).start()
+    try:
+        c = ZVMCollector("localhost", "user", "password", None, None,
+                         requester_class=SMAPIRequester,
+                         session=SMAPISession(server.server_address[1]))
+        server.outputs["Image_Volume_Space_Query_DM"] = (
+            0, 0, encode_records(lines(disk_free_data)))
+        snapshot = c.refresh()
+    finally:
+        server.stop()
+
+    # The metrics are the same as those built from xCAT responses
+    reference = ZVMCollector("localhost", "user", "password", "example.com",
+                             443)
+    responses = {"query_page_info": page_data,
+                 "query_cpu_memory_info": cpu_memory_data,
+                 "query_disk_def": disk_free_data,
+                 "query_disk_free": disk_free_data}
+    reference.requester = FakeRequester(dict(
+        (f, responses.get(f, "").replace("zhcpos2", "localhost"))
+        for f in QUERIES))
+    expected = reference.refresh()
+    names = [m.name for m in expected.metrics]
+    assert [m.name for m in snapshot.metrics] == names
+    assert "zvm_disk_space_free" in names
+    page = [m for m in snapshot.metrics if m.name.startswith("zvm_page")]
+    assert page[0].samples[0].labels == {"host": "localhost"}
+    assert [[s[:3] for s in m.samples] for m in snapshot.metrics] == \
+        [[s[:3] for s in m.samples] for m in expected.metrics]
+
+    # SMAPI can't stream responses: refused up front, not on refresh
+    with pytest.raises(ValueError):
+        ZVMCollector("localhost", "user", "password", None, None,
+                     requester_class=SMAPIRequester, stream=True,
+                     session=SMAPISession())
+    with pytest.raises(ValueError):
+        Targets("user", "password", None, None, smapi_port=44444,
+                stream=True)
@@ -0,0 +1,94 @@
+import os
+import stat
+import pytest
+from data import page_data, cpu_memory_data
+from utils import FakeRequester
+from zvm_exporter.collector import QUERIES, ZVMCollector
+from zvm_exporter.parser import Parser
+from zvm_exporter.requester import COMMANDS
+from zvm_exporter.ssh import (SSHRequester, SSHSession, SSHTransport,
+                              StubTransport)
+from zvm_exporter.targets import Targets
+
+
+def output(response):
+    return "".join(line.split(": ", 1)[1] + "\n"
+                   for line in Parser.iter_lines(response))
+
+
+def make_session(**options):
+    session = SSHSession()
+    session.transports["zhcpos2"] = StubTransport({
+        COMMANDS["query_page_info"]: output(page_data),
+        COMMANDS["query_cpu_memory_info"]: output(cpu_memory_data)},
+        **options)
+    return session
+
+
+def test_ssh_requester():
+    requester = SSHRequester("zhcpos2", "user", None, session=make_session())
+    response = requester.query_page_info()
+    assert Parser.parse_page("zhcpos2", response) == \
+        Parser.parse_page("zhcpos2", page_data)
+    assert requester.statuses[("page_info", "0")] == 1
+
+    # Combined commands are run by one shell
+    responses = requester.query_combined(["query_page_info",
+                                          "query_cpu_memory_info"])
+    assert Parser.parse_cpu_memory(
+        "zhcpos2", responses["query_cpu_memory_info"]) == \
+        Parser.parse_cpu_memory("zhcpos2", cpu_memory_data)
+    assert len(requester.session.transport("zhcpos2").commands) == 2
+
+    # Failed commands without output are failures
+    requester = SSHRequester("zhcpos2", "user", None,
+                             session=make_session(status=255))
+    assert requester.query_page_info() == ""
+
+
+def test_ssh_transport(tmpdir):
+    ssh = str(tmpdir.join("ssh"))
+    with open(ssh, "w") as f:
+        f.write('#!/bin/sh\necho "$@" > "$0.args"\n'
+                'case "$*" in *sleep*) exec sleep 5;; esac\n'
+                'echo CPU_COUNT=32\n')
+    os.chmod(ssh, os.stat(ssh).st_mode | stat.S_IEXEC)
+
+    transport = SSHTransport("zhcpos2", "user", "key", "/tmp/control",
+                             ssh=ssh)
+    assert transport.run("smcli Query") == (0, "CPU_COUNT=32\n")
+    with open(ssh + ".args") as f:
+        args = f.read().split()
+    # Commands are multiplexed on a master connection
+    assert "ControlMaster=auto" in args
+    assert "ControlPath=/tmp/control" in args
+    assert args[-3:] == ["zhcpos2", "smcli", "Query"]
+    assert ["-l", "user"] == args[args.index("-l"):args.index("-l") + 2]
+
+    # Commands are killed on timeout
+    status, _ = transport.run("sleep", timeout=0.2)
+    assert status < 0
+
+
+def test_ssh_collector():
+    c = ZVMCollector("zhcpos2", "user", None, None, None,
+                     requester_class=SSHRequester, session=make_session())
+    snapshot = c.refresh()
+
+    reference = ZVMCollector("zhcpos2", "user", "password", "example.com",
+                             443)
+    responses = {"query_page_info": page_data,
+                 "query_cpu_memory_info": cpu_memory_data}
+    reference.requester = FakeRequester(dict(
+        (f, responses.get(f, "")) for f in QUERIES))
+    expected = reference.refresh()
+    assert [[s[:3] for s in m.samples] for m in snapshot.metrics] == \
+        [[s[:3] for s in m.samples] for m in expected.metrics]
+
+    # smcli output can't be streamed: refused up front, not on refresh
+    with pytest.raises(ValueError):
+        ZVMCollector("zhcpos2", "user", None, None, None,
+                     requester_class=SSHRequester, stream=True,
+                     session=make_session())
+    with pytest.raises(ValueError):
+        Targets("user", None, None, None, ssh_user="user", stream=True)
@@ -0,0 +1,15 @@
+from zvm_exporter.stats import Histogram, histogram_family
+
+
+def test_histogram():
+    h = Histogram(buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        h.observe(value)
+    assert h.buckets() == [("1.0", 2), ("5.0", 3), ("+Inf", 4)]
+    assert h.sum == 14.5
+
+    family = histogram_family("duration", "Duration", ["host"],
+                              {("zhcpos2",): h})
+    samples = dict((s.name, s.value) for s in family.samples
+                   if "le" not in s.labels)
+    assert samples == {"duration_count": 4, "duration_sum": 14.5}
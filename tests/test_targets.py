@@ -0,0 +1,84 @@
+from prometheus_client.core import CollectorRegistry
+from utils import FakeRequester
+from zvm_exporter.targets import Targets
+from data import page_data
+
+
+def test_targets_shared_pools():
+    t = Targets("user", "password", "example.com", 443, interval=60)
+    a = t.add("zhcp1")
+    b = t.add("zhcp2")
+
+    # Static targets share the connection and worker pools
+    assert a.requester.session is b.requester.session is t.session
+    assert a.executor is b.executor is t.executor
+    # but have their own caches
+    assert a.cache is not b.cache
+    assert a.interval == 60
+
+    # Probed targets are created on demand, without background polling
+    c = t.get("zhcp3")
+    assert t.get("zhcp3") is c
+    assert c.interval is None
+    assert c.requester.session is t.session
+    assert t.get("zhcp1") is a
+
+
+def test_targets_max_probed():
+    t = Targets("user", "password", "example.com", 443, max_probed=2)
+    static = t.add("zhcp1")
+    a = t.get("zhcp2")
+    t.get("zhcp3")
+    assert t.get("zhcp2") is a
+
+    # The least recently probed target is dropped, static ones are kept
+    t.get("zhcp4")
+    assert list(t.probed) == ["zhcp2", "zhcp4"]
+    assert t.get("zhcp1") is static
+    assert t.get("zhcp3") is not None
+    assert list(t.probed) == ["zhcp4", "zhcp3"]
+
+
+def test_targets_collect():
+    t = Targets("user", "password", "example.com", 443)
+    for zhcpnode in ("zhcpos2", "zhcpos3"):
+        collector = t.add(zhcpnode)
+        collector.requester = FakeRequester(
+            {"query_page_info": page_data.replace("zhcpos2", zhcpnode)})
+        collector.fetch(["query_page_info"])
+
+    names = []
+    for metric in t.collect():
+        names.append(metric.name)
+        if metric.name == "zvm_page_used_total":
+            hosts = [s.labels["host"] for s in metric.samples]
+            assert sorted(hosts) == ["zhcpos2", "zhcpos3"]
+    # Families of all targets are merged
+    assert len(names) == len(set(names))
+    assert "zvm_page_used_total" in names
+
+
+def test_targets_describe():
+    t = Targets("user", "password", "example.com", 443)
+    collector = t.add("zhcpos2")
+    collector.requester = FakeRequester({})
+    collector.requester.query_page_info = None  # Not callable
+
+    # Registering does not query xCAT
+    registry = CollectorRegistry(auto_describe=True)
+    registry.register(t)
+
+    collector.requester = FakeRequester({"query_page_info": page_data})
+    names = [metric.name for metric in t.describe()]
+    assert set(metric.name for metric in t.collect()) < set(names)
+    assert "zvm_disk_space_free" in names
+    assert not collector.describe()[0].samples
+
+
+def test_targets_token():
+    t = Targets("user", "password", "example.com", 443, token=True)
+    a = t.add("zhcp1")
+    # All targets share one token
+    assert a.requester.auth is t.get("zhcp2").requester.auth is t.auth
+    assert t.auth.session is t.session
+    assert "password" not in a.requester.url()
@@ -4,3 +4,22 @@ def compare_lists(s, t):
 
 def compare_lists_of_dict(s, t, key=None):
     return sorted(s, key=lambda x: x[key]) == sorted(t, key=lambda x: x[key])
+
+
+class FakeRequester(object):
+    """Requester stand-in answering every query with the same response.
+
+    :param responses: dictionary of query function names and responses.
+    """
+    def __init__(self, responses):
+        self.responses = responses
+        self.coalesced = 0
+        self.latency = {}
+        self.response_bytes = {}
+        self.statuses = {}
+        self.hedged = {}
+        self.hedge_wins = {}
+        self.hedges_denied = {}
+
+    def __getattr__(self, name):
+        return lambda deadline=None: self.responses[name]
@@ -26,15 +26,163 @@ import os
 import sys
 import argparse
 import re
-from time import sleep
 
-from prometheus_client import start_http_server
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import SafeConfigParser as ConfigParser
+
 from prometheus_client.core import REGISTRY
 
-from zvm_exporter.collector import ZVMCollector
+from zvm_exporter.collector import COLLECTORS, QUERIES
+from zvm_exporter.server import start_http_server
+from zvm_exporter.targets import Targets
 from zvm_exporter import __version__
 
 
+def query_ttl(s):
+    """Parse a ``QUERY=SECONDS`` command line argument.
+
+    ``QUERY`` is the name of a query function of the
+    :class:`zvm_exporter.requester.Requester` class, without the ``query_``
+    prefix, e.g. ``disk_def=3600``.
+
+    :returns: a tuple of the query function name and the time in seconds.
+    :rtype: tuple
+
+    """
+    name, _, seconds = s.partition("=")
+    query_fn = "query_" + name.strip()
+    if query_fn not in QUERIES:
+        raise argparse.ArgumentTypeError(
+            "unknown query '{}', choose from {}".format(
+                name, ", ".join(q[len("query_"):] for q in QUERIES)))
+    try:
+        return query_fn, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid time '{}' for query '{}'".format(seconds, name))
+
+
+def collector_budget(s):
+    """Parse a ``COLLECTOR=SECONDS`` command line argument.
+
+    ``COLLECTOR`` is the name of a metric group of
+    :data:`zvm_exporter.collector.COLLECTORS`, e.g. ``disk=20``.
+
+    :returns: a tuple of the metric group name and the time in seconds.
+    :rtype: tuple
+
+    """
+    name, _, seconds = s.partition("=")
+    name = name.strip()
+    if name not in COLLECTORS:
+        raise argparse.ArgumentTypeError(
+            "unknown collector '{}', choose from {}".format(
+                name, ", ".join(COLLECTORS)))
+    try:
+        return name, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid time '{}' for collector '{}'".format(seconds, name))
+
+
+def read_times(path, section, parse):
+    """Read ``NAME = SECONDS`` options from a section of a config file.
+
+    :param path: path to the config file.
+    :type path: string
+    :param section: name of the section.
+    :type section: string
+    :param parse: function parsing a ``NAME=SECONDS`` string into a tuple,
+                  e.g. :func:`query_ttl`.
+    :type parse: function
+
+    :returns: a dictionary of the parsed names and times.
+    :rtype: dict
+
+    """
+    config = ConfigParser()
+    if not config.read(path):
+        raise argparse.ArgumentTypeError(
+            "can't read config file '{}'".format(path))
+    if not config.has_section(section):
+        return {}
+    return dict(parse("{}={}".format(name, value))
+                for name, value in config.items(section))
+
+
+def read_ttls(path):
+    """Read query refresh intervals from the ``[ttl]`` section of a config
+    file.
+
+    :example:
+        ::
+
+            [ttl]
+            disk_def = 3600
+            disk_free = 300
+
+    :param path: path to the config file.
+    :type path: string
+
+    :returns: a dictionary with query function names as keys and times in
+              seconds as values.
+    :rtype: dict
+
+    """
+    return read_times(path, "ttl", query_ttl)
+
+
+def read_budgets(path):
+    """Read the time budgets of the metric groups from the ``[budget]``
+    section of a config file.
+
+    :example:
+        ::
+
+            [budget]
+            disk = 20
+            system = 5
+
+    :param path: path to the config file.
+    :type path: string
+
+    :returns: a dictionary with metric group names as keys and times in
+              seconds as values.
+    :rtype: dict
+
+    """
+    return read_times(path, "budget", collector_budget)
+
+
+def read_targets(path):
+    """Read the static list of zHCP nodes from the ``[targets]`` section of a
+    config file.
+
+    :example:
+        ::
+
+            [targets]
+            nodes = zhcp1, zhcp2
+
+    :param path: path to the config file.
+    :type path: string
+
+    :returns: a list of zHCP node names.
+    :rtype: list
+
+    """
+    config = ConfigParser()
+    if not config.read(path):
+        raise argparse.ArgumentTypeError(
+            "can't read config file '{}'".format(path))
+    if not config.has_option("targets", "nodes"):
+        return []
+    return [node.strip() for node in config.get("targets", "nodes").split(",")
+            if node.strip()]
+
+
 def create_parser():
     parser = argparse.ArgumentParser(
         description="zVM Exporter for Prometheus. Metrics are exported to "
@@ -53,8 +201,18 @@ def create_parser():
 
     parser.add_argument(
         "--zhcpnode",
-        help="Name of the zHCP node.",
-        required=True)
+        help="Name of the zHCP node. Can be given several times. Other "
+             "nodes can be probed on /probe?target=<zhcpnode>.",
+        action="append",
+        default=[])
+
+    parser.add_argument(
+        "--max-probed",
+        help="Maximum number of nodes probed on /probe kept with their "
+             "caches. The least recently probed one is dropped first. "
+             "(defaults to 32)",
+        type=int,
+        default=32)
 
     parser.add_argument(
         "--username",
@@ -80,6 +238,199 @@ def create_parser():
         help="SSL cert file. If not provided, SSL verification is disabled.",
         default=None)
 
+    parser.add_argument(
+        "--pool-size",
+        help="Maximum number of keep-alive connections to the xCAT server. "
+             "(defaults to 10)",
+        type=int,
+        default=10)
+
+    parser.add_argument(
+        "--retries",
+        help="Number of times a failed xCAT request is retried. "
+             "(defaults to 3)",
+        type=int,
+        default=3)
+
+    parser.add_argument(
+        "--timeout",
+        help="Timeout of a single xCAT request in seconds. (defaults to 30)",
+        type=float,
+        default=30)
+
+    parser.add_argument(
+        "--backoff",
+        help="Time in seconds a failing xCAT query is not sent anymore. It "
+             "doubles on every further failure. (defaults to 30)",
+        type=float,
+        default=30)
+
+    parser.add_argument(
+        "--max-backoff",
+        help="Maximum time in seconds a failing xCAT query is not sent. "
+             "(defaults to 600)",
+        type=float,
+        default=600)
+
+    parser.add_argument(
+        "--workers",
+        help="Maximum number of xCAT queries sent at the same time. "
+             "(defaults to 5)",
+        type=int,
+        default=5)
+
+    parser.add_argument(
+        "--scrape-timeout",
+        help="Time in seconds a scrape waits for its xCAT queries. If not "
+             "provided, a scrape waits for all of them.",
+        type=float,
+        default=None)
+
+    parser.add_argument(
+        "--timeout-offset",
+        help="Time in seconds subtracted from the scrape timeout sent by "
+             "Prometheus to get the time scrapes wait for xCAT. "
+             "(defaults to 0.5)",
+        type=float,
+        default=0.5)
+
+    parser.add_argument(
+        "--interval",
+        help="Time in seconds between two background queries to xCAT. "
+             "Scrapes are served from the last collected metrics. If 0, "
+             "xCAT is queried on every scrape. (defaults to 60)",
+        type=float,
+        default=60)
+
+    parser.add_argument(
+        "--batch",
+        help="Query all zHCP nodes with a single xCAT request per query.",
+        action="store_true")
+
+    parser.add_argument(
+        "--combine",
+        help="Send all the queries of a refresh in a single xCAT request.",
+        action="store_true")
+
+    parser.add_argument(
+        "--stream",
+        help="Parse the xCAT responses while they are received.",
+        action="store_true")
+
+    parser.add_argument(
+        "--token",
+        help="Authenticate with an xCAT token, renewed before it expires, "
+             "instead of sending the password with every request.",
+        action="store_true")
+
+    parser.add_argument(
+        "--smapi-port",
+        help="Call the SMAPI servers of the zHCP nodes directly on this "
+             "port instead of going through xCAT. The zHCP node names are "
+             "used as their addresses. (SMAPI usually listens on 44444)",
+        metavar="PORT",
+        type=int,
+        default=None)
+
+    parser.add_argument(
+        "--ssh-user",
+        help="Run smcli on the zHCP nodes over SSH as this user instead of "
+             "going through xCAT. The zHCP node names are used as host "
+             "names.",
+        metavar="USER",
+        default=None)
+
+    parser.add_argument(
+        "--ssh-key",
+        help="Private key file to log in to the zHCP nodes with. If not "
+             "provided, the ssh configuration decides.",
+        metavar="FILE",
+        default=None)
+
+    parser.add_argument(
+        "--async",
+        help="Poll the zHCP nodes on a single asyncio event loop instead of "
+             "a thread per query. Needs Python 3.5 or later and aiohttp.",
+        dest="asynchronous",
+        action="store_true")
+
+    parser.add_argument(
+        "--limit-per-node",
+        help="Maximum number of xCAT requests in flight to a zHCP node with "
+             "--async. (defaults to 2)",
+        type=int,
+        default=2)
+
+    parser.add_argument(
+        "--hedge",
+        help="Send a request again when it has taken longer than this "
+             "percentile of the recent latency of its query, and use the "
+             "first response. (e.g. 95, not hedged by default)",
+        metavar="PERCENTILE",
+        type=float,
+        default=None)
+
+    parser.add_argument(
+        "--hedge-budget",
+        help="Maximum ratio of requests sent again with --hedge. "
+             "(defaults to 0.1)",
+        metavar="RATIO",
+        type=float,
+        default=0.1)
+
+    parser.add_argument(
+        "--cache-size",
+        help="Number of parsed xCAT responses kept per node and metric "
+             "group, so that unchanged responses are not parsed again. "
+             "(defaults to 1)",
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        "--collector",
+        help="Collect the metric group, one of {}. Can be given several "
+             "times. If not provided, all of them are collected.".format(
+                 ", ".join(COLLECTORS)),
+        metavar="GROUP",
+        choices=list(COLLECTORS),
+        action="append",
+        default=[])
+
+    parser.add_argument(
+        "--no-collector",
+        help="Do not collect the metric group. Can be given several times.",
+        metavar="GROUP",
+        choices=list(COLLECTORS),
+        action="append",
+        default=[])
+
+    parser.add_argument(
+        "--budget",
+        help="Time in seconds a refresh waits for the queries of a metric "
+             "group (page, spool, system or disk), e.g. disk=20. Defaults to "
+             "the scrape timeout. Can be given several times. Overrides the "
+             "config file.",
+        metavar="GROUP=SECONDS",
+        type=collector_budget,
+        action="append",
+        default=[])
+
+    parser.add_argument(
+        "--ttl",
+        help="Time in seconds the response of a query is reused before the "
+             "query is sent again, e.g. disk_def=3600. Can be given several "
+             "times. Overrides the config file.",
+        metavar="QUERY=SECONDS",
+        type=query_ttl,
+        action="append",
+        default=[])
+
+    parser.add_argument(
+        "-c", "--config",
+        help="Config file. Query refresh intervals are read from its [ttl] "
+             "section and zHCP nodes from its [targets] section.",
+        default=None)
+
     return parser
 
 
@@ -109,13 +460,81 @@ def main():
 
     logger.info("Program started")
 
-    # start collector
-    REGISTRY.register(ZVMCollector(args.zhcpnode, args.username,
-                                   args.password, xcat_addr, xcat_port,
-                                   args.cert))
-    start_http_server(args.port)
-    while True:
-        sleep(1)
+    ttls = {}
+    budgets = {}
+    zhcpnodes = []
+    if args.config:
+        try:
+            ttls.update(read_ttls(args.config))
+            budgets.update(read_budgets(args.config))
+            zhcpnodes.extend(read_targets(args.config))
+        except argparse.ArgumentTypeError as e:
+            logger.error(str(e))
+            return 1
+    ttls.update(args.ttl)
+    budgets.update(args.budget)
+    collectors = [c for c in args.collector or COLLECTORS
+                  if c not in args.no_collector]
+    if not collectors:
+        logger.error("All collectors are disabled")
+        return 1
+    zhcpnodes.extend(args.zhcpnode)
+    if args.batch and zhcpnodes:
+        # xCAT noderange: every query is sent once for all the nodes
+        zhcpnodes = [",".join(zhcpnodes)]
+
+    if args.asynchronous and not args.interval:
+        logger.error("--async needs an --interval")
+        return 1
+    if args.asynchronous and args.stream:
+        logger.error("--async can't be used with --stream")
+        return 1
+    for option, value in (("--smapi-port", args.smapi_port),
+                          ("--ssh-user", args.ssh_user)):
+        if value and (args.asynchronous or args.stream):
+            logger.error("{} can't be used with --async or --stream".format(
+                option))
+            return 1
+    if args.smapi_port and args.ssh_user:
+        logger.error("--smapi-port can't be used with --ssh-user")
+        return 1
+    hedge_options = {}
+    if args.hedge is not None:
+        if args.asynchronous:
+            logger.error("--hedge can't be used with --async")
+            return 1
+        if not 0 < args.hedge < 100:
+            logger.error("--hedge must be between 0 and 100")
+            return 1
+        hedge_options = {"hedge": args.hedge,
+                         "hedge_budget": args.hedge_budget}
+
+    # start collectors
+    try:
+        targets = Targets(args.username, args.password, xcat_addr, xcat_port,
+                          args.cert, workers=args.workers,
+                          pool_size=args.pool_size, retries=args.retries,
+                          asynchronous=args.asynchronous,
+                          limit_per_node=args.limit_per_node,
+                          smapi_port=args.smapi_port,
+                          ssh_user=args.ssh_user, ssh_key=args.ssh_key,
+                          token=args.token, max_probed=args.max_probed,
+                          scrape_timeout=args.scrape_timeout,
+                          interval=args.interval or None, ttls=ttls,
+                          budgets=budgets, collectors=collectors,
+                          combine=args.combine, stream=args.stream,
+                          cache_size=args.cache_size,
+                          timeout=args.timeout, backoff=args.backoff,
+                          max_backoff=args.max_backoff, **hedge_options)
+    except (ImportError, SyntaxError) as e:
+        logger.error("--async needs Python 3.5 or later and aiohttp: "
+                     "{}".format(e))
+        return 1
+    for zhcpnode in zhcpnodes:
+        targets.add(zhcpnode)
+    REGISTRY.register(targets)
+    start_http_server(args.port, targets, timeout_offset=args.timeout_offset)
+    targets.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,427 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Asynchronous collection, on a single asyncio event loop.
+
+This module needs Python 3.5 or later and aiohttp.
+"""
+
+import asyncio
+import logging
+import ssl
+import threading
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from zvm_exporter.collector import COLLECTORS, QUERIES, remaining
+from zvm_exporter.requester import COMMANDS, Requester
+from zvm_exporter.scrape import time_left
+
+logger = logging.getLogger("zvmExporter")
+
+
+class AsyncSession(object):
+    """Connections to the xCAT server shared by asynchronous requesters.
+
+    Besides the connection pool, the session limits the number of requests
+    in flight to each zHCP node, so that polling many nodes at once does not
+    flood the SMAPI server of any of them.
+
+    The aiohttp session is created on first use, on the event loop it is
+    used from.
+
+    :param pool_size: Maximum number of connections to the xCAT server.
+    :param limit_per_node: Maximum number of requests in flight to a zHCP
+                           node.
+    :type pool_size: int
+    :type limit_per_node: int
+
+    """
+    def __init__(self, pool_size=10, limit_per_node=2):
+        self.pool_size = pool_size
+        self.limit_per_node = limit_per_node
+        self.semaphores = {}
+        self._client = None
+
+    def client(self):
+        """Return the aiohttp session, creating it if needed.
+
+        :rtype: aiohttp.ClientSession
+
+        """
+        if self._client is None or self._client.closed:
+            self._client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size))
+        return self._client
+
+    def semaphore(self, zhcpnode):
+        """Return the semaphore limiting the requests to a zHCP node.
+
+        :param zhcpnode: Name of the zHCP node.
+        :type zhcpnode: string
+
+        :rtype: asyncio.Semaphore
+
+        """
+        if zhcpnode not in self.semaphores:
+            self.semaphores[zhcpnode] = asyncio.Semaphore(self.limit_per_node)
+        return self.semaphores[zhcpnode]
+
+    async def close(self):
+        """Close the connections."""
+        if self._client is not None:
+            await self._client.close()
+
+
+class AsyncRequester(Requester):
+    """Requester sending xCAT queries on an asyncio event loop.
+
+    Its query functions are coroutines with the same names and parameters as
+    those of :class:`Requester`. Concurrent identical queries share a single
+    request, each query has its own circuit breaker and the request
+    statistics are kept in the same attributes. Streamed requests are not
+    supported.
+
+    See :class:`Requester` for the parameters. ``session`` is an
+    :class:`AsyncSession`, shared by the requesters of all zHCP nodes.
+    Requests that could not connect and responses with a status code in
+    :data:`zvm_exporter.requester.RETRY_STATUSES` are retried ``retries``
+    times, after ``backoff_factor`` seconds doubled on every retry.
+
+    """
+    streaming = False
+
+    def __init__(self, zhcpnode, username, password, xcat_addr, xcat_port=443,
+                 cert=None, pool_size=10, retries=3, backoff_factor=0.5,
+                 timeout=30, backoff=30, max_backoff=600, session=None,
+                 auth=None):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        # query -> task of the request in flight
+        self.in_flight = {}
+        self._coalesced = 0
+        Requester.__init__(self, zhcpnode, username, password, xcat_addr,
+                           xcat_port, cert, pool_size, retries,
+                           backoff_factor, timeout, backoff, max_backoff,
+                           session, auth)
+        self.ssl = ssl.create_default_context(cafile=cert) if cert else False
+
+    @staticmethod
+    def create_session(pool_size=10, retries=3, backoff_factor=0.5,
+                       limit_per_node=2):
+        """Create the session shared by asynchronous requesters.
+
+        :param pool_size: Maximum number of connections kept in the pool.
+        :type pool_size: int
+        :param retries: Ignored, the requesters retry themselves.
+        :param backoff_factor: Ignored, see ``retries``.
+        :param limit_per_node: Maximum number of requests in flight to a
+                               zHCP node.
+        :type limit_per_node: int
+
+        :rtype: AsyncSession
+
+        """
+        return AsyncSession(pool_size, limit_per_node)
+
+    @property
+    def coalesced(self):
+        """Number of calls of :func:`send_request` that were served by a
+        request already in flight."""
+        return self._coalesced
+
+    async def send_request(self, query_name, deadline=None):
+        """Send request via xCAT. See :func:`Requester.send_request`.
+
+        :param query_name: xCAT query string.
+        :type query_name: string
+        :param deadline: see :func:`Requester.send_request`.
+        :type deadline: float
+
+        :returns: query response, or an empty string when the request has
+                  failed.
+        :rtype: string
+
+        """
+        if time_left(deadline) == 0:
+            logger.warning("Deadline passed, query not sent: {}".format(
+                query_name))
+            return ""
+        task = self.in_flight.get(query_name)
+        if task is None:
+            task = asyncio.ensure_future(self.guarded_request(query_name,
+                                                              deadline))
+            self.in_flight[query_name] = task
+            task.add_done_callback(
+                lambda _: self.in_flight.pop(query_name, None))
+        else:
+            self._coalesced += 1
+        # A waiter giving up does not cancel the request of the others
+        return await asyncio.shield(task)
+
+    async def guarded_request(self, query_name, deadline=None):
+        """Send request via xCAT through the circuit breaker of the query.
+
+        :returns: query response, or an empty string when the request has
+                  failed or the circuit is open.
+        :rtype: string
+
+        """
+        breaker = self.breaker(query_name)
+        if not breaker.allow():
+            logger.warning("Skipping query, circuit open: {}".format(
+                query_name))
+            return ""
+        try:
+            response = await self.do_request(query_name, deadline)
+        except Exception:
+            logger.exception("Call failed")
+            response = ""
+        if response:
+            breaker.success()
+        else:
+            breaker.failure()
+        return response
+
+    async def do_request(self, query_name, deadline=None):
+        """Send request via xCAT, without coalescing.
+
+        :returns: query response, or an empty string when the request has
+                  failed.
+        :rtype: string
+
+        """
+        response = await self.put(query_name, deadline=deadline)
+        return response if response is not None else ""
+
+    async def put(self, query_name, stream=False, deadline=None):
+        """Send the HTTP request of an xCAT query, retrying it if needed.
+        See :func:`Requester.put`.
+
+        :param query_name: xCAT query string.
+        :type query_name: string
+        :param stream: not supported.
+        :param deadline: see :func:`Requester.send_request`. No retry is
+                         made past it.
+        :type deadline: float
+
+        :returns: the text of the response, or None when the request has
+                  failed.
+        :rtype: string
+
+        """
+        url = self.url()
+        body = self.body(query_name)
+        loop = asyncio.get_event_loop()
+        retries = self.attempts(deadline)
+        delay = 0
+        while delay is not None:
+            if delay:
+                await asyncio.sleep(delay)
+            if time_left(deadline) == 0:
+                break
+            # The token is requested on a thread the first time
+            headers = await loop.run_in_executor(None, self.headers)
+            if headers is None:
+                break
+            timeout = aiohttp.ClientTimeout(
+                total=self.request_timeout(deadline))
+
+            async with self.session.semaphore(self.zhcpnode):
+                logger.info("Sending a request to xCAT...")
+                start = time.time()
+                try:
+                    async with self.session.client().put(
+                            url, data=body, headers=headers, timeout=timeout,
+                            ssl=self.ssl) as response:
+                        content = await response.read()
+                        text = await response.text(errors="replace")
+                except aiohttp.ClientConnectorError:
+                    logger.exception("Failed to connect to xCAT")
+                    self.record(query_name, time.time() - start)
+                    delay = retries.next()
+                    continue
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    # xCAT may have run the command already: not sent again
+                    logger.exception("Failed to send the request")
+                    self.record(query_name, time.time() - start)
+                    break
+
+            self.record(query_name, time.time() - start, response.status,
+                        len(content))
+            logger.info("Response status: {} {}".format(response.status,
+                                                        response.reason))
+            if response.status < 400:
+                return text
+            delay = retries.next(response.status, headers)
+
+        return None
+
+    async def query_page_info(self, deadline=None):
+        """See :func:`Requester.query_page_info`."""
+        return await self.send_request(COMMANDS["query_page_info"], deadline)
+
+    async def query_spool_info(self, deadline=None):
+        """See :func:`Requester.query_spool_info`."""
+        return await self.send_request(COMMANDS["query_spool_info"], deadline)
+
+    async def query_cpu_memory_info(self, deadline=None):
+        """See :func:`Requester.query_cpu_memory_info`."""
+        return await self.send_request(COMMANDS["query_cpu_memory_info"],
+                                       deadline)
+
+    async def query_disk_def(self, deadline=None):
+        """See :func:`Requester.query_disk_def`."""
+        return await self.send_request(COMMANDS["query_disk_def"], deadline)
+
+    async def query_disk_free(self, deadline=None):
+        """See :func:`Requester.query_disk_free`."""
+        return await self.send_request(COMMANDS["query_disk_free"], deadline)
+
+    async def query_combined(self, query_fn, deadline=None):
+        """See :func:`Requester.query_combined`."""
+        response = await self.send_request(self.combined_command(query_fn),
+                                           deadline)
+        return self.split_combined(query_fn, response)
+
+
+async def fetch(collector, query_fn, budgets=None, deadline=None):
+    """Send queries of a collector concurrently. Asynchronous counterpart of
+    :func:`zvm_exporter.collector.ZVMCollector.fetch`.
+
+    :param collector: a collector whose requester is an
+                      :class:`AsyncRequester`.
+    :type collector: zvm_exporter.collector.ZVMCollector
+
+    See :func:`zvm_exporter.collector.ZVMCollector.fetch` for the other
+    parameters and the return value. The queries are waited for
+    ``collector.scrape_timeout`` seconds unless ``budgets`` says otherwise.
+
+    """
+    now = time.time()
+    responses, calls = collector.plan_fetch(query_fn, now)
+    tasks = OrderedDict()
+    for names, call, args in calls:
+        task = asyncio.ensure_future(call(*(args + (deadline,))))
+        for f in names:
+            tasks[f] = task
+    for f, budget in collector.wait_order(
+            tasks, collector.scrape_timeout, budgets, deadline, now):
+        if not tasks[f].done():
+            await asyncio.wait([tasks[f]], timeout=remaining(now, budget))
+
+    responses.update(collector.responses(tasks, now))
+    return responses
+
+
+async def refresh(collector, deadline=None, collectors=None):
+    """Query xCAT and publish a new snapshot of the metrics of a collector.
+    Asynchronous counterpart of
+    :func:`zvm_exporter.collector.ZVMCollector.refresh`.
+
+    The responses are parsed on the worker pool of the collector, so that
+    large responses do not hold up the event loop.
+
+    :param collector: a collector whose requester is an
+                      :class:`AsyncRequester`.
+    :type collector: zvm_exporter.collector.ZVMCollector
+
+    See :func:`zvm_exporter.collector.ZVMCollector.refresh` for the other
+    parameters and the return value.
+
+    """
+    logger.info("Starting metric collection...")
+    loop = asyncio.get_event_loop()
+    timestamp = time.time()
+    collect_fn = collector.collect_functions(collectors)
+    budgets = collector.group_budgets(collect_fn, deadline, timestamp)
+    query_budgets = dict((f, budgets[namespace])
+                         for namespace in collect_fn
+                         for f in COLLECTORS[namespace])
+    responses = await fetch(collector,
+                            [f for f in QUERIES if f in query_budgets],
+                            query_budgets, deadline)
+    collected = {}
+    for namespace, fn in collect_fn.items():
+        try:
+            collected[namespace] = await loop.run_in_executor(
+                collector.executor, fn, responses, timestamp)
+        except Exception:
+            logger.exception("collect_{} failed".format(namespace))
+
+    return collector.publish(collect_fn, collected, timestamp)
+
+
+class AsyncPoller(object):
+    """Poll collectors on a single event loop.
+
+    Each collector is refreshed every ``collector.interval`` seconds, so that
+    the requests of all of them are in flight together without a thread per
+    request.
+
+    :param collectors: collectors whose requesters are
+                       :class:`AsyncRequester` objects.
+    :type collectors: list
+
+    """
+    def __init__(self, collectors):
+        self.collectors = list(collectors)
+
+    async def poll(self, collector):
+        """Refresh a collector every ``interval`` seconds. Never returns.
+
+        :type collector: zvm_exporter.collector.ZVMCollector
+
+        """
+        while True:
+            start = time.time()
+            try:
+                await refresh(collector)
+            except Exception:
+                logger.exception("Failed to refresh metrics")
+            await asyncio.sleep(
+                max(0, collector.interval - (time.time() - start)))
+
+    async def poll_all(self):
+        """Refresh every collector. Never returns."""
+        await asyncio.gather(*[self.poll(collector)
+                               for collector in self.collectors])
+
+    def run(self):
+        """Run the event loop in the current thread. Never returns."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self.poll_all())
+
+    def start(self):
+        """Run the event loop in a daemon thread.
+
+        :returns: the started thread.
+        :rtype: threading.Thread
+
+        """
+        thread = threading.Thread(target=self.run, name="poll-async")
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,187 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+import logging
+import threading
+import time
+
+from requests.exceptions import RequestException
+
+logger = logging.getLogger("zvmExporter")
+
+#: Format of the expiry time of xCAT tokens, in the time zone of the xCAT
+#: server.
+EXPIRE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class TokenAuth(object):
+    """xCAT token shared by the requests to an xCAT server.
+
+    A token is requested from ``/xcatws/tokens`` with the user name and
+    password, and then sent in the ``X-Auth-Token`` header of the requests
+    instead of the credentials. It is reused until it expires. Once it is
+    about to expire, a new one is requested in the background, so that no
+    request waits for it.
+
+    :param username: Username for xCAT request.
+    :param password: Password for xCAT request.
+    :param xcat_addr: xCAT server address.
+    :param xcat_port: Port to connect to the xCAT server.
+    :param session: HTTP session to request the tokens with.
+    :param cert: SSL cert file. If not provided, SSL verification is
+                 disabled.
+    :param margin: Time in seconds before the expiry of the token a new one
+                   is requested.
+    :param lifetime: Time in seconds a token is used if xCAT does not say
+                     when it expires.
+    :param timeout: Timeout of a token request, in seconds.
+    :type username: string
+    :type password: string
+    :type xcat_addr: string
+    :type xcat_port: int
+    :type session: requests.Session
+    :type cert: string
+    :type margin: float
+    :type lifetime: float
+    :type timeout: float
+
+    """
+    def __init__(self, username, password, xcat_addr, xcat_port, session,
+                 cert=None, margin=300, lifetime=3600, timeout=60):
+        self.username = username
+        self.password = password
+        self.xcat_addr = xcat_addr
+        self.xcat_port = xcat_port
+        self.session = session
+        self.cert = cert
+        self.margin = margin
+        self.lifetime = lifetime
+        self.timeout = timeout
+        self.id = None
+        self.expires = 0
+        # Number of tokens received
+        self.tokens = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        # Serializes the token requests
+        self._request_lock = threading.Lock()
+
+    def token(self, now=None):
+        """Return a valid token, requesting one if needed.
+
+        :returns: the token, or None if it could not be requested.
+        :rtype: string
+
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if self.id is not None and now < self.expires:
+                if now >= self.expires - self.margin and \
+                        not self._refreshing:
+                    self._refreshing = True
+                    thread = threading.Thread(target=self.refresh,
+                                              name="token-refresh")
+                    thread.daemon = True
+                    thread.start()
+                return self.id
+        return self.refresh()
+
+    def refresh(self):
+        """Request a new token.
+
+        Concurrent callers wait for the same request.
+
+        :returns: the token, or None if it could not be requested.
+        :rtype: string
+
+        """
+        with self._lock:
+            self._refreshing = True
+        try:
+            with self._request_lock:
+                if self.id is not None and \
+                        time.time() < self.expires - self.margin:
+                    # Refreshed by another caller meanwhile
+                    return self.id
+                token, expires = self.request()
+                if token is not None:
+                    with self._lock:
+                        self.id, self.expires = token, expires
+                        self.tokens += 1
+                return token
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def request(self):
+        """Request a token from xCAT.
+
+        :returns: the token and the time it expires, in seconds since the
+                  epoch, or None and None if the request has failed.
+        :rtype: tuple
+
+        """
+        url = "https://{}:{}/xcatws/tokens".format(self.xcat_addr,
+                                                   self.xcat_port)
+        body = json.dumps({"userName": self.username,
+                           "userPW": self.password})
+        logger.info("Requesting an xCAT token...")
+        start = time.time()
+        try:
+            response = self.session.post(
+                url, data=body, headers={'content-type': 'application/json'},
+                timeout=self.timeout,
+                verify=False if not self.cert else self.cert)
+        except RequestException:
+            logger.exception("Failed to request a token")
+            return None, None
+        if not response.ok:
+            logger.error("Failed to request a token: {} {}".format(
+                response.status_code, response.reason))
+            return None, None
+        try:
+            token = response.json()["token"]
+            token_id = token["id"]
+        except (ValueError, KeyError, TypeError):
+            logger.error("Invalid token response")
+            return None, None
+        try:
+            expires = time.mktime(time.strptime(token.get("expire", ""),
+                                                EXPIRE_FORMAT))
+        except (ValueError, TypeError):
+            expires = start + self.lifetime
+        return token_id, expires
+
+    def invalidate(self, token):
+        """Drop a token xCAT refused, so that the next request gets a new
+        one.
+
+        :param token: the refused token.
+        :type token: string
+
+        """
+        with self._lock:
+            if self.id == token:
+                self.id = None
+                self.expires = 0
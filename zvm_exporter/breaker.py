@@ -0,0 +1,106 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger("zvmExporter")
+
+
+class CircuitBreaker(object):
+    """Circuit breaker with exponential backoff.
+
+    After ``threshold`` consecutive failures the breaker opens and calls are
+    refused for ``backoff`` seconds. Every further failure doubles that time,
+    up to ``max_backoff`` seconds. Once the time has passed, the next call is
+    let through; a success closes the breaker again.
+
+    :param threshold: Number of consecutive failures that opens the breaker.
+    :param backoff: Time in seconds the breaker stays open after it opened.
+    :param max_backoff: Maximum time in seconds the breaker stays open.
+    :type threshold: int
+    :type backoff: float
+    :type max_backoff: float
+
+    """
+    def __init__(self, threshold=2, backoff=30, max_backoff=600):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    def allow(self, now=None):
+        """Check whether a call may be made.
+
+        :returns: False while the breaker is open.
+        :rtype: bool
+
+        """
+        if now is None:
+            now = time.time()
+        return now >= self.open_until
+
+    def success(self):
+        """Record a successful call and close the breaker."""
+        with self._lock:
+            self.failures = 0
+            self.open_until = 0
+
+    def failure(self, now=None):
+        """Record a failed call, opening the breaker if needed."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                delay = min(
+                    self.backoff * 2 ** (self.failures - self.threshold),
+                    self.max_backoff)
+                self.open_until = now + delay
+
+    def call(self, fn, *args, **kwargs):
+        """Call ``fn(*args, **kwargs)`` unless the breaker is open.
+
+        A call that raises an exception or returns an empty result counts as a
+        failure.
+
+        :returns: the return value of the call, or an empty string if the
+                  breaker is open or the call raised.
+
+        """
+        if not self.allow():
+            logger.warning("Circuit open, call skipped for {:.0f}s".format(
+                self.open_until - time.time()))
+            return ""
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            logger.exception("Call failed")
+            result = ""
+        if result:
+            self.success()
+        else:
+            self.failure()
+        return result
@@ -0,0 +1,100 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """Least recently used cache keyed by the digest of xCAT responses.
+
+    Identical responses give the same key, so the work done on a response,
+    e.g. parsing it and building its metrics, is done only once as long as
+    the response does not change.
+
+    The entries are kept per group, e.g. per metric group, so that a group
+    whose responses change on every refresh, like the free disk space,
+    does not evict the entries of the others. With the default size, only
+    the entry of the last response of each group is kept, and a changed
+    response replaces it.
+
+    :param maxsize: Maximum number of entries per group. The least recently
+                    used entry of a group is evicted when it is exceeded.
+    :type maxsize: int
+
+    """
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # group -> OrderedDict of its entries, least recently used first
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        """Build the key of a list of strings.
+
+        :returns: a SHA-1 digest of the strings.
+        :rtype: string
+
+        """
+        digest = hashlib.sha1()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = part.encode("utf-8")
+            # prefix each part with its length so that parts cannot run
+            # into each other
+            digest.update("{}:".format(len(part)).encode("ascii"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def get(self, group, key):
+        """Look up an entry of a group, counting a hit or a miss.
+
+        :returns: the cached value, or None if there is none.
+
+        """
+        with self._lock:
+            entries = self._groups.setdefault(group, OrderedDict())
+            try:
+                value = entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, group, key, value):
+        """Store an entry of a group, evicting the least recently used ones
+        of the group if needed."""
+        with self._lock:
+            entries = self._groups.setdefault(group, OrderedDict())
+            entries.pop(key, None)
+            entries[key] = value
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._groups.values())
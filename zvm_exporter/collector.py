@@ -21,12 +21,131 @@
 # THE SOFTWARE.
 
 import logging
-from prometheus_client.core import GaugeMetricFamily
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import sleep
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from zvm_exporter.cache import ResponseCache
+from zvm_exporter.scrape import (current_collectors, current_deadline,
+                                 shortest, time_left)
 from zvm_exporter.requester import Requester
-from zvm_exporter.parser import Parser
+from zvm_exporter.parser import DiskVolumes, Parser
+from zvm_exporter.stats import Histogram, histogram_family
 
 logger = logging.getLogger("zvmExporter")
 
+# Names of the query functions in the Requester class, in the order their
+# results are merged back into a scrape.
+QUERIES = ("query_page_info", "query_spool_info", "query_cpu_memory_info",
+           "query_disk_def", "query_disk_free")
+
+#: Metric groups, with the query functions their metrics are built from.
+COLLECTORS = OrderedDict([
+    ("page", ("query_page_info",)),
+    ("spool", ("query_spool_info",)),
+    ("system", ("query_cpu_memory_info",)),
+    ("disk", ("query_disk_def", "query_disk_free")),
+])
+
+#: Metrics of each metric group: the labels of its metrics besides
+#: ``host``, and the metrics built from the keys of its parse results, in
+#: the form of the ``metrics_dict`` of :func:`ZVMCollector.build_metrics`.
+METRICS = {
+    "page": ([], {
+        "total_allocated": (
+            "allocated_total",
+            ("The total number of pages allocated for paging use on the "
+             "system")),
+        "total_used": (
+            "used_total",
+            "The total number of pages in use for paging on the system")}),
+    "spool": ([], {
+        "total_allocated": (
+            "allocated_total",
+            ("The total number of pages allocated for spool use on the "
+             "system")),
+        "total_used": (
+            "used_total",
+            "The total number of pages in use for spool on the system")}),
+    "system": ([], {
+        "cpu_count": (
+            "cpu_count",
+            "The total number of CPU cores"),
+        "cpu_average_use": (
+            "cpu_in_use",
+            "The average amount of CPU used (0.0-1.0)"),
+        "memory_in_use": (
+            "memory_in_use",
+            "Memory in use"),
+        "memory_total": (
+            "memory_total",
+            "Total available memory")}),
+    "disk": (["volume"], {
+        "status": (
+            "status",
+            "Usage status of the volume (1: free, 0: used)"),
+        "space_total": (
+            "space_total",
+            "Size of the total disk space defined for the volume"),
+        "space_free": (
+            "space_free",
+            "Size of the free disk space of the volume")}),
+}
+
+#: Time in seconds a query response is reused before the query is sent
+#: again. Queries that are not listed are sent on every refresh.
+DEFAULT_TTLS = {"query_disk_def": 3600}
+
+#: Metrics collected in one go, with the time the collection started.
+Snapshot = namedtuple("Snapshot", ["timestamp", "metrics"])
+
+
+def remaining(start, budget, now=None):
+    """Return the time left from a budget.
+
+    :param start: time in seconds since the epoch the budget started.
+    :param budget: time in seconds, or None for no limit.
+    :param now: current time. If not provided, the current time is used.
+    :type start: float
+    :type budget: float
+    :type now: float
+
+    :returns: the time left in seconds, or None if there is no limit.
+    :rtype: float
+
+    """
+    if budget is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0, start + budget - now)
+
+
+def restamp(metrics, timestamp):
+    """Copy metrics built by :func:`ZVMCollector.build_metrics` with their
+    samples stamped with another time.
+
+    :param metrics: metrics as returned by :func:`ZVMCollector.build_metrics`.
+    :param timestamp: time in seconds since the epoch, or None.
+    :type metrics: dict
+    :type timestamp: float
+
+    :returns: the copied metrics, in the same form.
+    :rtype: dict
+
+    """
+    copied = {}
+    for name in metrics:
+        family = metrics[name]['value']
+        copy = GaugeMetricFamily(family.name, family.documentation,
+                                 labels=[])
+        copy.samples = [sample._replace(timestamp=timestamp)
+                        for sample in family.samples]
+        copied[name] = {'value': copy}
+    return copied
+
 
 class ZVMCollector(object):
     """Prometheus Collector class.
@@ -42,58 +161,770 @@ class ZVMCollector(object):
             args.password, xcat_addr, xcat_port))
 
     :param zhcpnode: Name of the zHCP node. It is used when sending the SMAPI
-                     request.
+                     request. It can also be a comma-separated list of
+                     nodes, which are then queried with a single request
+                     per query.
     :param username: Username for xCAT request.
     :param password: Password for xCAT request.
     :param xcat_addr: xCAT server address.
     :param xcat_port: Port to connect to the xCAT server, e.g. 443 for HTTPS.
+    :param cert: SSL cert file. If not provided, SSL verification is
+                 disabled.
+    :param workers: Maximum number of queries sent to xCAT at the same time.
+                    Ignored if ``executor`` is provided.
+    :param scrape_timeout: Time in seconds a scrape waits for its queries.
+                           Queries that have not returned by then are
+                           treated as failed. ``None`` waits for all of them.
+    :param interval: Time in seconds between two background refreshes, see
+                     :func:`run`. If not provided, xCAT is queried on every
+                     scrape.
+    :param ttls: a dictionary with query function names as keys and the
+                 time in seconds their responses are reused as values. It
+                 is merged into :data:`DEFAULT_TTLS`.
+    :param combine: Send all the queries of a refresh in a single request
+                    instead of one request per query. Ignored if ``stream``
+                    is set.
+    :param stream: Parse the responses while they are received instead of
+                   reading them whole first. The parse results are cached
+                   instead of the responses. A ValueError is raised if the
+                   ``requester_class`` can't stream them, see
+                   :attr:`zvm_exporter.requester.Requester.streaming`.
+    :param cache_size: Number of parsed responses kept per metric group, see
+                       :class:`ResponseCache`. The metrics of a response
+                       identical to a kept one are not built again.
+    :param budgets: a dictionary with metric group names (see
+                    :data:`COLLECTORS`) as keys and the time in seconds a
+                    refresh waits for their queries as values. Groups that
+                    are not listed wait for ``scrape_timeout``. A group
+                    that misses its budget is served from its last good
+                    metrics, or skipped, without holding up the others.
+    :param collectors: names of the metric groups to collect (see
+                       :data:`COLLECTORS`). All of them by default.
+    :param executor: worker pool to send the queries on, e.g. to share it
+                     between the collectors of several zHCP nodes. If not
+                     provided, a new one with ``workers`` threads is created.
+    :param requester_class: class of the requester sending the queries,
+                            :class:`Requester` by default. See
+                            :class:`zvm_exporter.aio.AsyncRequester` for
+                            asynchronous collection.
+    :param requester_options: keyword arguments passed on to
+                              :class:`Requester`, e.g. ``pool_size``,
+                              ``retries``, ``backoff_factor``, ``timeout`` or
+                              ``session``.
 
     """
 
     def __init__(self, zhcpnode, username, password, xcat_addr, xcat_port,
-                 cert=None):
+                 cert=None, workers=5, scrape_timeout=None, interval=None,
+                 ttls=None, combine=False, stream=False, cache_size=1,
+                 budgets=None, collectors=None, executor=None,
+                 requester_class=Requester, **requester_options):
         self.zhcpnode = zhcpnode
-        self.requester = Requester(zhcpnode, username, password, xcat_addr,
-                                   xcat_port, cert)
+        self.hosts = [host.strip() for host in zhcpnode.split(",")]
+        self.scrape_timeout = scrape_timeout
+        self.interval = interval
+        self.budgets = dict(budgets or {})
+        self.collectors = list(collectors or COLLECTORS)
+        unknown = set(self.collectors) - set(COLLECTORS)
+        if unknown:
+            raise ValueError("Unknown collectors: {}".format(
+                ", ".join(sorted(unknown))))
+        self.combine = combine
+        self.stream = stream
+        self.snapshot = None
+        self.ttls = dict(DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        # query function name -> (time it was sent, response)
+        self.cache = {}
+        # query function name -> whether its last request succeeded
+        self.success = {}
+        # query function name -> xCAT error code of its last response
+        self.errorcodes = {}
+        # namespace -> results of its parse function, in stream mode
+        self.parsed = {}
+        # namespace -> Histogram of the time spent parsing its responses
+        self.parse_time = {}
+        # namespace -> whether its last collection succeeded
+        self.collector_success = {}
+        # namespace -> last metrics built from good responses
+        self.last_metrics = {}
+        # time in seconds the last refresh took
+        self.duration = None
+        # digest of the responses -> metrics built from them
+        self.metrics_cache = ResponseCache(cache_size)
+        if stream and not requester_class.streaming:
+            raise ValueError("{} can't stream responses".format(
+                requester_class.__name__))
+        self.executor = executor or ThreadPoolExecutor(max_workers=workers)
+        self.requester = requester_class(zhcpnode, username, password,
+                                         xcat_addr, xcat_port, cert,
+                                         **requester_options)
 
     def collect(self):
         """Main collect function.
 
+        When the collector polls xCAT in the background (see :func:`run`),
+        the last published snapshot is served and no query is sent.
+        Otherwise the snapshot is refreshed first, within the deadline of
+        the scrape if the HTTP handler set one (see
+        :func:`zvm_exporter.scrape.scrape_deadline`).
+
+        When the scrape requests some metric groups only (see
+        :func:`zvm_exporter.scrape.scrape_collectors`), only their metrics
+        are exported, and only their queries are sent.
+
         :note: Prometheus Collector should have collect function.
 
-        :yields: GaugeMetricFamily objects of prometheus_client.core.
+        :yields: GaugeMetricFamily and CounterMetricFamily objects of
+                 prometheus_client.core.
 
         """
 
-        logger.info("Starting metric collection...")
-        page_metrics = self.collect_page()
-        spool_metrics = self.collect_spool()
-        cpu_memory_metrics = self.collect_cpu_memory()
-        disk_metrics = self.collect_disk()
+        requested = current_collectors()
+        collectors = [c for c in self.collectors
+                      if requested is None or c in requested]
+        if self.interval:
+            snapshot = self.snapshot
+        else:
+            snapshot = self.refresh(current_deadline(), collectors)
+
+        if snapshot is None:
+            logger.info("No metrics collected yet")
+            return
 
         logger.info("Yielding metrics...")
-        for m in page_metrics:
-            for v in page_metrics[m].values():
-                yield v
+        for metric in snapshot.metrics:
+            # Metric names are zvm_<group>_<name>
+            if metric.name.split("_")[1] in collectors:
+                yield metric
+
+        for metric in self.collect_exporter(snapshot):
+            yield metric
+
+    def describe(self):
+        """Describe the metrics without querying xCAT.
+
+        prometheus_client calls :func:`collect` to learn the metric names of
+        a collector that has no describe function, so that registering a
+        collector that queries xCAT on scrape would wait for every query.
+        The names are known beforehand:
+        the metrics of the collected groups (see :data:`METRICS`) and the
+        metrics about the exporter itself.
+
+        :note: Prometheus Collector may have describe function.
+
+        :returns: GaugeMetricFamily and CounterMetricFamily objects of
+                  prometheus_client.core, without samples.
+        :rtype: list
+
+        """
+        metrics = []
+        for namespace in self.collectors:
+            labels, metrics_dict = METRICS[namespace]
+            for name, description in sorted(metrics_dict.values()):
+                metrics.append(GaugeMetricFamily(
+                    'zvm_{}_{}'.format(namespace, name), description,
+                    labels=["host"] + labels))
+        return metrics + self.collect_exporter()
+
+    def collect_exporter(self, snapshot=None):
+        """Build the metrics about the exporter itself.
+
+        :param snapshot: the snapshot being served, if any.
+        :type snapshot: Snapshot
+
+        :returns: the collection time of the snapshot, the metrics of
+                  :func:`collect_queries` and :func:`collect_stats` and
+                  counters of the coalesced requests and of the metrics
+                  cache.
+        :rtype: list
+
+        """
+        # Timestamps rather than ages, so that a pre-rendered exposition
+        # does not serve outdated values: the age is time() - timestamp.
+        collected = GaugeMetricFamily(
+            "zvm_exporter_snapshot_timestamp_seconds",
+            "Time the served metrics were collected, in seconds since the "
+            "epoch",
+            labels=["host"])
+        if snapshot is not None:
+            collected.add_metric([self.zhcpnode], snapshot.timestamp)
+
+        coalesced = CounterMetricFamily(
+            "zvm_exporter_requests_coalesced",
+            "Number of xCAT queries served by an identical request already in "
+            "flight",
+            labels=["host"])
+        coalesced.add_metric([self.zhcpnode], self.requester.coalesced)
+
+        hits = CounterMetricFamily(
+            "zvm_exporter_metrics_cache_hits",
+            "Number of xCAT responses whose metrics were already built",
+            labels=["host"])
+        hits.add_metric([self.zhcpnode], self.metrics_cache.hits)
+
+        misses = CounterMetricFamily(
+            "zvm_exporter_metrics_cache_misses",
+            "Number of xCAT responses parsed to build their metrics",
+            labels=["host"])
+        misses.add_metric([self.zhcpnode], self.metrics_cache.misses)
+
+        return ([collected] + self.collect_queries() +
+                [coalesced, hits, misses] + self.collect_stats())
+
+    def ready(self):
+        """Tell whether a snapshot with metrics has been published.
+
+        A refresh in which every group failed publishes an empty snapshot,
+        which does not make the collector ready.
+
+        :rtype: bool
+
+        """
+        return self.snapshot is not None and bool(self.snapshot.metrics)
+
+    def collect_queries(self):
+        """Build the metrics about the state of each query.
+
+        :returns: a ``zvm_exporter_query_up`` gauge telling whether the last
+                  request of each query succeeded, a
+                  ``zvm_exporter_sample_timestamp_seconds`` gauge with the
+                  time the response the metrics are built from was received
+                  and a
+                  ``zvm_exporter_query_errorcode`` gauge with the error code
+                  xCAT returned in that response.
+        :rtype: list
+
+        """
+        up = GaugeMetricFamily(
+            "zvm_exporter_query_up",
+            "Whether the last xCAT request of the query succeeded",
+            labels=["host", "query"])
+        received = GaugeMetricFamily(
+            "zvm_exporter_sample_timestamp_seconds",
+            "Time the response of the query was received, in seconds since "
+            "the epoch",
+            labels=["host", "query"])
+        errorcode = GaugeMetricFamily(
+            "zvm_exporter_query_errorcode",
+            "Error code of the last xCAT response of the query",
+            labels=["host", "query"])
+
+        for f in QUERIES:
+            query = f[len("query_"):]
+            if f in self.success:
+                up.add_metric([self.zhcpnode, query], int(self.success[f]))
+            if f in self.cache:
+                received.add_metric([self.zhcpnode, query],
+                                    self.cache[f][0])
+            if self.errorcodes.get(f) is not None:
+                errorcode.add_metric([self.zhcpnode, query],
+                                     self.errorcodes[f])
+
+        return [up, received, errorcode]
+
+    def collect_stats(self):
+        """Build the metrics about the time and data spent collecting.
+
+        :returns: histograms of the duration of the xCAT requests and of the
+                  parse time of each metric group, counters of the bytes
+                  received, of the HTTP responses per status code and of the
+                  hedged requests, a gauge telling whether each metric group
+                  was collected from fresh responses in time and a gauge with
+                  the duration of the last collection.
+        :rtype: list
+
+        """
+        host = self.zhcpnode
+        requester = self.requester
+        latency = histogram_family(
+            "zvm_exporter_request_duration_seconds",
+            "Time spent sending an xCAT request and receiving its response",
+            ["host", "query"],
+            dict(((host, q), h) for q, h in requester.latency.items()))
+        parse_time = histogram_family(
+            "zvm_exporter_parse_duration_seconds",
+            "Time spent parsing the xCAT responses of a metric group",
+            ["host", "collector"],
+            dict(((host, n), h) for n, h in self.parse_time.items()))
+
+        size = CounterMetricFamily(
+            "zvm_exporter_response_bytes",
+            "Number of bytes received in xCAT responses",
+            labels=["host", "query"])
+        for query, count in sorted(requester.response_bytes.items()):
+            size.add_metric([host, query], count)
+
+        statuses = CounterMetricFamily(
+            "zvm_exporter_responses",
+            "Number of xCAT responses by HTTP status code",
+            labels=["host", "query", "code"])
+        for (query, code), count in sorted(requester.statuses.items()):
+            statuses.add_metric([host, query, code], count)
+
+        hedges = []
+        for name, documentation, counts in (
+                ("zvm_exporter_hedged_requests",
+                 "Number of xCAT requests sent again because they were slow",
+                 requester.hedged),
+                ("zvm_exporter_hedge_wins",
+                 "Number of hedged xCAT requests answered first by the "
+                 "second request", requester.hedge_wins),
+                ("zvm_exporter_hedges_over_budget",
+                 "Number of slow xCAT requests not sent again for lack of "
+                 "budget", requester.hedges_denied)):
+            family = CounterMetricFamily(name, documentation,
+                                         labels=["host", "query"])
+            for query, count in sorted(counts.items()):
+                family.add_metric([host, query], count)
+            hedges.append(family)
+
+        success = GaugeMetricFamily(
+            "zvm_exporter_collector_success",
+            "Whether the last collection of the metric group succeeded",
+            labels=["host", "collector"])
+        for namespace, ok in sorted(self.collector_success.items()):
+            success.add_metric([host, namespace], int(ok))
+
+        duration = GaugeMetricFamily(
+            "zvm_exporter_scrape_duration_seconds",
+            "Time the last collection of the metrics took",
+            labels=["host"])
+        if self.duration is not None:
+            duration.add_metric([host], self.duration)
+
+        return [latency, parse_time, size, statuses] + hedges + \
+            [success, duration]
+
+    def refresh(self, deadline=None, collectors=None):
+        """Query xCAT and publish a new snapshot of the metrics.
+
+        Every sample of the snapshot is stamped with the time the collection
+        started.
+
+        :param deadline: time in seconds since the epoch the snapshot is
+                         needed by. The budgets of the metric groups are cut
+                         to it and it is passed on to the requester.
+        :param collectors: names of the metric groups to collect. If not
+                           provided, the groups of :attr:`collectors` are
+                           collected.
+        :type deadline: float
+        :type collectors: list
+
+        :returns: the published snapshot.
+        :rtype: Snapshot
+
+        """
+        logger.info("Starting metric collection...")
+        timestamp = time.time()
+        collect_fn = self.collect_functions(collectors)
+        budgets = self.group_budgets(collect_fn, deadline, timestamp)
+        collected = {}
+        if self.stream:
+            # Each group streams and parses its own responses
+            futures = dict((namespace, self.executor.submit(
+                fn, None, timestamp, deadline))
+                for namespace, fn in collect_fn.items())
+            for namespace in sorted(collect_fn, key=lambda n: (
+                    budgets[n] is None, budgets[n])):
+                future = futures[namespace]
+                wait([future], remaining(timestamp, budgets[namespace]))
+                if not future.done():
+                    logger.warning("collect_{} did not return in time".format(
+                        namespace))
+                elif future.exception() is not None:
+                    logger.error("collect_{} failed: {}".format(
+                        namespace, future.exception()))
+                else:
+                    collected[namespace] = future.result()
+        else:
+            query_budgets = dict((f, budgets[namespace])
+                                 for namespace in collect_fn
+                                 for f in COLLECTORS[namespace])
+            responses = self.fetch(
+                [f for f in QUERIES if f in query_budgets],
+                self.scrape_timeout, query_budgets, deadline)
+            for namespace, fn in collect_fn.items():
+                try:
+                    collected[namespace] = fn(responses, timestamp)
+                except Exception:
+                    logger.exception("collect_{} failed".format(namespace))
+
+        return self.publish(collect_fn, collected, timestamp)
+
+    def collect_functions(self, collectors=None):
+        """Return the collect functions of metric groups.
+
+        :param collectors: names of the metric groups. If not provided, the
+                           groups of :attr:`collectors` are returned.
+        :type collectors: list
+
+        :returns: a dictionary with the names of the groups as keys and
+                  their collect functions, e.g. :func:`collect_page`, as
+                  values, in the order of :data:`COLLECTORS`.
+        :rtype: OrderedDict
+
+        """
+        collect_fn = OrderedDict([("page", self.collect_page),
+                                  ("spool", self.collect_spool),
+                                  ("system", self.collect_cpu_memory),
+                                  ("disk", self.collect_disk)])
+        collectors = self.collectors if collectors is None else collectors
+        return OrderedDict((namespace, fn)
+                           for namespace, fn in collect_fn.items()
+                           if namespace in collectors)
+
+    def group_budgets(self, namespaces, deadline=None, now=None):
+        """Return the time budgets of metric groups, see ``budgets``.
+
+        :param namespaces: names of the metric groups.
+        :param deadline: time in seconds since the epoch the budgets are
+                         cut to.
+        :param now: time in seconds since the epoch the budgets start.
+        :type namespaces: list
+        :type deadline: float
+        :type now: float
+
+        :returns: a dictionary with the names of the groups as keys and
+                  their budgets in seconds, or None, as values.
+        :rtype: dict
+
+        """
+        return dict((namespace, shortest(
+            self.budgets.get(namespace, self.scrape_timeout),
+            time_left(deadline, now))) for namespace in namespaces)
+
+    def publish(self, collect_fn, collected, timestamp):
+        """Publish a new snapshot of the metrics of a refresh.
+
+        Groups that collected nothing are served from their last good
+        metrics, if any, and marked as failed.
+
+        :param collect_fn: the collect functions of the refresh, as returned
+                           by :func:`collect_functions`.
+        :param collected: a dictionary with the names of the groups as keys
+                          and the metrics they collected as values.
+        :param timestamp: time the refresh started.
+        :type collect_fn: OrderedDict
+        :type collected: dict
+        :type timestamp: float
+
+        :returns: the published snapshot.
+        :rtype: Snapshot
+
+        """
+        metrics = []
+        for namespace in collect_fn:
+            group = collected.get(namespace)
+            if group:
+                self.last_metrics[namespace] = group
+            else:
+                # Whatever the other groups collected is still published
+                self.collector_success[namespace] = False
+                if namespace not in self.last_metrics:
+                    continue
+                logger.warning("Serving last good metrics of {}".format(
+                    namespace))
+                group = restamp(self.last_metrics[namespace], timestamp)
+            for m in group:
+                metrics.extend(group[m].values())
+
+        self.duration = time.time() - timestamp
+        self.snapshot = Snapshot(timestamp, tuple(metrics))
+        return self.snapshot
+
+    def run(self):
+        """Refresh the snapshot every ``interval`` seconds. Never returns."""
+        while True:
+            start = time.time()
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh metrics")
+            sleep(max(0, self.interval - (time.time() - start)))
+
+    def warm_up(self):
+        """Refresh the snapshot once in a background thread.
+
+        When xCAT is queried on scrape, this fills the caches of the
+        queries before the first scrape and makes the collector
+        :func:`ready`. Polling collectors are warmed up by :func:`run`.
 
-        for m in spool_metrics:
-            for v in spool_metrics[m].values():
-                yield v
+        :returns: the started thread.
+        :rtype: threading.Thread
 
-        for m in cpu_memory_metrics:
-            for v in cpu_memory_metrics[m].values():
-                yield v
+        """
+        def refresh():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to warm up metrics")
+
+        thread = threading.Thread(target=refresh,
+                                  name="warm-up-{}".format(self.zhcpnode))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def fetch(self, query_fn, timeout=None, budgets=None, deadline=None):
+        """Send queries to xCAT concurrently.
+
+        The queries are run on the worker pool of the collector, so the time
+        spent is roughly that of the slowest query rather than the sum of all
+        of them. Queries whose last response has not expired yet (see
+        ``ttls``) are not sent again and their cached response is returned.
+
+        :param query_fn: Names of the query functions in the
+                         :class:`Requester` class.
+        :param timeout: Time in seconds to wait for the queries. ``None``
+                        waits until all of them have returned.
+        :param budgets: a dictionary with query function names as keys and
+                        the time in seconds to wait for them as values,
+                        overriding ``timeout``.
+        :param deadline: time in seconds since the epoch after which the
+                         responses are not waited for anymore. It is passed
+                         on to the requester.
+        :type query_fn: list
+        :type timeout: float
+        :type budgets: dict
+        :type deadline: float
+
+        :returns: a dictionary with query function names as keys and the
+                  responses as values. Queries that failed or did not return
+                  in time, and have never succeeded before, have an empty
+                  string as response.
+        :rtype: dict
+
+        """
+        now = time.time()
+        responses, calls = self.plan_fetch(query_fn, now)
+        futures = OrderedDict()
+        for names, call, args in calls:
+            future = self.executor.submit(call, *(args + (deadline,)))
+            for f in names:
+                futures[f] = future
+        for f, budget in self.wait_order(futures, timeout, budgets, deadline,
+                                         now):
+            wait([futures[f]], remaining(now, budget))
+
+        responses.update(self.responses(futures, now))
+        return responses
+
+    def plan_fetch(self, query_fn, now):
+        """Split queries into the ones served from the cache and the calls
+        to make to the requester. See :func:`fetch`.
+
+        :param query_fn: Names of the query functions in the
+                         :class:`Requester` class.
+        :param now: time in seconds since the epoch the queries are sent.
+        :type query_fn: list
+        :type now: float
+
+        :returns: a dictionary with the cached responses, and a list of
+                  ``(query_fn, function, args)`` calls: ``function(*args,
+                  deadline)`` sends the queries of ``query_fn``. A single
+                  call returns the dictionary of :func:`Requester.
+                  query_combined` when the queries are combined.
+        :rtype: tuple
+
+        """
+        responses = {}
+        expired = []
+        for f in query_fn:
+            if self.expired(f, now):
+                expired.append(f)
+            else:
+                responses[f] = self.cache[f][1]
+
+        if self.combine and len(expired) > 1:
+            calls = [(expired, self.requester.query_combined, (expired,))]
+        else:
+            calls = [([f], getattr(self.requester, f), ()) for f in expired]
+        return responses, calls
+
+    @staticmethod
+    def wait_order(query_fn, timeout=None, budgets=None, deadline=None,
+                   now=None):
+        """Return the time to wait for each query, shortest first.
+
+        Waiting for the queries with the shortest budget first makes sure
+        each query is waited for its own budget at most.
+
+        :param query_fn: Names of the query functions sent.
+        :param now: time in seconds since the epoch the queries were sent.
+        :type query_fn: list
+        :type now: float
+
+        See :func:`fetch` for the other parameters.
 
-        for m in disk_metrics:
-            for v in disk_metrics[m].values():
-                yield v
+        :returns: a list of ``(query_fn, budget)`` pairs, where ``budget``
+                  is counted from ``now``, or None for no limit.
+        :rtype: list
+
+        """
+        limit = time_left(deadline, now)
+        budgets = dict((f, shortest((budgets or {}).get(f, timeout), limit))
+                       for f in query_fn)
+        return sorted(budgets.items(),
+                      key=lambda item: (item[1] is None, item[1]))
+
+    def responses(self, futures, now):
+        """Keep the responses of the queries waited for by :func:`fetch`.
+
+        Queries that did not return are cancelled. All the responses go
+        through :func:`store`.
+
+        :param futures: a dictionary with query function names as keys and
+                        the futures of their calls as values. Both
+                        :class:`concurrent.futures.Future` and
+                        :class:`asyncio.Future` are supported.
+        :param now: time in seconds since the epoch the queries were sent.
+        :type futures: dict
+        :type now: float
+
+        :returns: a dictionary with query function names as keys and the
+                  responses as values.
+        :rtype: dict
+
+        """
+        responses = {}
+        for f, future in futures.items():
+            if not future.done() or future.cancelled():
+                future.cancel()
+                logger.warning("{} did not return in time".format(f))
+                response = ""
+            elif future.exception() is not None:
+                logger.error("{} failed: {}".format(f, future.exception()))
+                response = ""
+            else:
+                response = future.result()
+                if isinstance(response, dict):
+                    # Queries combined in a single request
+                    response = response[f]
+            responses[f] = self.store(f, response, now)
+        return responses
+
+    def store(self, query_fn, response, now=None):
+        """Keep the response of a query that was sent.
+
+        :param query_fn: Name of the query function in the
+                         :class:`Requester` class.
+        :param response: the response, or an empty string if the query
+                         failed.
+        :param now: time in seconds since the epoch the query was sent.
+        :type query_fn: string
+        :type response: string
+        :type now: float
+
+        :returns: the response, or the last good response of the query if it
+                  failed.
+        :rtype: string
+
+        """
+        if now is None:
+            now = time.time()
+        self.success[query_fn] = bool(response)
+        if response:
+            self.cache[query_fn] = (now, response)
+            self.errorcodes[query_fn] = Parser.get_errorcode(response)
+        elif query_fn in self.cache:
+            logger.warning("Serving last good response of {}".format(
+                query_fn))
+            response = self.cache[query_fn][1]
+        return response
+
+    def stream_results(self, namespace, parse_fn, query_fn, deadline=None):
+        """Stream the responses of queries into a parse function.
+
+        The responses are parsed while they are received, so the whole
+        responses are never held in memory. As there are no responses to
+        cache, the parse results are cached instead, and served again until
+        one of the queries expires or when the queries fail.
+
+        :param namespace: name of the metric group, e.g. "disk".
+        :param parse_fn: Name of the parse function in the :class:`Parser`
+                         class.
+        :param query_fn: Name(s) of the query function(s) in the
+                         :class:`Requester` class.
+        :param deadline: see :func:`fetch`.
+        :type namespace: string
+        :type parse_fn: string
+        :type query_fn: list
+        :type deadline: float
+
+        :returns: the results of the parse function.
+        :rtype: dict
+
+        """
+        now = time.time()
+        if namespace in self.parsed and \
+                not any(self.expired(f, now) for f in query_fn):
+            return self.parsed[namespace]
+
+        streams = [self.requester.stream(f, deadline) for f in query_fn]
+        for f, stream in zip(query_fn, streams):
+            self.success[f] = stream is not None
+
+        if None in streams:
+            for stream in streams:
+                if stream is not None:
+                    stream.close()
+            if namespace in self.parsed:
+                logger.warning("Serving last good results of {}".format(
+                    namespace))
+            return self.parsed.get(namespace, {})
+
+        # The responses are received while they are parsed, so the time
+        # includes the transfer
+        start = time.time()
+        try:
+            results = getattr(Parser, parse_fn)(*streams)
+        finally:
+            # A stream left unread would hold its pooled connection
+            for stream in streams:
+                stream.close()
+        self.parse_time.setdefault(namespace, Histogram()).observe(
+            time.time() - start)
+        if any(stream.failed for stream in streams):
+            # Partial results are not cached
+            for f, stream in zip(query_fn, streams):
+                self.success[f] = not stream.failed
+            return self.parsed.get(namespace, {})
+        for f, stream in zip(query_fn, streams):
+            self.cache[f] = (now, None)
+            self.errorcodes[f] = stream.errorcode
+        self.parsed[namespace] = results
+        return results
+
+    def expired(self, query_fn, now=None):
+        """Check whether the cached response of a query has expired.
+
+        :param query_fn: Name of the query function in the
+                         :class:`Requester` class.
+        :param now: time in seconds since the epoch to check against. If not
+                    provided, the current time is used.
+        :type query_fn: string
+        :type now: float
+
+        :returns: True if the query has to be sent again.
+        :rtype: bool
+
+        """
+        if query_fn not in self.cache:
+            return True
+        if now is None:
+            now = time.time()
+        timestamp, _ = self.cache[query_fn]
+        return now - timestamp >= self.ttls.get(query_fn, 0)
 
     def build_metrics(self, metrics_dict, namespace, labels, parse_fn,
-                      *query_fn):
+                      query_fn, responses=None, timestamp=None,
+                      deadline=None):
         """Helper function for building metrics.
 
         Send a query, parse the response and return the metrics in an
-        appropriate form.
+        appropriate form. The response may hold the output of several zHCP
+        nodes (see ``zhcpnode``); samples are added for each of them.
 
         :param metrics_dict: a dictionary. It should have the following format:
             ::
@@ -115,13 +946,25 @@ class ZVMCollector(object):
         :param labels: a list of strings that represent the keys for which the
                        value will be added as the metric labels.
         :param parse_fn: Name of the parse function in the :class:`Parser`
-                         class.
+                         class. It should return the results of all zHCP
+                         nodes, like :func:`Parser.parse_page_hosts`.
         :param query_fn: Name(s) of the query function(s) in the
                          :class:`Requester` class.
+        :param responses: responses of the query functions, as returned by
+                          :func:`fetch`. If not provided, the queries are
+                          sent, and streamed if ``stream`` is set.
+        :param timestamp: time in seconds since the epoch the samples are
+                          stamped with. If not provided, the samples have no
+                          timestamp.
+        :param deadline: time in seconds since the epoch the queries sent
+                         are given to return, see :func:`fetch`.
         :type metrics_dict: dict
         :type labels: list
         :type parse_fn: string
-        :type query_fn: string
+        :type query_fn: list
+        :type responses: dict
+        :type timestamp: float
+        :type deadline: float
 
         :returns: a dictionary with metric names as keys and a dictionary of
                   ``{'value': GaugeMetricFamily}``
@@ -129,18 +972,60 @@ class ZVMCollector(object):
 
         """
 
-        metrics = {}
-
         if not labels:
             labels = []
 
-        query_result = [getattr(self.requester, f)() for f in query_fn]
-        result = getattr(Parser, parse_fn)(self.zhcpnode, *query_result)
+        if responses is None and self.stream:
+            results = self.stream_results(namespace, parse_fn, query_fn,
+                                          deadline)
+            metrics = self.make_metrics(metrics_dict, namespace, labels,
+                                        results, timestamp)
+        else:
+            if responses is None:
+                responses = self.fetch(query_fn, self.scrape_timeout,
+                                       deadline=deadline)
+            query_result = [responses.get(f, "") for f in query_fn]
 
-        logger.debug("collect_{}: {}".format(namespace, str(result)))
+            # Reuse the metrics of identical responses
+            key = ResponseCache.key(namespace, *query_result)
+            cached = self.metrics_cache.get(namespace, key)
+            if cached is not None:
+                metrics = restamp(cached, timestamp)
+            else:
+                start = time.time()
+                results = getattr(Parser, parse_fn)(*query_result)
+                self.parse_time.setdefault(namespace, Histogram()).observe(
+                    time.time() - start)
+                metrics = self.make_metrics(metrics_dict, namespace, labels,
+                                            results, timestamp)
+                self.metrics_cache.put(namespace, key, metrics)
+
+        self.collector_success[namespace] = bool(metrics) and all(
+            self.success.get(f, True) for f in query_fn)
+        return metrics
 
-        # If the result is empty
-        if result == [{}]:
+    def make_metrics(self, metrics_dict, namespace, labels, results,
+                     timestamp=None):
+        """Build the metrics of parse results.
+
+        See :func:`build_metrics` for the parameters.
+
+        :param results: the results of the parse function.
+        :type results: dict
+
+        :returns: a dictionary with metric names as keys and a dictionary of
+                  ``{'value': GaugeMetricFamily}``
+        :rtype: dict
+
+        """
+        metrics = {}
+
+        logger.debug("collect_{}: {}".format(namespace, str(results)))
+
+        # Ignore the nodes with an empty result
+        results = [(host, results[host]) for host in self.hosts
+                   if results.get(host, [{}]) != [{}]]
+        if not results:
             return []
 
         for name, description in metrics_dict.values():
@@ -150,17 +1035,40 @@ class ZVMCollector(object):
                     metric_name, description, labels=["host"] + labels),
                 }
 
-        for item in result:
-            for key in metrics_dict:
-                name, _ = metrics_dict[key]
-                metrics[name]['value'].add_metric(
-                    [self.zhcpnode] + [item[x] for x in labels], item[key])
+        for host, result in results:
+            if isinstance(result, DiskVolumes):
+                # Emit the samples column by column, without building a
+                # dictionary per volume
+                label_values = [[host] + list(values) for values in
+                                zip(*[result.column(x) for x in labels])]
+                for key in metrics_dict:
+                    name, _ = metrics_dict[key]
+                    add_metric = metrics[name]['value'].add_metric
+                    for values, value in zip(label_values,
+                                             result.column(key)):
+                        add_metric(values, value, timestamp=timestamp)
+                continue
+            for item in result:
+                for key in metrics_dict:
+                    name, _ = metrics_dict[key]
+                    metrics[name]['value'].add_metric(
+                        [host] + [item[x] for x in labels], item[key],
+                        timestamp=timestamp)
 
         return metrics
 
-    def collect_page(self):
+    def collect_page(self, responses=None, timestamp=None, deadline=None):
         """Calls :func:`build_metrics` function for page metrics.
 
+        :param responses: responses of the query functions, as returned by
+                          :func:`fetch`. If not provided, the queries are
+                          sent.
+        :param timestamp: time the samples are stamped with.
+        :param deadline: see :func:`fetch`.
+        :type responses: dict
+        :type timestamp: float
+        :type deadline: float
+
         :returns: a dictionary with metric names as keys and a dictionary of
                   ``{'value': GaugeMetricFamily}`` as corresponding values
 
@@ -168,22 +1076,24 @@ class ZVMCollector(object):
         :rtype: dict
 
         """
+        labels, metrics_dict = METRICS["page"]
 
-        metrics_dict = {
-            "total_allocated": (
-                "allocated_total",
-                ("The total number of pages allocated for paging use on the "
-                 "system")),
-            "total_used": (
-                "used_total",
-                "The total number of pages in use for paging on the system")}
-
-        return self.build_metrics(metrics_dict, "page", [], "parse_page",
-                                  "query_page_info")
+        return self.build_metrics(metrics_dict, "page", labels,
+                                  "parse_page_hosts", ["query_page_info"],
+                                  responses, timestamp, deadline)
 
-    def collect_spool(self):
+    def collect_spool(self, responses=None, timestamp=None, deadline=None):
         """Calls :func:`build_metrics` function for spool metrics.
 
+        :param responses: responses of the query functions, as returned by
+                          :func:`fetch`. If not provided, the queries are
+                          sent.
+        :param timestamp: time the samples are stamped with.
+        :param deadline: see :func:`fetch`.
+        :type responses: dict
+        :type timestamp: float
+        :type deadline: float
+
         :returns: a dictionary with metric names as keys and a dictionary of
                   ``{'value': GaugeMetricFamily}`` as corresponding values
 
@@ -192,21 +1102,25 @@ class ZVMCollector(object):
         :rtype: dict
 
         """
-        metrics_dict = {
-            "total_allocated": (
-                "allocated_total",
-                ("The total number of pages allocated for spool use on the "
-                 "system")),
-            "total_used": (
-                "used_total",
-                "The total number of pages in use for spool on the system")}
-
-        return self.build_metrics(metrics_dict, "spool", [], "parse_page",
-                                  "query_spool_info")
-
-    def collect_cpu_memory(self):
+        labels, metrics_dict = METRICS["spool"]
+
+        return self.build_metrics(metrics_dict, "spool", labels,
+                                  "parse_page_hosts", ["query_spool_info"],
+                                  responses, timestamp, deadline)
+
+    def collect_cpu_memory(self, responses=None, timestamp=None,
+                           deadline=None):
         """Calls :func:`build_metrics` function for cpu, memory metrics.
 
+        :param responses: responses of the query functions, as returned by
+                          :func:`fetch`. If not provided, the queries are
+                          sent.
+        :param timestamp: time the samples are stamped with.
+        :param deadline: see :func:`fetch`.
+        :type responses: dict
+        :type timestamp: float
+        :type deadline: float
+
         :returns: a dictionary with metric names as keys and a dictionary of
                   ``{'value': GaugeMetricFamily}`` as corresponding values
 
@@ -215,26 +1129,25 @@ class ZVMCollector(object):
         :rtype: dict
 
         """
-        metrics_dict = {
-            "cpu_count": (
-                "cpu_count",
-                "The total number of CPU cores"),
-            "cpu_average_use": (
-                "cpu_in_use",
-                "The average amount of CPU used (0.0-1.0)"),
-            "memory_in_use": (
-                "memory_in_use",
-                "Memory in use"),
-            "memory_total": (
-                "memory_total",
-                "Total available memory")}
-
-        return self.build_metrics(metrics_dict, "system", [],
-                                  "parse_cpu_memory", "query_cpu_memory_info")
-
-    def collect_disk(self):
+        labels, metrics_dict = METRICS["system"]
+
+        return self.build_metrics(metrics_dict, "system", labels,
+                                  "parse_cpu_memory_hosts",
+                                  ["query_cpu_memory_info"], responses,
+                                  timestamp, deadline)
+
+    def collect_disk(self, responses=None, timestamp=None, deadline=None):
         """Calls :func:`build_metrics` function for disk metrics.
 
+        :param responses: responses of the query functions, as returned by
+                          :func:`fetch`. If not provided, the queries are
+                          sent.
+        :param timestamp: time the samples are stamped with.
+        :param deadline: see :func:`fetch`.
+        :type responses: dict
+        :type timestamp: float
+        :type deadline: float
+
         :returns: a dictionary with metric names as keys and a dictionary of
                   ``{'value': GaugeMetricFamily}`` as corresponding values
 
@@ -243,17 +1156,9 @@ class ZVMCollector(object):
         :rtype: dict
 
         """
-        metrics_dict = {
-            "status": (
-                "status",
-                "Usage status of the volume (1: free, 0: used)"),
-            "space_total": (
-                "space_total",
-                "Size of the total disk space defined for the volume"),
-            "space_free": (
-                "space_free",
-                "Size of the free disk space of the volume")}
-
-        return self.build_metrics(metrics_dict, "disk", ["volume"],
-                                  "parse_disk", "query_disk_def",
-                                  "query_disk_free")
+        labels, metrics_dict = METRICS["disk"]
+
+        return self.build_metrics(metrics_dict, "disk", labels,
+                                  "parse_disk_hosts",
+                                  ["query_disk_def", "query_disk_free"],
+                                  responses, timestamp, deadline)
@@ -0,0 +1,128 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import gzip
+import hashlib
+import io
+import threading
+import time
+from collections import namedtuple
+from email.utils import formatdate
+
+#: Exposition bytes rendered once, in plain and gzip-compressed form.
+Rendered = namedtuple("Rendered", ["content_type", "plain", "gzip", "etag",
+                                   "last_modified"])
+
+
+def compress(data):
+    """Compress bytes with gzip.
+
+    :rtype: bytes
+
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def render(registry, encoder, content_type, timestamp=None):
+    """Render the exposition of a registry.
+
+    :param registry: registry to render.
+    :type registry: prometheus_client.core.CollectorRegistry
+    :param encoder: encoder function, as returned by
+                    prometheus_client.exposition.choose_encoder.
+    :param content_type: content type of the encoder.
+    :type content_type: string
+    :param timestamp: time the data was last modified. If not provided, the
+                      current time is used.
+    :type timestamp: float
+
+    :rtype: Rendered
+
+    """
+    plain = encoder(registry)
+    etag = '"{}"'.format(hashlib.sha1(plain).hexdigest())
+    if timestamp is None:
+        timestamp = time.time()
+    return Rendered(content_type, plain, compress(plain), etag,
+                    formatdate(timestamp, usegmt=True))
+
+
+class ExpositionCache(object):
+    """Exposition of a registry rendered once per change of its data.
+
+    The exposition is rendered again only when ``version`` returns another
+    value, so serving it costs the same whatever the number of series, and
+    several scrapers do not render it several times. Metrics that change
+    between two versions, e.g. the ones about the process, are exported as
+    they were when the exposition was rendered.
+
+    :param registry: registry to render.
+    :type registry: prometheus_client.core.CollectorRegistry
+    :param version: function returning a value that changes whenever the
+                    data of the registry does, e.g.
+                    :func:`zvm_exporter.targets.Targets.version`. When it
+                    returns None, the exposition is rendered every time.
+    :type version: function
+
+    """
+    def __init__(self, registry, version):
+        self.registry = registry
+        self.version = version
+        self.renders = 0
+        self._version = None
+        # (content type, variant) -> Rendered
+        self._rendered = {}
+        self._lock = threading.Lock()
+
+    def get(self, encoder, content_type, variant=None):
+        """Return the exposition in a format, rendering it if needed.
+
+        :param encoder: encoder function of the format.
+        :param content_type: content type of the format.
+        :type content_type: string
+        :param variant: any hashable value telling apart expositions of the
+                        same format whose content differ, e.g. because the
+                        scrape requested some metric groups only.
+
+        :rtype: Rendered
+
+        """
+        version = self.version()
+        timestamps = [t for t in version or () if t is not None]
+        timestamp = max(timestamps) if timestamps else None
+        if version is None:
+            self.renders += 1
+            return render(self.registry, encoder, content_type, timestamp)
+
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._rendered = {}
+            key = (content_type, variant)
+            if key not in self._rendered:
+                self.renders += 1
+                self._rendered[key] = render(
+                    self.registry, encoder, content_type, timestamp)
+            return self._rendered[key]
@@ -0,0 +1,144 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Local SMAPI server answering with canned outputs, for testing.
+
+:example:
+    ::
+
+        server = FakeSMAPIServer({
+            "System_Performance_Information_Query": (
+                0, 0, encode_strings(["CPU_COUNT=32"]))}).start()
+        session = SMAPISession(server.server_address[1])
+        ...
+        server.stop()
+"""
+
+import itertools
+import threading
+import time
+
+try:
+    from socketserver import StreamRequestHandler, ThreadingTCPServer
+except ImportError:
+    from SocketServer import StreamRequestHandler, ThreadingTCPServer
+
+from zvm_exporter.smapi import (SMAPIError, pack_int, unpack_int,
+                                unpack_string)
+
+#: Return and reason codes of a failed authentication.
+AUTHENTICATION_FAILED = (100, 8)
+
+#: Return and reason codes of an unknown function.
+UNKNOWN_FUNCTION = (900, 0)
+
+
+class FakeSMAPIHandler(StreamRequestHandler):
+    """Handler answering the requests of a connection until it is closed."""
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return
+            length, _ = unpack_int(header)
+            data = self.rfile.read(length)
+            try:
+                function, offset = unpack_string(data)
+                userid, offset = unpack_string(data, offset)
+                password, offset = unpack_string(data, offset)
+                _, offset = unpack_string(data, offset)
+            except SMAPIError:
+                return
+            with server.lock:
+                server.calls.append((function, data[offset:]))
+                request_id = next(server.request_ids)
+            if server.delay:
+                time.sleep(server.delay)
+
+            if server.credentials not in (None, (userid, password)):
+                return_code, reason_code = AUTHENTICATION_FAILED
+                output = b""
+            else:
+                return_code, reason_code, output = server.outputs.get(
+                    function, UNKNOWN_FUNCTION + (b"",))
+            body = b"".join([pack_int(request_id), pack_int(return_code),
+                             pack_int(reason_code), output])
+            self.wfile.write(pack_int(request_id))
+            self.wfile.write(pack_int(len(body)) + body)
+            self.wfile.flush()
+
+
+class FakeSMAPIServer(ThreadingTCPServer):
+    """Local SMAPI server.
+
+    :param outputs: a dictionary with SMAPI function names as keys and
+                    tuples of the return code, the reason code and the
+                    encoded output (see :mod:`zvm_exporter.smapi`) as
+                    values.
+    :param credentials: user and password the requests must authenticate
+                        with, or None to accept any.
+    :param addr: address to listen on.
+    :param port: port to listen on, 0 for any free port.
+    :param delay: time in seconds the server waits before answering.
+    :type outputs: dict
+    :type credentials: tuple
+    :type addr: string
+    :type port: int
+    :type delay: float
+
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, outputs, credentials=None, addr="127.0.0.1", port=0,
+                 delay=0):
+        ThreadingTCPServer.__init__(self, (addr, port), FakeSMAPIHandler)
+        self.outputs = outputs
+        self.credentials = credentials
+        self.delay = delay
+        # (function, encoded parameters) of every request received
+        self.calls = []
+        self.connections = 0
+        self.request_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Serve in a daemon thread.
+
+        :returns: the server.
+        :rtype: FakeSMAPIServer
+
+        """
+        thread = threading.Thread(target=self.serve_forever,
+                                  name="fake-smapi")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,113 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import math
+import threading
+from collections import deque
+
+
+class HedgePolicy(object):
+    """Decide when a slow request is hedged, i.e. sent again.
+
+    The latency of the last ``window`` responses of each query is kept. A
+    request still waiting after the ``percentile`` of those latencies is
+    hedged, so that a request stuck behind a slow dsh session does not hold
+    up the query.
+
+    Hedges are capped by a budget: every request earns ``budget`` hedges,
+    up to ``burst``, and every hedge spends one. With the default budget, at
+    most one request in ten is hedged in the long run.
+
+    :param percentile: percentile of the latency after which a request is
+                       hedged, e.g. 95.
+    :param budget: number of hedges earned per request.
+    :param window: number of latencies kept per query.
+    :param min_samples: number of latencies needed before a query is hedged.
+    :param burst: maximum number of hedges saved up.
+    :type percentile: float
+    :type budget: float
+    :type window: int
+    :type min_samples: int
+    :type burst: float
+
+    """
+    def __init__(self, percentile=95, budget=0.1, window=100, min_samples=20,
+                 burst=5):
+        self.percentile = percentile
+        self.budget = budget
+        self.window = window
+        self.min_samples = min_samples
+        self.burst = burst
+        # query -> latencies of its last responses
+        self.latencies = {}
+        self.tokens = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, query, duration):
+        """Record the latency of a response.
+
+        :param query: name of the query, e.g. "page_info".
+        :param duration: time in seconds the request took.
+        :type query: string
+        :type duration: float
+
+        """
+        with self._lock:
+            if query not in self.latencies:
+                self.latencies[query] = deque(maxlen=self.window)
+            self.latencies[query].append(duration)
+
+    def delay(self, query):
+        """Return the time after which a request of a query is hedged.
+
+        :param query: name of the query.
+        :type query: string
+
+        :returns: the ``percentile`` of the latencies of the query, or None
+                  while there are fewer than ``min_samples`` of them.
+        :rtype: float
+
+        """
+        with self._lock:
+            latencies = sorted(self.latencies.get(query, ()))
+        if not latencies or len(latencies) < self.min_samples:
+            return None
+        rank = int(math.ceil(self.percentile / 100.0 * len(latencies)))
+        return latencies[min(max(rank, 1), len(latencies)) - 1]
+
+    def earn(self):
+        """Add the hedges earned by a request to the budget."""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.budget)
+
+    def spend(self):
+        """Take a hedge from the budget.
+
+        :returns: False if the budget is spent.
+        :rtype: bool
+
+        """
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
@@ -20,11 +20,243 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import codecs
+import json
 import logging
 import re
+from array import array
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+try:
+    intern
+except NameError:
+    from sys import intern
 
 logger = logging.getLogger("zvmExporter")
 
+#: Type code of the arrays of 64-bit integers ('q' is missing in Python 2).
+try:
+    INT64 = array('q').typecode
+except ValueError:
+    INT64 = 'l'
+
+
+class StreamDecoder(object):
+    """Incremental decoder of xCAT response messages.
+
+    Text is fed in chunks of any size with :func:`feed`, which yields the
+    lines of output as soon as they are complete. Only the line being read
+    is kept in memory, so the memory used does not depend on the size of
+    the response.
+
+    The lines and error code are read from the structure described in
+    :func:`Parser.decode`. Any other value is skipped.
+
+    """
+    _text_rx = re.compile(r'[^"\\]+')
+    _skip_rx = re.compile(r'[^"{}\[\],:]+')
+    _escapes = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f',
+                'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self):
+        self.errorcode = None
+        self._buffer = ""
+        # one [type, key, expect_key] entry per open object or array
+        self._stack = []
+        # pieces of the string being read, None outside strings
+        self._string = None
+        self._kind = None
+        self._started = False
+
+    def feed(self, text):
+        """Decode a chunk of the response.
+
+        :param text: next chunk of the response message.
+        :type text: string
+
+        :yields: the lines of output completed by the chunk.
+
+        """
+        buf = self._buffer + text
+        pos = 0
+        end = len(buf)
+
+        while pos < end:
+            if self._string is not None:
+                text_match = self._text_rx.match(buf, pos)
+                if text_match:
+                    self._append(text_match.group())
+                    pos = text_match.end()
+                    continue
+                if buf[pos] == '"':
+                    pos += 1
+                    for line in self._end_string():
+                        yield line
+                    continue
+                # escape sequence, possibly cut at the end of the chunk
+                if pos + 1 >= end:
+                    break
+                escape = buf[pos + 1]
+                if escape == 'u':
+                    if pos + 6 > end:
+                        break
+                    code = int(buf[pos + 2:pos + 6], 16)
+                    if 0xD800 <= code < 0xDC00 and \
+                            '\\u'.startswith(buf[pos + 6:pos + 8]):
+                        # high surrogate, joined with the low one following
+                        if pos + 12 > end:
+                            break
+                        char = self._surrogate_pair(code,
+                                                    buf[pos + 8:pos + 12])
+                        if char is not None:
+                            pos += 12
+                            self._append(char)
+                            continue
+                    char = unichr(code)
+                    pos += 6
+                elif escape == 'n' and self._kind == 'line':
+                    yield ''.join(self._string)
+                    self._string = []
+                    self._started = True
+                    pos += 2
+                    continue
+                else:
+                    char = self._escapes.get(escape, escape)
+                    pos += 2
+                self._append(char)
+                continue
+
+            char = buf[pos]
+            if char == '"':
+                self._start_string()
+            elif char == '{':
+                self._stack.append(['{', None, True])
+            elif char == '[':
+                key = self._stack[-1][1] if self._stack else None
+                self._stack.append(['[', key, False])
+            elif char in '}]':
+                if self._stack:
+                    self._stack.pop()
+            elif char == ':':
+                if self._stack:
+                    self._stack[-1][2] = False
+            elif char == ',':
+                if self._stack and self._stack[-1][0] == '{':
+                    self._stack[-1][2] = True
+            else:
+                # whitespace and literals such as null
+                pos = self._skip_rx.match(buf, pos).end()
+                continue
+            pos += 1
+
+        self._buffer = buf[pos:]
+
+    @staticmethod
+    def _surrogate_pair(high, low):
+        """Return the character of a surrogate pair, or None if ``low``, the
+        hexadecimal digits of the escape following ``high``, is not a low
+        surrogate."""
+        try:
+            low = int(low, 16)
+        except ValueError:
+            return None
+        if not 0xDC00 <= low < 0xE000:
+            return None
+        try:
+            return unichr(0x10000 + ((high - 0xD800) << 10) + low - 0xDC00)
+        except ValueError:
+            # narrow Python 2 builds keep the pair
+            return unichr(high) + unichr(low)
+
+    def _start_string(self):
+        top = self._stack[-1] if self._stack else None
+        if top is not None and top[0] == '{' and top[2]:
+            self._kind = 'key'
+        elif top is not None and top[0] == '[' and top[1] == 'data' and \
+                len(self._stack) == 4:
+            self._kind = 'line'
+        elif top is not None and top[0] == '[' and \
+                top[1] in ('errorcode', 'error'):
+            self._kind = top[1]
+        else:
+            self._kind = None
+        self._string = []
+        self._started = False
+
+    def _append(self, text):
+        self._started = True
+        # strings that are not needed are skipped, whatever their size
+        if self._kind is not None:
+            self._string.append(text)
+
+    def _end_string(self):
+        value = ''.join(self._string)
+        kind, started = self._kind, self._started
+        self._string = None
+        if kind == 'key':
+            self._stack[-1][1] = value
+        elif kind == 'line' and started:
+            yield value
+        elif kind == 'errorcode' and value and self.errorcode is None:
+            self.errorcode = value
+        elif kind == 'error':
+            logger.warning("xCAT error: {}".format(value))
+
+
+class DiskVolumes(object):
+    """Disk results of a zHCP node, stored by column.
+
+    Each volume is a row of parallel columns: its interned name in
+    ``volume`` and its values in the ``status``, ``space_total`` and
+    ``space_free`` arrays. This takes far less memory than a dictionary per
+    volume when there are many of them.
+
+    Iterating yields a dictionary per volume, as returned by
+    :func:`Parser.parse_disk`.
+
+    """
+    __slots__ = ("volume", "status", "space_total", "space_free")
+
+    def __init__(self):
+        self.volume = []
+        self.status = array('b')
+        self.space_total = array(INT64)
+        self.space_free = array(INT64)
+
+    def add(self, volume, space_total):
+        """Add a volume with no free space.
+
+        :returns: the row of the volume.
+        :rtype: int
+
+        """
+        self.volume.append(intern(str(volume)))
+        self.status.append(0)
+        self.space_total.append(space_total)
+        self.space_free.append(0)
+        return len(self.volume) - 1
+
+    def column(self, key):
+        """Return the column of a key of the volume dictionaries."""
+        return getattr(self, key)
+
+    def __len__(self):
+        return len(self.volume)
+
+    def __iter__(self):
+        for row in zip(self.volume, self.status, self.space_total,
+                       self.space_free):
+            yield dict(zip(self.__slots__, row))
+
 
 class Parser:
     """Parser class.
@@ -52,6 +284,122 @@ class Parser:
         """
         return re.sub('\s', '_', s).lower()
 
+    @staticmethod
+    def decode(response):
+        """Decode an xCAT response message.
+
+        The message has the following structure, where the inner ``data``
+        list may hold several chunks of output:
+        ::
+
+            {"data":[{"data":["...","..."]},{"errorcode":["..."]}]}
+
+        :param response: xCAT response message.
+        :type response: string
+
+        :returns: a tuple of the list of output chunks and the error code,
+                  which is None if the response has none.
+        :rtype: tuple
+
+        """
+        try:
+            message = json.loads(response)
+        except ValueError:
+            if response:
+                logger.error("Failed to decode response")
+            return [], None
+
+        chunks = []
+        errorcode = None
+        items = message.get("data", []) if isinstance(message, dict) else []
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            for chunk in item.get("data") or []:
+                if isinstance(chunk, basestring) and chunk:
+                    chunks.append(chunk)
+            for error in item.get("error") or []:
+                logger.warning("xCAT error: {}".format(error))
+            for code in item.get("errorcode") or []:
+                if errorcode is None and code:
+                    errorcode = code
+        return chunks, errorcode
+
+    @staticmethod
+    def get_errorcode(response):
+        """Return the error code of an xCAT response message.
+
+        :param response: xCAT response message.
+        :type response: string
+
+        :returns: the error code, or None if the response has none or it is
+                  not a number.
+        :rtype: int
+
+        """
+        _, errorcode = Parser.decode(response)
+        try:
+            return int(errorcode)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def iter_lines(response):
+        """Iterate over the lines of output of an xCAT response message.
+
+        The lines are yielded one by one, without building a list of all
+        of them.
+
+        :param response: xCAT response message, or an iterable of lines that
+                         have already been decoded, e.g. by
+                         :func:`iter_stream`.
+        :type response: string
+
+        :yields: strings.
+
+        """
+        if not isinstance(response, basestring):
+            for line in response:
+                yield line
+            return
+
+        chunks, _ = Parser.decode(response)
+        for chunk in chunks:
+            start = 0
+            end = chunk.find('\n')
+            while end >= 0:
+                yield chunk[start:end]
+                start = end + 1
+                end = chunk.find('\n', start)
+            yield chunk[start:]
+
+    @staticmethod
+    def iter_stream(chunks, decoder=None):
+        """Iterate over the lines of output of an xCAT response message
+        received in chunks.
+
+        The lines are yielded as soon as they are complete, so parsing can
+        start before the whole response has been received.
+
+        :param chunks: chunks of the response message, as bytes in UTF-8 or
+                       as strings.
+        :type chunks: iterable
+        :param decoder: decoder to use, e.g. to read its error code once the
+                        lines have been consumed. A new one by default.
+        :type decoder: StreamDecoder
+
+        :yields: strings.
+
+        """
+        if decoder is None:
+            decoder = StreamDecoder()
+        utf8 = codecs.getincrementaldecoder('utf-8')('replace')
+        for chunk in chunks:
+            if isinstance(chunk, bytes):
+                chunk = utf8.decode(chunk)
+            for line in decoder.feed(chunk):
+                yield line
+
     @staticmethod
     def get_data(response):
         """Helper function to split the data chunk from xCAT response message.
@@ -63,21 +411,90 @@ class Parser:
         :rtype: list
 
         """
-        # result_rx is regex that matches the following:
-        # {"data":[{"data":["..."]},{"errorcode":["..."]}]} or
-        # {"data":[{"data":["...","..."]},{"errorcode":["..."]}]}
-        result_rx = re.compile(
-            r'{"data":\[{"data":\["(?P<data>.+)"(.*)\]},'
-            r'{"errorcode":\["(?P<errorcode>.+)"\]}\]}',
-            re.DOTALL)
-
-        # use regex to get data out
-        result_match = result_rx.match(response)
-        if not result_match:
-            logger.error("Failed to match response to regex")
-            return []
-        data = result_match.group('data')
-        return data.split('\\n')
+        return list(Parser.iter_lines(response))
+
+    @staticmethod
+    def split_host(line):
+        """Split a line of dsh output into the node name and the output.
+
+        :example:
+            ::
+
+                >>> split_host('zhcpos2: OS2P01 3390-64K 65520 OS2P01')
+                ('zhcpos2', 'OS2P01 3390-64K 65520 OS2P01')
+
+        :param line: a line of xCAT response data.
+        :type line: string
+
+        :returns: a tuple of the stripped node name and the rest of the line,
+                  or ``(None, None)`` if the line has no node prefix.
+        :rtype: tuple
+
+        """
+        host, sep, rest = line.partition(':')
+        if not host or not rest.startswith(' '):
+            return None, None
+        return host.strip(), rest[1:]
+
+    @staticmethod
+    def split_commands(response, marker, count):
+        """Split the response of a combined request into the responses of
+        its commands.
+
+        Every command of the request is expected to be followed by a line
+        holding only ``marker``. Lines are assigned to commands per zHCP
+        node, so the output of several nodes may be interleaved.
+
+        :param response: xCAT response message.
+        :type response: string
+        :param marker: line separating the output of two commands.
+        :type marker: string
+        :param count: number of commands in the request.
+        :type count: int
+
+        :returns: a list of ``count`` xCAT response messages, in the order
+                  of the commands. A command without output has an empty
+                  string as response.
+        :rtype: list
+
+        """
+        chunks = [[] for _ in range(count)]
+        index = {}
+        last_host = None
+
+        for line in Parser.iter_lines(response):
+            host, rest = Parser.split_host(line)
+            if host is not None:
+                last_host = host
+                if rest.strip() == marker:
+                    index[host] = index.get(host, 0) + 1
+                    continue
+            if index.get(last_host, 0) < count:
+                chunks[index.get(last_host, 0)].append(line)
+
+        _, errorcode = Parser.decode(response)
+        return [Parser.encode(chunk, errorcode) if chunk else ""
+                for chunk in chunks]
+
+    @staticmethod
+    def encode(lines, errorcode=None):
+        """Encode lines of output as an xCAT response message, see
+        :func:`decode`.
+
+        It lets output that was not received from xCAT, e.g. from a SMAPI
+        server, be parsed by the parse functions.
+
+        :param lines: lines of output, e.g. ``["zhcp1: CPU_COUNT=32"]``.
+        :type lines: list
+        :param errorcode: error code of the response.
+        :type errorcode: string
+
+        :returns: xCAT response message.
+        :rtype: string
+
+        """
+        return json.dumps({"data": [{"data": ["\n".join(lines)]},
+                                    {"errorcode": [errorcode or "0"]}]})
 
     @staticmethod
     def parse_page(zhcpnode, response):
@@ -96,13 +513,30 @@ class Parser:
                     "available_percentage": ... }]
         :rtype: list
 
+        """
+        return Parser.parse_page_hosts(response).get(zhcpnode, [{}])
+
+    @staticmethod
+    def parse_page_hosts(response):
+        """Parse function for page query response of one or more zHCP nodes.
+
+        The lines of all nodes are demultiplexed in a single pass.
+
+        :param response: response returned from xCAT query.
+        :type response: string
+
+        :returns: a dictionary with the zHCP node names as keys and lists as
+                  returned by :func:`parse_page` as values.
+        :rtype: dict
+
         """
         host_rx = re.compile(
             r'(?P<host>[^:]+): (?P<field>[^:]+): (?P<value>.+)', re.DOTALL)
         k_rx = re.compile(r'(\d+)K')
-        output = {}
+        outputs = {}
+        done = set()
 
-        for line in Parser.get_data(response):
+        for line in Parser.iter_lines(response):
             # match regex
             line_match = host_rx.match(line)
             if not line_match:
@@ -110,11 +544,13 @@ class Parser:
             host = line_match.group('host').strip()
             field = line_match.group('field').strip()
             value = line_match.group('value').strip()
-            if host != zhcpnode:
+            if host in done:
                 continue
+            output = outputs.setdefault(host, {})
             # ignore data after Volume ID
-            elif field == 'Volume ID':
-                break
+            if field == 'Volume ID':
+                done.add(host)
+                continue
             # get rid of K
             k_match = k_rx.match(value)
             if k_match:
@@ -127,7 +563,7 @@ class Parser:
             # add data to output dictionary
             output[Parser.make_snake_case(field)] = value
 
-        return [output]
+        return dict((host, [output]) for host, output in outputs.items())
 
     @staticmethod
     def parse_cpu_memory(zhcpnode, response):
@@ -148,13 +584,31 @@ class Parser:
                 }]
         :rtype: list
 
+        """
+        return Parser.parse_cpu_memory_hosts(response).get(zhcpnode, [{}])
+
+    @staticmethod
+    def parse_cpu_memory_hosts(response):
+        """Parse function for CPU and memory query response of one or more
+        zHCP nodes.
+
+        The lines of all nodes are demultiplexed in a single pass.
+
+        :param response: response returned from xCAT query.
+        :type response: string
+
+        :returns: a dictionary with the zHCP node names as keys and lists as
+                  returned by :func:`parse_cpu_memory` as values.
+        :rtype: dict
+
         """
         host_rx = re.compile(
             r'(?P<host>[^:]+): (?P<field>[^:]+)=(?P<value>.+)', re.DOTALL)
         percent_rx = re.compile(r'([0-9.]+)%')
-        output = {}
+        outputs = {}
+        done = set()
 
-        for line in Parser.get_data(response):
+        for line in Parser.iter_lines(response):
             # match regex
             line_match = host_rx.match(line)
             if not line_match:
@@ -162,11 +616,13 @@ class Parser:
             host = line_match.group('host').strip()
             field = line_match.group('field').strip()
             value = line_match.group('value').strip()
-            if host != zhcpnode:
+            if host in done:
                 continue
+            output = outputs.setdefault(host, {})
             # ignore data after MONITOR_RATE
-            elif field == 'MONITOR_RATE':
-                break
+            if field == 'MONITOR_RATE':
+                done.add(host)
+                continue
             # take care of %
             percent_match = percent_rx.match(value)
             if percent_match:
@@ -178,7 +634,7 @@ class Parser:
             # add data to output dictionary
             output[Parser.make_snake_case(field)] = value
 
-        return [output]
+        return dict((host, [output]) for host, output in outputs.items())
 
     @staticmethod
     def parse_disk(zhcpnode, def_response, free_response):
@@ -211,68 +667,90 @@ class Parser:
         :rtype: list
 
         """
-        def_rx = re.compile(
-            r'(?P<host>[^:]+): (?P<volid>\S+) (?P<devtype>\S+) (?P<size>\S+) '
-            r'(?P<region_names>.+)')
-        free_rx = re.compile(
-            r'(?P<host>[^:]+): (?P<volid>.+) (?P<devtype>.+) (?P<start>.+) '
-            r'(?P<size>.+) (?P<group_name>.+) (?P<region_name>.+)')
-        output = {}
+        return list(Parser.parse_disk_hosts(def_response,
+                                            free_response).get(zhcpnode, []))
 
-        def_response_data = Parser.get_data(def_response)
-        free_response_data = Parser.get_data(free_response)
+    @staticmethod
+    def parse_disk_hosts(def_response, free_response):
+        """Parse function for disk query response of one or more zHCP nodes.
 
-        # Because we need to have both data to get the final output
-        if def_response_data == [] or free_response_data == []:
-            return []
+        The lines of all nodes are demultiplexed in a single pass over each
+        response.
 
-        for line in def_response_data:
-            # match regex
-            line_match = def_rx.match(line)
-            if not line_match:
-                continue
+        :param def_response: response returned from xCAT query
+                             :func:`requester.query_disk_def`.
+        :type def_response: string
+        :param free_response: response returned from xCAT query
+                              :func:`requester.query_disk_free`.
+        :type free_response: string
 
-            volume_dict = {}
-            host = line_match.group('host').strip()
-            volid = line_match.group('volid').strip()
-            size = line_match.group('size').strip()
-            if host != zhcpnode:
-                continue
-            try:
-                size = int(size)
-            except ValueError:
-                pass
-            # add data to output dictionary
-            volume_dict['volume'] = volid
-            volume_dict['space_total'] = size
-            volume_dict['status'] = 0
-            volume_dict['space_free'] = 0
-            output[volid] = volume_dict
+        :returns: a dictionary with the zHCP node names as keys and
+                  :class:`DiskVolumes` as values. Volumes whose sizes are not
+                  numbers are skipped.
+        :rtype: dict
 
-        for line in free_response_data:
-            # match regex
-            line_match = free_rx.match(line)
-            if not line_match:
+        """
+        outputs = {}
+        # zHCP node -> volume ID -> row in the output of the node
+        rows = {}
+
+        def_lines = 0
+        free_lines = 0
+
+        # The lines are split on single spaces rather than matched with a
+        # regex, so the cost is linear in the length of the line.
+        for line in Parser.iter_lines(def_response):
+            def_lines += 1
+            # host: volid devtype size region_names
+            host, rest = Parser.split_host(line)
+            if host is None:
                 continue
-
-            host = line_match.group('host').strip()
-            volid = line_match.group('volid').strip()
-            start = line_match.group('start').strip()
-            size = line_match.group('size').strip()
-            if host != zhcpnode:
+            fields = rest.split(' ', 3)
+            if len(fields) < 4 or not all(fields):
                 continue
+
+            volid = fields[0].strip()
             try:
-                start = int(start)
-                size = int(size)
+                size = int(fields[2])
             except ValueError:
-                pass
-            # add data to output dictionary
+                continue
+            if host not in outputs:
+                outputs[host] = DiskVolumes()
+                rows[host] = {}
+            output = outputs[host]
+            row = rows[host].get(volid)
+            if row is None:
+                rows[host][volid] = output.add(volid, size)
+            else:
+                # A volume defined again replaces the previous definition
+                output.status[row] = 0
+                output.space_total[row] = size
+                output.space_free[row] = 0
+
+        for line in Parser.iter_lines(free_response):
+            free_lines += 1
+            # host: volid devtype start size group_name region_name
+            # Only the volume ID may contain spaces, so split from the right.
+            host, rest = Parser.split_host(line)
+            if host is None:
+                continue
+            fields = rest.rsplit(' ', 5)
+            if len(fields) < 6 or not all(fields):
+                continue
+
             try:
-                volume_dict = output[volid]
-            except KeyError:
+                row = rows[host][fields[0].strip()]
+                start = int(fields[2])
+                size = int(fields[3])
+            except (KeyError, ValueError):
                 continue
+            output = outputs[host]
             if start == 1:
-                volume_dict['status'] = 1
-            volume_dict['space_free'] += size
+                output.status[row] = 1
+            output.space_free[row] += size
+
+        # Because we need to have both data to get the final output
+        if not def_lines or not free_lines:
+            return {}
 
-        return output.values()
+        return outputs
@@ -21,11 +21,56 @@
 # THE SOFTWARE.
 
 import logging
-from requests import put
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from requests import Session
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException, SSLError
+from requests.packages.urllib3.util.retry import Retry
+from zvm_exporter.breaker import CircuitBreaker
+from zvm_exporter.hedge import HedgePolicy
+from zvm_exporter.scrape import time_left
+from zvm_exporter.parser import Parser, StreamDecoder
+from zvm_exporter.singleflight import SingleFlight
+from zvm_exporter.stats import Histogram
 
 logger = logging.getLogger("zvmExporter")
 
+#: SMAPI commands sent by the query functions of the :class:`Requester`.
+COMMANDS = {
+    "query_page_info": "System_Page_Utilization_Query -T ZHCP",
+    "query_spool_info": "System_Spool_Utilization_Query -T ZHCP",
+    "query_cpu_memory_info": ("System_Performance_Information_Query -T ZHCP "
+                              "-k DETAILED_CPU=SHOW=NO"),
+    # -q 1: query_type DEFINITION - Query volume definition for the
+    #       specified image device
+    # -e 1: entry_type VOLUME - Query specified volume
+    "query_disk_def": "Image_Volume_Space_Query_DM -T ZHCP -q 1 -e 1",
+    # -q 2: query_type FREE - Query amount of free space available on the
+    #       specified image
+    # -e 1: entry_type VOLUME - Query specified volume
+    "query_disk_free": "Image_Volume_Space_Query_DM -T ZHCP -q 2 -e 1",
+}
+
+#: Name of the queries of the SMAPI commands, as used in metric labels.
+QUERY_NAMES = dict((command, f[len("query_"):])
+                   for f, command in COMMANDS.items())
+
+#: HTTP status codes of the responses to a request with a refused token.
+AUTH_STATUSES = (401, 403)
+
+#: HTTP status codes of the responses whose request is retried.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+#: Line echoed after each command of a combined request.
+END_OF_COMMAND = "ZVM_EXPORTER_END_OF_COMMAND"
+
 
 class Requester:
     """Requester class that makes xCAT API requests.
@@ -37,27 +82,295 @@ class Requester:
     :param xcat_addr: xCAT server address.
     :param xcat_port: Port to connect to the xCAT server, e.g. 443 for HTTPS
                       (default).
+    :param cert: SSL cert file. If not provided, SSL verification is
+                 disabled.
+    :param pool_size: Maximum number of keep-alive connections kept open to
+                      the xCAT server.
+    :param retries: Number of times a request is retried when the connection
+                    to xCAT fails or the response status code is in
+                    :data:`RETRY_STATUSES`. See :func:`create_session` and
+                    :func:`put`.
+    :param backoff_factor: Backoff factor applied between retries, in
+                           seconds.
+    :param timeout: Timeout of a single request, in seconds. It is kept
+                    shorter than the polling interval, so that a hung query
+                    does not hold up the next collections.
+    :param backoff: Time in seconds a query is not sent anymore once it has
+                    failed repeatedly. It doubles on every further failure.
+    :param max_backoff: Maximum time in seconds a failing query is not sent.
+    :param session: HTTP session to send the requests with, e.g. to share
+                    one connection pool between the requesters of several
+                    zHCP nodes. If not provided, a new one is created with
+                    :func:`create_session`.
+    :param auth: xCAT token to authenticate with instead of sending the
+                 username and password in the URL of every request, e.g. to
+                 share one token between the requesters of several zHCP
+                 nodes.
+    :param hedge: percentile of the recent latency of a query, e.g. 95,
+                  after which a request of the query is hedged: a duplicate
+                  is sent and the first response is used. See
+                  :class:`zvm_exporter.hedge.HedgePolicy`. If not provided,
+                  requests are not hedged.
+    :param hedge_budget: number of hedges earned by each request, i.e. the
+                         maximum ratio of hedged requests.
     :type zhcpnode: string
     :type username: string
     :type password: string
     :type xcat_addr: string
     :type xcat_port: int
+    :type cert: string
+    :type pool_size: int
+    :type retries: int
+    :type backoff_factor: float
+    :type timeout: float
+    :type backoff: float
+    :type max_backoff: float
+    :type session: requests.Session
+    :type auth: zvm_exporter.auth.TokenAuth
+    :type hedge: float
+    :type hedge_budget: float
 
     """
+    #: Whether the responses can be streamed, see :func:`stream_request`.
+    streaming = True
+
     def __init__(self, zhcpnode, username, password, xcat_addr, xcat_port=443,
-                 cert=None):
+                 cert=None, pool_size=10, retries=3, backoff_factor=0.5,
+                 timeout=30, backoff=30, max_backoff=600, session=None,
+                 auth=None, hedge=None, hedge_budget=0.1):
         self.xcat_addr = xcat_addr
         self.xcat_port = xcat_port
         self.zhcpnode = zhcpnode
         self.username = username
         self.password = password
         self.cert = cert
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.auth = auth
+        self.session = session or self.create_session(pool_size, retries,
+                                                      backoff_factor)
+        self.flight = SingleFlight()
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breakers = {}
+        # query -> Histogram of the request durations
+        self.latency = {}
+        # query -> number of bytes received
+        self.response_bytes = {}
+        # (query, HTTP status code) -> number of responses
+        self.statuses = {}
+        self.hedging = HedgePolicy(hedge, hedge_budget) \
+            if hedge is not None else None
+        # query -> number of hedged requests
+        self.hedged = {}
+        # query -> number of hedged requests answered first by the hedge
+        self.hedge_wins = {}
+        # query -> number of requests not hedged for lack of budget
+        self.hedges_denied = {}
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def create_session(pool_size=10, retries=3, backoff_factor=0.5):
+        """Create the HTTP session shared by all queries of a requester.
+
+        The session keeps the connections to the xCAT server alive, so the
+        TCP connect and the TLS handshake are only paid once per pooled
+        connection instead of once per query.
+
+        :param pool_size: Maximum number of connections kept in the pool.
+        :type pool_size: int
+        :param retries: Number of times a request is retried when the
+                        connection fails. Requests that failed while waiting
+                        for the response are not retried: xCAT may already
+                        have run the command on the zHCP node. The responses
+                        with a status code in :data:`RETRY_STATUSES` are
+                        retried by :func:`put`, within the deadline of the
+                        request.
+        :type retries: int
+        :param backoff_factor: Backoff factor applied between retries.
+        :type backoff_factor: float
 
-    def send_request(self, query_name):
+        :returns: a session with a pooling adapter mounted for HTTPS.
+        :rtype: requests.Session
+
+        """
+        retry = Retry(total=retries, connect=retries, read=0, status=0,
+                      backoff_factor=backoff_factor)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry, pool_block=True)
+        session = Session()
+        session.mount("https://", adapter)
+        return session
+
+    def send_request(self, query_name, deadline=None):
         """Send request via xCAT.
 
+        Concurrent calls with the same query share a single request: only the
+        first caller sends it, the others wait for it and receive the same
+        response. The number of coalesced calls is kept in
+        :attr:`coalesced`.
+
+        Each query has its own :class:`CircuitBreaker`: once a query has
+        failed repeatedly it is not sent anymore for a while and an empty
+        string is returned right away.
+
         :param query_name: xCAT query string.
         :type query_name: string
+        :param deadline: time in seconds since the epoch the response is
+                         needed by, e.g. because the scrape times out then.
+                         The request is given at most the time left, and is
+                         not sent at all once the deadline has passed.
+        :type deadline: float
+
+        :returns: query response, or an empty string when the request has
+                  failed.
+        :rtype: string
+
+        """
+        if time_left(deadline) == 0:
+            logger.warning("Deadline passed, query not sent: {}".format(
+                query_name))
+            return ""
+        breaker = self.breaker(query_name)
+        return self.flight.do(query_name, breaker.call, self.hedge_request,
+                              query_name, deadline)
+
+    def hedge_request(self, query_name, deadline=None):
+        """Send request via xCAT, hedging it if it is slow.
+
+        Once the request has taken longer than the delay of
+        :attr:`hedging`, a duplicate is sent if the budget allows it, and
+        the first successful response of the two is returned.
+
+        :param query_name: xCAT query string.
+        :type query_name: string
+        :param deadline: see :func:`send_request`.
+        :type deadline: float
+
+        :returns: query response, or an empty string when the requests have
+                  failed.
+        :rtype: string
+
+        """
+        if self.hedging is None:
+            return self.do_request(query_name, deadline)
+        query = self.query_label(query_name)
+        self.hedging.earn()
+        delay = self.hedging.delay(query)
+        left = time_left(deadline)
+        if delay is None or (left is not None and delay >= left):
+            # Too early to tell, or no time left to hedge
+            return self.do_request(query_name, deadline)
+
+        results = queue.Queue()
+
+        def send(hedge):
+            try:
+                response = self.do_request(query_name, deadline)
+            except Exception:
+                logger.exception("Failed to send the request")
+                response = ""
+            results.put((hedge, response))
+
+        self.start(send, False)
+        try:
+            return results.get(timeout=delay)[1]
+        except queue.Empty:
+            pass
+        if not self.hedging.spend():
+            self.count(self.hedges_denied, query)
+            return results.get()[1]
+
+        logger.info("Hedging query after {:.2f}s: {}".format(
+            delay, query_name))
+        self.count(self.hedged, query)
+        self.start(send, True)
+        hedge, response = results.get()
+        if not response:
+            # The other request may still succeed
+            hedge, response = results.get()
+        if response and hedge:
+            self.count(self.hedge_wins, query)
+        return response
+
+    @staticmethod
+    def start(fn, *args):
+        """Run a function in a daemon thread."""
+        thread = threading.Thread(target=fn, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def count(self, counts, query):
+        """Increment the count of a query in one of the hedge counters."""
+        with self._stats_lock:
+            counts[query] = counts.get(query, 0) + 1
+
+    def breaker(self, query_name):
+        """Return the circuit breaker of a query, creating it if needed.
+
+        :param query_name: xCAT query string.
+        :type query_name: string
+
+        :rtype: CircuitBreaker
+
+        """
+        return self.breakers.setdefault(
+            query_name, CircuitBreaker(backoff=self.backoff,
+                                       max_backoff=self.max_backoff))
+
+    @staticmethod
+    def query_label(query_name):
+        """Return the name of a query as used in metric labels.
+
+        :param query_name: xCAT query string.
+        :type query_name: string
+
+        :returns: e.g. "page_info", or "combined" for a combined request.
+        :rtype: string
+
+        """
+        return QUERY_NAMES.get(query_name, "combined")
+
+    def record(self, query_name, duration=None, status=None, size=None):
+        """Record statistics about a request.
+
+        :param query_name: xCAT query string.
+        :param duration: time in seconds the request took.
+        :param status: HTTP status code of the response.
+        :param size: number of bytes of the response.
+        :type query_name: string
+        :type duration: float
+        :type status: int
+        :type size: int
+
+        """
+        query = self.query_label(query_name)
+        with self._stats_lock:
+            if duration is not None:
+                self.latency.setdefault(query, Histogram()).observe(duration)
+                if status is not None and self.hedging is not None:
+                    self.hedging.observe(query, duration)
+            if status is not None:
+                key = (query, str(status))
+                self.statuses[key] = self.statuses.get(key, 0) + 1
+            if size is not None:
+                self.response_bytes[query] = \
+                    self.response_bytes.get(query, 0) + size
+
+    @property
+    def coalesced(self):
+        """Number of calls of :func:`send_request` that were served by a
+        request already in flight."""
+        return self.flight.coalesced
+
+    def do_request(self, query_name, deadline=None):
+        """Send request via xCAT, without coalescing.
+
+        :param query_name: xCAT query string.
+        :type query_name: string
+        :param deadline: see :func:`send_request`.
+        :type deadline: float
 
         :returns: query response, or an empty string when the request has
                   failed.
@@ -67,77 +380,406 @@ class Requester:
                Application Programming of the z/VM manual.
 
         """
-        result = ""
+        response = self.put(query_name, deadline=deadline)
+        return response.text if response is not None else ""
+
+    def stream_request(self, query_name, deadline=None):
+        """Send request via xCAT, without reading the response.
+
+        The response is read while it is consumed, so it can be parsed as it
+        arrives. Streamed requests are not coalesced, as the response can be
+        consumed only once, but they go through the circuit breaker.
+
+        :param query_name: xCAT query string.
+        :type query_name: string
+        :param deadline: see :func:`send_request`.
+        :type deadline: float
+
+        :returns: lines of the response, or None when the request has failed.
+        :rtype: ResponseStream
+
+        """
+        if time_left(deadline) == 0:
+            logger.warning("Deadline passed, query not sent: {}".format(
+                query_name))
+            return None
+        breaker = self.breaker(query_name)
+        if not breaker.allow():
+            logger.warning("Skipping query, circuit open: {}".format(
+                query_name))
+            return None
+
+        response = self.put(query_name, stream=True, deadline=deadline)
+        if response is None:
+            breaker.failure()
+            return None
+
+        breaker.success()
+        return ResponseStream(
+            response, on_close=lambda size: self.record(query_name,
+                                                        size=size))
+
+    def put(self, query_name, stream=False, deadline=None):
+        """Send the HTTP request of an xCAT query.
+
+        Failed requests are sent again as decided by :class:`Attempts`.
+
+        :param query_name: xCAT query string.
+        :type query_name: string
+        :param stream: whether to defer reading the response body.
+        :type stream: bool
+        :param deadline: see :func:`send_request`. No retry is made past it.
+        :type deadline: float
+
+        :returns: the response, or None when the request has failed.
+        :rtype: requests.Response
 
+        """
         # Prepare HTTP request
-        url = ("https://{}:{}/xcatws/nodes/{}/dsh?userName={}&password={}&"
-               "format=json").format(self.xcat_addr, self.xcat_port,
-                                     self.zhcpnode, self.username,
-                                     self.password)
-        body = '["command=smcli {}"]'.format(query_name)
-        headers = {'content-type': 'text/plain', 'content-length': len(body)}
-
-        logger.info("Sending a request to xCAT...")
-        try:
-            response = put(url, data=body, headers=headers, timeout=300,
-                           verify=False if not self.cert else self.cert)
-        except SSLError:
-            logger.exception("Problem with SSL verification")
-        except RequestException:
-            logger.exception("Failed to send the request")
-        else:
-            result = response.text
+        url = self.url()
+        body = self.body(query_name)
+        retries = self.attempts(deadline)
+
+        while True:
+            headers = self.headers()
+            if headers is None:
+                return None
+            timeout = self.request_timeout(deadline)
+
+            logger.info("Sending a request to xCAT...")
+            start = time.time()
+            try:
+                response = self.session.put(
+                    url, data=body, headers=headers, timeout=timeout,
+                    verify=False if not self.cert else self.cert,
+                    stream=stream)
+            except SSLError:
+                logger.exception("Problem with SSL verification")
+                self.record(query_name, time.time() - start)
+                return None
+            except RequestException:
+                logger.exception("Failed to send the request")
+                self.record(query_name, time.time() - start)
+                return None
+
+            # A streamed response is counted once it has been read
+            self.record(query_name, time.time() - start,
+                        response.status_code,
+                        None if stream else len(response.content))
             logger.info("Response status: {} {}".format(response.status_code,
                                                         response.reason))
+            if response.ok:
+                return response
+            response.close()
+            delay = retries.next(response.status_code, headers)
+            if delay is None:
+                return None
+            time.sleep(delay)
+
+    def attempts(self, deadline=None):
+        """Return the retry rules of one request.
+
+        :param deadline: see :func:`send_request`.
+        :type deadline: float
+
+        :returns: the attempts of the request, see :func:`put`.
+        :rtype: Attempts
+
+        """
+        return Attempts(self.retries, self.backoff_factor, self.auth,
+                        deadline)
+
+    def headers(self):
+        """Return the headers of the xCAT requests.
+
+        :returns: the headers, with the token of :attr:`auth` if it is set,
+                  or None if no token could be obtained.
+        :rtype: dict
+
+        """
+        headers = {'content-type': 'text/plain'}
+        if self.auth is not None:
+            token = self.auth.token()
+            if token is None:
+                logger.error("No xCAT token, request not sent")
+                return None
+            headers["X-Auth-Token"] = token
+        return headers
+
+    def url(self):
+        """Return the URL of the xCAT dsh requests of the zHCP node.
+
+        The credentials are in the URL unless :attr:`auth` is set.
+
+        :rtype: string
+
+        """
+        if self.auth is not None:
+            return "https://{}:{}/xcatws/nodes/{}/dsh?format=json".format(
+                self.xcat_addr, self.xcat_port, self.zhcpnode)
+        return ("https://{}:{}/xcatws/nodes/{}/dsh?userName={}&password={}&"
+                "format=json").format(self.xcat_addr, self.xcat_port,
+                                      self.zhcpnode, self.username,
+                                      self.password)
+
+    @staticmethod
+    def body(query_name):
+        """Return the body of the xCAT dsh request of a query.
+
+        :param query_name: xCAT query string.
+        :type query_name: string
+
+        :rtype: string
+
+        """
+        return '["command=smcli {}"]'.format(query_name)
+
+    def request_timeout(self, deadline=None):
+        """Return the timeout of a request.
 
-        return result
+        :param deadline: see :func:`send_request`.
+        :type deadline: float
 
-    def query_page_info(self):
+        :returns: :attr:`timeout`, or the time left to the deadline if it is
+                  shorter.
+        :rtype: float
+
+        """
+        if deadline is None:
+            return self.timeout
+        return min(self.timeout, max(time_left(deadline), 0.001))
+
+    def stream(self, query_fn, deadline=None):
+        """Send the query of a query function as a streamed request.
+
+        :param query_fn: name of the query function, e.g. "query_disk_def".
+        :type query_fn: string
+        :param deadline: see :func:`send_request`.
+        :type deadline: float
+
+        :returns: lines of the response, or None when the request has failed.
+        :rtype: ResponseStream
+
+        """
+        return self.stream_request(COMMANDS[query_fn], deadline)
+
+    def query_page_info(self, deadline=None):
         """Calls :func:`send_request` function with the following query
         ::
 
             System_Page_Utilization_Query -T ZHCP
         """
-        return self.send_request("System_Page_Utilization_Query -T ZHCP")
+        return self.send_request(COMMANDS["query_page_info"], deadline)
 
-    def query_spool_info(self):
+    def query_spool_info(self, deadline=None):
         """Calls :func:`send_request` function with the following query
         ::
 
             System_Spool_Utilization_Query -T ZHCP
         """
-        return self.send_request("System_Spool_Utilization_Query -T ZHCP")
+        return self.send_request(COMMANDS["query_spool_info"], deadline)
 
-    def query_cpu_memory_info(self):
+    def query_cpu_memory_info(self, deadline=None):
         """Calls :func:`send_request` function with the following query
         ::
 
             System_Performance_Information_Query -T ZHCP -k
             DETAILED_CPU=SHOW=NO
         """
-        return self.send_request("System_Performance_Information_Query -T "
-                                 "ZHCP -k DETAILED_CPU=SHOW=NO")
+        return self.send_request(COMMANDS["query_cpu_memory_info"], deadline)
 
-    def query_disk_def(self):
+    def query_disk_def(self, deadline=None):
         """Calls :func:`send_request` function with the following query
         ::
 
             Image_Volume_Space_Query_DM -T ZHCP -q 1 -e 1
         """
-        # -q 1: query_type DEFINITION - Query volume definition for the
-        #       specified image device
-        # -e 1: entry_type VOLUME - Query specified volume
-        return self.send_request("Image_Volume_Space_Query_DM -T ZHCP -q 1 "
-                                 "-e 1")
+        return self.send_request(COMMANDS["query_disk_def"], deadline)
 
-    def query_disk_free(self):
+    def query_disk_free(self, deadline=None):
         """Calls :func:`send_request` function with the following query:
         ::
 
             Image_Volume_Space_Query_DM -T ZHCP -q 2 -e 1
         """
-        # -q 2: query_type FREE - Query amount of free space available on
-        #       the specified image
-        # -e 1: entry_type VOLUME - Query specified volume
-        return self.send_request("Image_Volume_Space_Query_DM -T ZHCP -q 2 "
-                                 "-e 1")
+        return self.send_request(COMMANDS["query_disk_free"], deadline)
+
+    def query_combined(self, query_fn, deadline=None):
+        """Send the commands of several query functions in a single request.
+
+        The commands are run one after the other by one dsh call, each
+        followed by an ``echo`` of :data:`END_OF_COMMAND`. The output is then
+        split back into one response per query with
+        :func:`Parser.split_commands`.
+
+        :param query_fn: Names of the query functions, e.g.
+                         ``["query_page_info", "query_spool_info"]``.
+        :type query_fn: list
+        :param deadline: see :func:`send_request`.
+        :type deadline: float
+
+        :returns: a dictionary with the query function names as keys and
+                  their responses as values. The responses are empty strings
+                  when the request has failed.
+        :rtype: dict
+
+        """
+        response = self.send_request(self.combined_command(query_fn),
+                                     deadline)
+        return self.split_combined(query_fn, response)
+
+    @staticmethod
+    def combined_command(query_fn):
+        """Return the command of a combined request, see
+        :func:`query_combined`.
+
+        :param query_fn: Names of the query functions.
+        :type query_fn: list
+
+        :rtype: string
+
+        """
+        return "; smcli ".join(
+            "{}; echo {}".format(COMMANDS[f], END_OF_COMMAND)
+            for f in query_fn)
+
+    @staticmethod
+    def split_combined(query_fn, response):
+        """Split the response of a combined request, see
+        :func:`query_combined`.
+
+        :param query_fn: Names of the query functions of the request.
+        :param response: the response, or an empty string if the request
+                         has failed.
+        :type query_fn: list
+        :type response: string
+
+        :returns: a dictionary with the query function names as keys and
+                  their responses as values.
+        :rtype: dict
+
+        """
+        return dict(zip(query_fn, Parser.split_commands(
+            response, END_OF_COMMAND, len(query_fn))))
+
+
+class Attempts(object):
+    """Decide whether a failed xCAT request is sent again.
+
+    A request refused for its token is sent once more with a new token.
+    A request that failed with a status code in :data:`RETRY_STATUSES`, or
+    could not connect, is retried ``retries`` times, after
+    ``backoff_factor`` seconds doubled on every retry. No retry is made
+    past the deadline.
+
+    :param retries: number of retries of a failed request.
+    :param backoff_factor: time in seconds before the first retry.
+    :param auth: the token provider of the requester, or None.
+    :param deadline: time in seconds since the epoch after which the
+                     request is not sent again, or None.
+    :type retries: int
+    :type backoff_factor: float
+    :type auth: zvm_exporter.auth.TokenAuth
+    :type deadline: float
+
+    """
+
+    def __init__(self, retries, backoff_factor, auth=None, deadline=None):
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.auth = auth
+        self.deadline = deadline
+        #: Number of retries made so far.
+        self.attempt = 0
+        #: Token of the request refused by xCAT, if any.
+        self.refused = None
+
+    def next(self, status=None, headers=None):
+        """Return the time to wait before sending the request again.
+
+        :param status: HTTP status code of the failed request, or None if
+                       it could not connect.
+        :param headers: headers the request was sent with.
+        :type status: int
+        :type headers: dict
+
+        :returns: the time in seconds, or None if the request is not sent
+                  again.
+        :rtype: float
+
+        """
+        if status in AUTH_STATUSES and self.auth is not None and \
+                self.refused is None:
+            # The token expired or was revoked early: get a new one
+            self.refused = headers["X-Auth-Token"]
+            self.auth.invalidate(self.refused)
+            return 0
+        if (status is not None and status not in RETRY_STATUSES) or \
+                self.attempt >= self.retries:
+            return None
+        self.attempt += 1
+        delay = self.backoff_factor * 2 ** (self.attempt - 1)
+        left = time_left(self.deadline)
+        if left is not None and left <= delay:
+            return None
+        return delay
+
+
+class ResponseStream(object):
+    """Lines of output of an xCAT response, read as they arrive.
+
+    The stream can be iterated once. The error code is available once the
+    lines have been consumed. When the response can't be read or decoded,
+    the iteration stops and :attr:`failed` is set.
+
+    :param response: response of a streamed request.
+    :type response: requests.Response
+    :param chunk_size: number of bytes read at a time.
+    :type chunk_size: int
+    :param on_close: function called with the number of bytes read once the
+                     stream is closed.
+    :type on_close: function
+
+    """
+    def __init__(self, response, chunk_size=8192, on_close=None):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.decoder = StreamDecoder()
+        self.size = 0
+        self.on_close = on_close
+        self.failed = False
+
+    def __iter__(self):
+        try:
+            for line in Parser.iter_stream(self.chunks(), self.decoder):
+                yield line
+        except RequestException:
+            logger.exception("Failed to read the response")
+            self.failed = True
+        except ValueError:
+            # e.g. a malformed escape sequence
+            logger.exception("Failed to decode the response")
+            self.failed = True
+        finally:
+            self.close()
+
+    def chunks(self):
+        """Iterate over the chunks of the response, counting their size."""
+        for chunk in self.response.iter_content(self.chunk_size):
+            self.size += len(chunk)
+            yield chunk
+
+    @property
+    def errorcode(self):
+        """Error code of the response, as an int, or None."""
+        try:
+            return int(self.decoder.errorcode)
+        except (TypeError, ValueError):
+            return None
+
+    def close(self):
+        """Release the connection of the response."""
+        self.response.close()
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close(self.size)
@@ -0,0 +1,114 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+def current_deadline():
+    """Return the deadline of the scrape being served by the current thread.
+
+    :returns: time in seconds since the epoch, or None if there is none.
+    :rtype: float
+
+    """
+    return getattr(_local, "deadline", None)
+
+
+def current_collectors():
+    """Return the metric groups requested by the scrape being served by the
+    current thread.
+
+    :returns: names of metric groups, or None if all of them are requested.
+    :rtype: list
+
+    """
+    return getattr(_local, "collectors", None)
+
+
+@contextmanager
+def _scope(name, value):
+    previous = getattr(_local, name, None)
+    setattr(_local, name, value)
+    try:
+        yield value
+    finally:
+        setattr(_local, name, previous)
+
+
+def scrape_deadline(deadline):
+    """Set the deadline of the scrape served by the current thread.
+
+    Collectors called within the block, e.g. by a registry, can read it
+    with :func:`current_deadline`, since prometheus_client does not pass
+    anything to their ``collect`` function.
+
+    :param deadline: time in seconds since the epoch, or None.
+    :type deadline: float
+
+    """
+    return _scope("deadline", deadline)
+
+
+def scrape_collectors(collectors):
+    """Set the metric groups requested by the scrape served by the current
+    thread, see :func:`scrape_deadline`.
+
+    :param collectors: names of metric groups, or None for all of them.
+    :type collectors: list
+
+    """
+    return _scope("collectors", collectors)
+
+
+def time_left(deadline, now=None):
+    """Return the time left until a deadline.
+
+    :param deadline: time in seconds since the epoch, or None.
+    :param now: current time. If not provided, the current time is used.
+    :type deadline: float
+    :type now: float
+
+    :returns: the time left in seconds, at least 0, or None if there is no
+              deadline.
+    :rtype: float
+
+    """
+    if deadline is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0, deadline - now)
+
+
+def shortest(*times):
+    """Return the shortest of several times, ignoring the ones that are None.
+
+    :returns: the shortest time, or None if all of them are None.
+    :rtype: float
+
+    """
+    times = [t for t in times if t is not None]
+    return min(times) if times else None
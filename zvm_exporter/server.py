@@ -0,0 +1,243 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+from prometheus_client.core import REGISTRY
+from prometheus_client.exposition import choose_encoder
+from zvm_exporter.collector import COLLECTORS
+from zvm_exporter.scrape import scrape_collectors, scrape_deadline
+from zvm_exporter.exposition import ExpositionCache, render
+
+logger = logging.getLogger("zvmExporter")
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling every request in its own thread."""
+    daemon_threads = True
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+    """HTTP handler of the exporter.
+
+    ``/probe?target=<zhcpnode>`` exports the metrics of a single zHCP node
+    of :attr:`targets`. Any other path exports :attr:`registry`, through
+    :attr:`exposition` if it is set. Both accept ``collect[]`` parameters,
+    e.g. ``/metrics?collect[]=system&collect[]=page``, to export some metric
+    groups only (see :data:`zvm_exporter.collector.COLLECTORS`).
+
+    The ``X-Prometheus-Scrape-Timeout-Seconds`` header of a scrape, minus
+    :attr:`timeout_offset`, sets the deadline of the xCAT queries the scrape
+    sends, see :func:`zvm_exporter.scrape.scrape_deadline`.
+
+    The exposition is sent gzip-compressed to clients accepting it, with
+    ``ETag`` and ``Last-Modified`` headers. Conditional requests whose
+    exposition has not changed get a 304 response.
+
+    ``/ready`` answers 200 once every static target of :attr:`targets` has
+    published a snapshot of its metrics, and 503 until then.
+
+    """
+    #: Registry exported on ``/metrics``.
+    registry = REGISTRY
+    #: :class:`zvm_exporter.targets.Targets` that can be probed.
+    targets = None
+    #: :class:`zvm_exporter.exposition.ExpositionCache` of :attr:`registry`.
+    exposition = None
+    #: Time in seconds kept from the scrape timeout to send the exposition.
+    timeout_offset = 0.5
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+
+        if url.path == "/ready":
+            self.send_ready()
+            return
+
+        collectors = params.get("collect[]")
+        if collectors is not None:
+            unknown = set(collectors) - set(COLLECTORS)
+            if unknown:
+                self.send_error(400, "Unknown collectors: {}".format(
+                    ", ".join(sorted(unknown))))
+                return
+            collectors = sorted(set(collectors))
+
+        if url.path == "/probe":
+            target = params.get("target", [""])[0]
+            if not target or self.targets is None:
+                self.send_error(400, "Missing target parameter")
+                return
+            registry = self.targets.registry(target)
+            exposition = None
+        else:
+            registry = self.registry
+            exposition = self.exposition
+
+        encoder, content_type = choose_encoder(self.headers.get("Accept"))
+        try:
+            with scrape_deadline(self.deadline()), \
+                    scrape_collectors(collectors):
+                if exposition is not None:
+                    rendered = exposition.get(
+                        encoder, content_type,
+                        collectors and tuple(collectors))
+                else:
+                    rendered = render(registry, encoder, content_type)
+        except Exception:
+            logger.exception("Failed to generate metrics")
+            self.send_error(500, "Failed to generate metrics")
+            return
+
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            output = rendered.gzip
+            etag = rendered.etag[:-1] + '-gzip"'
+        else:
+            output = rendered.plain
+            etag = rendered.etag
+
+        if self.not_modified(etag, rendered.last_modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", rendered.last_modified)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(output)))
+        if output is rendered.gzip:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", rendered.last_modified)
+        self.end_headers()
+        self.wfile.write(output)
+
+    def send_ready(self):
+        """Answer a readiness probe."""
+        if self.targets is None or self.targets.ready():
+            status, output = 200, b"ready\n"
+        else:
+            status, output = 503, b"not ready\n"
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def deadline(self):
+        """Return the deadline of the scrape.
+
+        :returns: time in seconds since the epoch, or None if Prometheus did
+                  not send its scrape timeout.
+        :rtype: float
+
+        """
+        header = self.headers.get("X-Prometheus-Scrape-Timeout-Seconds")
+        if not header:
+            return None
+        try:
+            timeout = float(header)
+        except ValueError:
+            logger.warning("Invalid scrape timeout: {}".format(header))
+            return None
+        return time.time() + max(0, timeout - self.timeout_offset)
+
+    def not_modified(self, etag, last_modified):
+        """Check the conditional headers of the request.
+
+        :param etag: ETag of the exposition.
+        :type etag: string
+        :param last_modified: Last-Modified date of the exposition.
+        :type last_modified: string
+
+        :returns: True if the client already has the exposition.
+        :rtype: bool
+
+        """
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return etag in tags or "*" in tags
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            since = parsedate_tz(if_modified_since)
+            modified = parsedate_tz(last_modified)
+            if since is not None and modified is not None:
+                return mktime_tz(modified) <= mktime_tz(since)
+        return False
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def start_http_server(port, targets=None, addr="", registry=REGISTRY,
+                      timeout_offset=0.5):
+    """Start the HTTP server of the exporter in a daemon thread.
+
+    :param port: Port on which to expose metrics.
+    :type port: int
+    :param targets: targets that can be probed on ``/probe``. The
+                    exposition on ``/metrics`` is rendered again only when
+                    their snapshots change, see
+                    :class:`zvm_exporter.exposition.ExpositionCache`.
+    :type targets: zvm_exporter.targets.Targets
+    :param addr: Address to listen on. Defaults to all addresses.
+    :type addr: string
+    :param registry: Registry exported on ``/metrics``.
+    :type registry: prometheus_client.core.CollectorRegistry
+    :param timeout_offset: Time in seconds subtracted from the scrape timeout
+                           sent by Prometheus to get the deadline of the
+                           xCAT queries.
+    :type timeout_offset: float
+
+    :returns: the started server.
+    :rtype: ThreadingHTTPServer
+
+    """
+    exposition = None
+    if targets is not None:
+        exposition = ExpositionCache(registry, targets.version)
+    handler = type("Handler", (ExporterHandler, object),
+                   {"targets": targets, "registry": registry,
+                    "exposition": exposition,
+                    "timeout_offset": timeout_offset})
+    server = ThreadingHTTPServer((addr, port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
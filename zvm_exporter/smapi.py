@@ -0,0 +1,447 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Direct access to the SMAPI servers of the zHCP nodes.
+
+The SMAPI socket protocol is used instead of the xCAT REST API, which runs
+``smcli`` on the zHCP node over ssh for every query. A request is sent as:
+::
+
+    input_length (int4), then the length (int4) and value of each of
+    function_name, authenticated_userid, password and target_identifier,
+    then the parameters of the function
+
+The server answers with the request ID (int4), then:
+::
+
+    output_length (int4), request_id (int4), return_code (int4),
+    reason_code (int4), then the output of the function
+
+All integers are big-endian.
+"""
+
+import logging
+import socket
+import ssl
+import struct
+import threading
+import time
+
+from zvm_exporter.parser import Parser
+from zvm_exporter.requester import QUERY_NAMES, Requester
+
+logger = logging.getLogger("zvmExporter")
+
+#: Default port of the SMAPI server.
+SMAPI_PORT = 44444
+
+#: Target of the SMAPI calls, as in ``smcli ... -T ZHCP``.
+TARGET = "ZHCP"
+
+#: SMAPI functions called for the query functions of the
+#: :class:`zvm_exporter.requester.Requester`, with their parameters.
+CALLS = {
+    "query_page_info": ("System_Page_Utilization_Query", b""),
+    "query_spool_info": ("System_Spool_Utilization_Query", b""),
+    "query_cpu_memory_info": ("System_Performance_Information_Query",
+                              b"DETAILED_CPU=SHOW=NO\0"),
+    # query_type (int1) DEFINITION, entry_type (int1) VOLUME, all entries
+    "query_disk_def": ("Image_Volume_Space_Query_DM",
+                       b"\x01\x01\x00\x00\x00\x00"),
+    # query_type (int1) FREE, entry_type (int1) VOLUME, all entries
+    "query_disk_free": ("Image_Volume_Space_Query_DM",
+                        b"\x02\x01\x00\x00\x00\x00"),
+}
+
+
+class SMAPIError(Exception):
+    """Malformed message received from a SMAPI server."""
+
+
+def pack_int(value):
+    """Encode an int4."""
+    return struct.pack(">i", value)
+
+
+def pack_string(value):
+    """Encode a string with its length."""
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    return pack_int(len(value)) + value
+
+
+def unpack_int(data, offset=0):
+    """Decode an int4.
+
+    :returns: the value and the offset following it.
+    :rtype: tuple
+
+    """
+    if len(data) < offset + 4:
+        raise SMAPIError("Truncated message")
+    return struct.unpack(">i", data[offset:offset + 4])[0], offset + 4
+
+
+def unpack_string(data, offset=0):
+    """Decode a string with its length.
+
+    :returns: the value and the offset following it.
+    :rtype: tuple
+
+    """
+    length, offset = unpack_int(data, offset)
+    if length < 0 or len(data) < offset + length:
+        raise SMAPIError("Truncated message")
+    return (data[offset:offset + length].decode("utf-8", "replace"),
+            offset + length)
+
+
+def encode_request(function, userid, password, target, parameters=b""):
+    """Encode a SMAPI request.
+
+    :param function: name of the SMAPI function.
+    :param userid: user to authenticate with.
+    :param password: password of the user.
+    :param target: target of the function.
+    :param parameters: encoded parameters of the function.
+    :type function: string
+    :type userid: string
+    :type password: string
+    :type target: string
+    :type parameters: bytes
+
+    :rtype: bytes
+
+    """
+    body = b"".join([pack_string(function), pack_string(userid),
+                     pack_string(password), pack_string(target),
+                     parameters])
+    return pack_int(len(body)) + body
+
+
+def encode_utilization(total_allocated, total_used, available_percentage):
+    """Encode the output of the page and spool utilization queries:
+    total_allocated (int8), total_used (int8) and available_percentage
+    (int4)."""
+    return struct.pack(">qqi", total_allocated, total_used,
+                       available_percentage)
+
+
+def decode_utilization(data):
+    """Decode the output of :func:`encode_utilization` into the lines
+    ``smcli`` prints."""
+    if len(data) < 20:
+        raise SMAPIError("Truncated message")
+    total_allocated, total_used, available = struct.unpack(">qqi", data[:20])
+    return ["Total allocated: {}".format(total_allocated),
+            "Total used: {}".format(total_used),
+            "Available percentage: {}".format(available)]
+
+
+def encode_strings(strings):
+    """Encode the output of the keyword queries: the length (int4) of an
+    array of null-terminated strings, e.g. ``CPU_COUNT=32``."""
+    data = b"".join(s.encode("utf-8") + b"\0" for s in strings)
+    return pack_int(len(data)) + data
+
+
+def decode_strings(data):
+    """Decode the output of :func:`encode_strings` into its strings."""
+    length, offset = unpack_int(data)
+    if length < 0 or len(data) < offset + length:
+        raise SMAPIError("Truncated message")
+    strings = data[offset:offset + length].split(b"\0")
+    return [s.decode("utf-8", "replace") for s in strings if s]
+
+
+def encode_records(records):
+    """Encode the output of the volume space queries: the length (int4) of
+    an array of records, each with its length (int4)."""
+    data = b"".join(pack_string(record) for record in records)
+    return pack_int(len(data)) + data
+
+
+def decode_records(data):
+    """Decode the output of :func:`encode_records` into its records."""
+    length, offset = unpack_int(data)
+    end = offset + length
+    if length < 0 or len(data) < end:
+        raise SMAPIError("Truncated message")
+    records = []
+    while offset < end:
+        record, offset = unpack_string(data, offset)
+        records.append(record)
+    return records
+
+
+#: Functions decoding the output of the SMAPI functions into lines of text.
+DECODERS = {
+    "System_Page_Utilization_Query": decode_utilization,
+    "System_Spool_Utilization_Query": decode_utilization,
+    "System_Performance_Information_Query": decode_strings,
+    "Image_Volume_Space_Query_DM": decode_records,
+}
+
+
+class SMAPIConnection(object):
+    """Persistent connection to a SMAPI server.
+
+    Several requests are sent one after the other on the same connection.
+    A request that fails on a connection that was reused is sent again on a
+    new one, as the server may have closed it meanwhile.
+
+    :param host: address of the SMAPI server.
+    :param port: port of the SMAPI server.
+    :param ssl_context: context to wrap the connection with, if any.
+    :type host: string
+    :type port: int
+    :type ssl_context: ssl.SSLContext
+
+    """
+    def __init__(self, host, port=SMAPI_PORT, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.sock = None
+        self.requests = 0
+
+    def connect(self, timeout=None):
+        """Open the connection."""
+        sock = socket.create_connection((self.host, self.port), timeout)
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock,
+                                                server_hostname=self.host)
+        self.sock = sock
+        self.requests = 0
+
+    def close(self):
+        """Close the connection."""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def recv(self, size):
+        """Read exactly ``size`` bytes."""
+        chunks = []
+        while size:
+            chunk = self.sock.recv(size)
+            if not chunk:
+                raise SMAPIError("Connection closed by the SMAPI server")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def call(self, request, timeout=None):
+        """Send an encoded request and read its response.
+
+        :param request: request as returned by :func:`encode_request`.
+        :type request: bytes
+        :param timeout: time in seconds to wait for the server.
+        :type timeout: float
+
+        :returns: the return code, the reason code and the output of the
+                  function.
+        :rtype: tuple
+
+        """
+        for attempt in range(2):
+            reused = self.sock is not None
+            if not reused:
+                self.connect(timeout)
+            try:
+                self.sock.settimeout(timeout)
+                self.sock.sendall(request)
+                request_id, _ = unpack_int(self.recv(4))
+                length, _ = unpack_int(self.recv(4))
+                output = self.recv(length)
+            except (socket.error, SMAPIError):
+                self.close()
+                if reused and not attempt:
+                    continue
+                raise
+            self.requests += 1
+            if unpack_int(output)[0] != request_id:
+                self.close()
+                raise SMAPIError("Unexpected request ID")
+            return_code, offset = unpack_int(output, 4)
+            reason_code, offset = unpack_int(output, offset)
+            return return_code, reason_code, output[offset:]
+
+
+class SMAPISession(object):
+    """Connections to the SMAPI servers, shared by SMAPI requesters.
+
+    Up to ``pool_size`` idle connections are kept per server.
+
+    :param port: port of the SMAPI servers.
+    :param pool_size: Maximum number of idle connections kept per server.
+    :param cert: CA certificate file. If provided, the connections use TLS.
+    :type port: int
+    :type pool_size: int
+    :type cert: string
+
+    """
+    def __init__(self, port=SMAPI_PORT, pool_size=10, cert=None):
+        self.port = port
+        self.pool_size = pool_size
+        self.ssl_context = ssl.create_default_context(cafile=cert) \
+            if cert else None
+        # host -> idle connections
+        self.idle = {}
+        self._lock = threading.Lock()
+
+    def call(self, host, request, timeout=None):
+        """Send an encoded request to a SMAPI server on an idle connection,
+        or on a new one. See :func:`SMAPIConnection.call`."""
+        with self._lock:
+            idle = self.idle.get(host)
+            connection = idle.pop() if idle else None
+        if connection is None:
+            connection = SMAPIConnection(host, self.port, self.ssl_context)
+        result = connection.call(request, timeout)
+        with self._lock:
+            idle = self.idle.setdefault(host, [])
+            if len(idle) < self.pool_size:
+                idle.append(connection)
+            else:
+                connection.close()
+        return result
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+
+
+class SMAPIRequester(Requester):
+    """Requester calling the SMAPI servers of the zHCP nodes directly.
+
+    The zHCP node names are used as addresses of their SMAPI servers, and
+    ``username`` and ``password`` to authenticate with them. The output of
+    the SMAPI functions is decoded into the lines ``smcli`` prints, prefixed
+    with the node name, and returned as an xCAT response message (see
+    :func:`zvm_exporter.parser.Parser.encode`), so that the responses are
+    parsed as those of xCAT. The return code of the SMAPI function is the
+    error code of the response, and is recorded as the status code of the
+    request. Streamed requests are not supported.
+
+    See :class:`zvm_exporter.requester.Requester` for the parameters.
+    ``xcat_addr`` and ``xcat_port`` are ignored, ``session`` is a
+    :class:`SMAPISession`.
+
+    """
+    streaming = False
+
+    def __init__(self, zhcpnode, username, password, xcat_addr=None,
+                 xcat_port=None, cert=None, pool_size=10, retries=3,
+                 backoff_factor=0.5, timeout=30, backoff=30, max_backoff=600,
+                 session=None, hedge=None, hedge_budget=0.1):
+        Requester.__init__(self, zhcpnode, username, password, xcat_addr,
+                           xcat_port, cert, pool_size, retries,
+                           backoff_factor, timeout, backoff, max_backoff,
+                           session or SMAPISession(pool_size=pool_size,
+                                                   cert=cert),
+                           hedge=hedge, hedge_budget=hedge_budget)
+        self.hosts = [host.strip() for host in zhcpnode.split(",")]
+
+    @staticmethod
+    def create_session(pool_size=10, retries=3, backoff_factor=0.5,
+                       port=SMAPI_PORT, cert=None):
+        """Create the session shared by SMAPI requesters.
+
+        :param pool_size: Maximum number of idle connections per server.
+        :type pool_size: int
+        :param retries: Ignored.
+        :param backoff_factor: Ignored.
+        :param port: port of the SMAPI servers.
+        :type port: int
+        :param cert: see :class:`SMAPISession`.
+        :type cert: string
+
+        :rtype: SMAPISession
+
+        """
+        return SMAPISession(port, pool_size, cert)
+
+    def do_request(self, query_name, deadline=None):
+        """Call the SMAPI function of a query on every zHCP node.
+
+        :param query_name: xCAT query string, see
+                           :data:`zvm_exporter.requester.COMMANDS`.
+        :type query_name: string
+        :param deadline: see :func:`Requester.send_request`.
+        :type deadline: float
+
+        :returns: an xCAT response message, or an empty string when a call
+                  has failed.
+        :rtype: string
+
+        """
+        query_fn = "query_{}".format(QUERY_NAMES.get(query_name))
+        if query_fn not in CALLS:
+            logger.error("No SMAPI function for query: {}".format(query_name))
+            return ""
+        function, parameters = CALLS[query_fn]
+        request = encode_request(function, self.username, self.password,
+                                 TARGET, parameters)
+        lines = []
+        errorcode = 0
+        for host in self.hosts:
+            logger.info("Calling {} on {}...".format(function, host))
+            start = time.time()
+            try:
+                return_code, reason_code, output = self.session.call(
+                    host, request, self.request_timeout(deadline))
+                records = DECODERS[function](output) if output else []
+            except (socket.error, SMAPIError):
+                logger.exception("Failed to call {} on {}".format(function,
+                                                                  host))
+                self.record(query_name, time.time() - start)
+                return ""
+            self.record(query_name, time.time() - start, return_code,
+                        len(output))
+            if return_code:
+                logger.warning("{} on {} returned {} (reason {})".format(
+                    function, host, return_code, reason_code))
+                if not records:
+                    return ""
+                errorcode = errorcode or return_code
+            lines.extend("{}: {}".format(host, record) for record in records)
+        return Parser.encode(lines, str(errorcode))
+
+    def query_combined(self, query_fn, deadline=None):
+        """Call the SMAPI functions of several query functions.
+
+        SMAPI has no combined request: the functions are called one after
+        the other on the same connection.
+
+        :returns: see :func:`Requester.query_combined`.
+        :rtype: dict
+
+        """
+        return dict((f, getattr(self, f)(deadline)) for f in query_fn)
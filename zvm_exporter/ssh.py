@@ -0,0 +1,313 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Running ``smcli`` on the zHCP nodes over SSH, without xCAT."""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from zvm_exporter.parser import Parser
+from zvm_exporter.requester import Requester
+
+logger = logging.getLogger("zvmExporter")
+
+#: Exit status of ssh when the connection failed.
+SSH_ERROR = 255
+
+
+class Transport(object):
+    """Runs commands on a zHCP node."""
+
+    def run(self, command, timeout=None):
+        """Run a shell command.
+
+        :param command: the command.
+        :type command: string
+        :param timeout: time in seconds the command may take.
+        :type timeout: float
+
+        :returns: the exit status and the standard output of the command.
+        :rtype: tuple
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release the resources of the transport."""
+
+
+class SSHTransport(Transport):
+    """Runs commands over a long-lived SSH connection.
+
+    The commands are multiplexed on a master connection, which the first
+    command opens and which is kept open ``persist`` seconds after the last
+    one (see ``ControlMaster`` in ssh_config(5)). Commands run concurrently
+    as sessions of the same connection, so only the first one pays for the
+    TCP connect, the key exchange and the authentication.
+
+    :param host: address of the zHCP node.
+    :param user: user to log in as. If not provided, the ssh configuration
+                 decides.
+    :param key: private key file. If not provided, the ssh configuration
+                decides.
+    :param control_path: path of the socket of the master connection.
+    :param persist: time in seconds the idle master connection is kept open.
+    :param ssh: ssh program to run.
+    :type host: string
+    :type user: string
+    :type key: string
+    :type control_path: string
+    :type persist: int
+    :type ssh: string
+
+    """
+    def __init__(self, host, user=None, key=None, control_path=None,
+                 persist=600, ssh="ssh"):
+        self.host = host
+        self.user = user
+        self.key = key
+        self.control_path = control_path
+        self.persist = persist
+        self.ssh = ssh
+
+    def options(self):
+        """Return the ssh options of the transport.
+
+        :rtype: list
+
+        """
+        options = ["-o", "BatchMode=yes"]
+        if self.control_path:
+            options += ["-o", "ControlMaster=auto",
+                        "-o", "ControlPath={}".format(self.control_path),
+                        "-o", "ControlPersist={}".format(self.persist)]
+        if self.key:
+            options += ["-i", self.key]
+        if self.user:
+            options += ["-l", self.user]
+        return options
+
+    def run(self, command, timeout=None):
+        args = [self.ssh] + self.options() + [self.host, command]
+        process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, process.kill)
+            timer.start()
+        try:
+            output, error = process.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if process.returncode and error:
+            logger.warning("{}: {}".format(self.host, error.decode(
+                "utf-8", "replace").strip()))
+        return process.returncode, output.decode("utf-8", "replace")
+
+    def close(self):
+        """Close the master connection, if any."""
+        if not self.control_path:
+            return
+        args = [self.ssh] + self.options() + ["-O", "exit", self.host]
+        with open(os.devnull, "w") as devnull:
+            subprocess.call(args, stdout=devnull, stderr=devnull)
+
+
+class StubTransport(Transport):
+    """Transport answering ``smcli`` commands with canned outputs, for
+    testing.
+
+    Commands are split on ``;`` as a shell would: ``smcli <command>`` is
+    answered with the output of ``<command>`` and ``echo <text>`` with
+    ``<text>``.
+
+    :param outputs: a dictionary with ``smcli`` commands, e.g.
+                    ``System_Page_Utilization_Query -T ZHCP``, as keys and
+                    their output as values.
+    :param status: exit status of the commands.
+    :type outputs: dict
+    :type status: int
+
+    """
+    def __init__(self, outputs, status=0):
+        self.outputs = outputs
+        self.status = status
+        self.commands = []
+
+    def run(self, command, timeout=None):
+        self.commands.append(command)
+        output = []
+        for part in command.split(";"):
+            part = part.strip()
+            if part.startswith("smcli "):
+                output.append(self.outputs.get(part[len("smcli "):], ""))
+            elif part.startswith("echo "):
+                output.append(part[len("echo "):] + "\n")
+        return self.status, "".join(output)
+
+
+class SSHSession(object):
+    """SSH transports to the zHCP nodes, shared by SSH requesters.
+
+    :param user: user to log in as.
+    :param key: private key file.
+    :param persist: time in seconds idle connections are kept open.
+    :param ssh: ssh program to run.
+    :type user: string
+    :type key: string
+    :type persist: int
+    :type ssh: string
+
+    """
+    def __init__(self, user=None, key=None, persist=600, ssh="ssh"):
+        self.user = user
+        self.key = key
+        self.persist = persist
+        self.ssh = ssh
+        self.transports = {}
+        self._control_dir = None
+        self._lock = threading.Lock()
+
+    def transport(self, host):
+        """Return the transport to a zHCP node, creating it if needed.
+
+        :param host: address of the zHCP node.
+        :type host: string
+
+        :rtype: Transport
+
+        """
+        with self._lock:
+            if host not in self.transports:
+                if self._control_dir is None:
+                    self._control_dir = tempfile.mkdtemp(
+                        prefix="zvm_exporter-ssh-")
+                self.transports[host] = SSHTransport(
+                    host, self.user, self.key,
+                    os.path.join(self._control_dir, host), self.persist,
+                    self.ssh)
+            return self.transports[host]
+
+    def close(self):
+        """Close the connections."""
+        with self._lock:
+            for transport in self.transports.values():
+                transport.close()
+            self.transports.clear()
+            if self._control_dir is not None:
+                shutil.rmtree(self._control_dir, ignore_errors=True)
+                self._control_dir = None
+
+
+class SSHRequester(Requester):
+    """Requester running ``smcli`` on the zHCP nodes over SSH.
+
+    The zHCP node names are used as SSH host names. The output lines are
+    prefixed with the node name, as dsh does, and returned as an xCAT
+    response message (see :func:`zvm_exporter.parser.Parser.encode`), so
+    that the responses are parsed as those of xCAT. The exit status of
+    ``smcli`` is the error code of the response, and is recorded as the
+    status code of the request. Streamed requests are not supported.
+
+    See :class:`zvm_exporter.requester.Requester` for the parameters.
+    ``xcat_addr``, ``xcat_port``, ``password`` and ``cert`` are ignored,
+    ``session`` is a :class:`SSHSession`. If it is not provided, ``username``
+    is the SSH user.
+
+    """
+    streaming = False
+
+    def __init__(self, zhcpnode, username, password, xcat_addr=None,
+                 xcat_port=None, cert=None, pool_size=10, retries=3,
+                 backoff_factor=0.5, timeout=30, backoff=30, max_backoff=600,
+                 session=None, hedge=None, hedge_budget=0.1):
+        Requester.__init__(self, zhcpnode, username, password, xcat_addr,
+                           xcat_port, cert, pool_size, retries,
+                           backoff_factor, timeout, backoff, max_backoff,
+                           session or SSHSession(username),
+                           hedge=hedge, hedge_budget=hedge_budget)
+        self.hosts = [host.strip() for host in zhcpnode.split(",")]
+
+    @staticmethod
+    def create_session(pool_size=10, retries=3, backoff_factor=0.5,
+                       user=None, key=None):
+        """Create the session shared by SSH requesters.
+
+        :param pool_size: Ignored.
+        :param retries: Ignored.
+        :param backoff_factor: Ignored.
+        :param user: see :class:`SSHSession`.
+        :param key: see :class:`SSHSession`.
+        :type user: string
+        :type key: string
+
+        :rtype: SSHSession
+
+        """
+        return SSHSession(user, key)
+
+    def do_request(self, query_name, deadline=None):
+        """Run ``smcli`` on every zHCP node.
+
+        :param query_name: xCAT query string. Commands combined by
+                           :func:`query_combined` are run by one shell.
+        :type query_name: string
+        :param deadline: see :func:`Requester.send_request`.
+        :type deadline: float
+
+        :returns: an xCAT response message, or an empty string when the
+                  command has failed.
+        :rtype: string
+
+        """
+        lines = []
+        errorcode = 0
+        for host in self.hosts:
+            logger.info("Running smcli on {}...".format(host))
+            start = time.time()
+            try:
+                status, output = self.session.transport(host).run(
+                    "smcli {}".format(query_name),
+                    self.request_timeout(deadline))
+            except (OSError, IOError):
+                logger.exception("Failed to run smcli on {}".format(host))
+                self.record(query_name, time.time() - start)
+                return ""
+            self.record(query_name, time.time() - start, status,
+                        len(output))
+            if status:
+                logger.warning("smcli on {} exited with {}".format(host,
+                                                                   status))
+                # Killed on timeout, or no connection
+                if status < 0 or status == SSH_ERROR or not output.strip():
+                    return ""
+                errorcode = errorcode or status
+            lines.extend("{}: {}".format(host, line)
+                         for line in output.splitlines() if line.strip())
+        return Parser.encode(lines, str(errorcode))
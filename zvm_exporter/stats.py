@@ -0,0 +1,98 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+
+from prometheus_client.core import HistogramMetricFamily
+
+#: Upper bounds in seconds of the buckets of the latency histograms.
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+                   120, 300)
+
+
+class Histogram(object):
+    """Distribution of observed values, exported as a histogram.
+
+    Unlike prometheus_client's Histogram, it is not registered anywhere, so
+    that each collector can export its own with a ``host`` label.
+
+    :param buckets: upper bounds of the buckets, in increasing order.
+    :type buckets: tuple
+
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record a value."""
+        with self._lock:
+            self.sum += value
+            for i, bound in enumerate(self.bounds):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            else:
+                self.counts[-1] += 1
+
+    def buckets(self):
+        """Return the cumulative buckets of the histogram.
+
+        :returns: a list of ``(upper bound, count)`` tuples, the last one
+                  being ``("+Inf", total count)``.
+        :rtype: list
+
+        """
+        with self._lock:
+            counts = list(self.counts)
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            total += count
+            buckets.append((str(float(bound)) if bound != float("inf")
+                            else "+Inf", total))
+        return buckets
+
+
+def histogram_family(name, documentation, labels, histograms):
+    """Build a histogram metric family from histograms.
+
+    :param name: name of the metric.
+    :param documentation: description of the metric.
+    :param labels: label names.
+    :param histograms: a dictionary with tuples of label values as keys and
+                       :class:`Histogram` as values.
+    :type name: string
+    :type documentation: string
+    :type labels: list
+    :type histograms: dict
+
+    :rtype: HistogramMetricFamily
+
+    """
+    family = HistogramMetricFamily(name, documentation, labels=labels)
+    for label_values, histogram in sorted(histograms.items()):
+        family.add_metric(list(label_values), histogram.buckets(),
+                          histogram.sum)
+    return family
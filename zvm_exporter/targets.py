@@ -0,0 +1,322 @@
+# The MIT License (MIT)
+
+# Copyright (c) 2016 IBM Corporation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+from prometheus_client.core import CollectorRegistry, Metric
+
+from zvm_exporter.auth import TokenAuth
+from zvm_exporter.collector import ZVMCollector
+from zvm_exporter.requester import Requester
+
+logger = logging.getLogger("zvmExporter")
+
+
+class Targets(object):
+    """Collectors of several zHCP nodes managed by the same xCAT server.
+
+    All collectors share one connection pool to the xCAT server and one
+    worker pool, while each of them keeps its own query cache and circuit
+    breakers. Targets are either static, i.e. added with :func:`add` and
+    exported on ``/metrics``, or created on demand by :func:`get` when they
+    are probed on ``/probe?target=<zhcpnode>``.
+
+    An instance of this class can be registered in
+    prometheus_client.core.REGISTRY to export the static targets.
+
+    :example:
+        ::
+
+            targets = Targets(args.username, args.password, xcat_addr,
+                              xcat_port)
+            targets.add("zhcp1")
+            targets.add("zhcp2")
+            REGISTRY.register(targets)
+
+    :param username: Username for xCAT request.
+    :param password: Password for xCAT request.
+    :param xcat_addr: xCAT server address.
+    :param xcat_port: Port to connect to the xCAT server, e.g. 443 for HTTPS.
+    :param cert: SSL cert file. If not provided, SSL verification is
+                 disabled.
+    :param workers: Maximum number of queries sent to xCAT at the same time,
+                    for all targets together.
+    :param pool_size: Maximum number of keep-alive connections kept open to
+                      the xCAT server, for all targets together.
+    :param retries: Number of times a failed request is retried.
+    :param backoff_factor: Backoff factor applied between retries, in
+                           seconds.
+    :param asynchronous: Poll the static targets on a single asyncio event
+                         loop, see :mod:`zvm_exporter.aio`. Needs Python 3.5
+                         or later, aiohttp and an ``interval``. Probed
+                         targets are still queried on the worker pool.
+    :param limit_per_node: Maximum number of requests in flight to a static
+                           target with ``asynchronous``.
+    :param smapi_port: Call the SMAPI servers of the zHCP nodes directly on
+                       this port instead of going through xCAT, see
+                       :class:`zvm_exporter.smapi.SMAPIRequester`.
+    :param ssh_user: Run ``smcli`` on the zHCP nodes over SSH as this user
+                     instead of going through xCAT, see
+                     :class:`zvm_exporter.ssh.SSHRequester`.
+    :param ssh_key: private key file to log in with over SSH.
+    :param token: Authenticate with an xCAT token shared by all targets
+                  instead of sending the username and password with every
+                  request, see :class:`zvm_exporter.auth.TokenAuth`.
+    :param max_probed: Maximum number of probed targets kept. The least
+                       recently probed one is dropped, with its caches, when
+                       it is exceeded, so that probing arbitrary names does
+                       not grow the memory without limit.
+    :param collector_options: keyword arguments passed on to
+                              :class:`ZVMCollector`, e.g. ``interval``,
+                              ``ttls`` or ``timeout``.
+
+    """
+
+    def __init__(self, username, password, xcat_addr, xcat_port, cert=None,
+                 workers=5, pool_size=10, retries=3, backoff_factor=0.5,
+                 asynchronous=False, limit_per_node=2, smapi_port=None,
+                 ssh_user=None, ssh_key=None, token=False, max_probed=32,
+                 **collector_options):
+        self.username = username
+        self.password = password
+        self.xcat_addr = xcat_addr
+        self.xcat_port = xcat_port
+        self.cert = cert
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.collector_options = collector_options
+        if asynchronous and (smapi_port or ssh_user):
+            raise ValueError("Asynchronous collection needs xCAT")
+        if smapi_port:
+            from zvm_exporter.smapi import SMAPIRequester
+            self.requester_class = SMAPIRequester
+            self.session = SMAPIRequester.create_session(
+                pool_size, retries, backoff_factor, smapi_port, cert)
+        elif ssh_user:
+            from zvm_exporter.ssh import SSHRequester
+            self.requester_class = SSHRequester
+            self.session = SSHRequester.create_session(
+                pool_size, retries, backoff_factor, ssh_user, ssh_key)
+        else:
+            self.requester_class = Requester
+            self.session = Requester.create_session(pool_size, retries,
+                                                    backoff_factor)
+        if collector_options.get("stream") and (
+                asynchronous or not self.requester_class.streaming):
+            # Otherwise probed targets would fail on scrape
+            raise ValueError("Streamed responses need the xCAT requester")
+        self.auth = None
+        if token and self.requester_class is Requester:
+            self.auth = TokenAuth(username, password, xcat_addr, xcat_port,
+                                  self.session, cert)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.asynchronous = asynchronous
+        if asynchronous:
+            if not collector_options.get("interval"):
+                raise ValueError("Asynchronous collection needs an interval")
+            from zvm_exporter.aio import AsyncRequester
+            self.async_options = {
+                "requester_class": AsyncRequester,
+                "session": AsyncRequester.create_session(
+                    pool_size, retries, backoff_factor, limit_per_node)}
+        self.static = OrderedDict()
+        self.max_probed = max_probed
+        # zhcpnode -> collector, from the least to the most recently probed
+        self.probed = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, zhcpnode, **options):
+        """Create a collector sharing the pools of the targets.
+
+        :param zhcpnode: Name of the zHCP node.
+        :type zhcpnode: string
+        :param options: keyword arguments overriding the collector options
+                        given to the constructor.
+
+        :rtype: ZVMCollector
+
+        """
+        collector_options = {"executor": self.executor,
+                             "session": self.session,
+                             "requester_class": self.requester_class,
+                             "retries": self.retries,
+                             "backoff_factor": self.backoff_factor}
+        if self.auth is not None:
+            collector_options["auth"] = self.auth
+        collector_options.update(self.collector_options)
+        collector_options.update(options)
+        return ZVMCollector(zhcpnode, self.username, self.password,
+                            self.xcat_addr, self.xcat_port, self.cert,
+                            **collector_options)
+
+    def add(self, zhcpnode):
+        """Add a static target.
+
+        :param zhcpnode: Name of the zHCP node, or a comma-separated list of
+                         nodes that are queried with a single request per
+                         query.
+        :type zhcpnode: string
+
+        :rtype: ZVMCollector
+
+        """
+        with self._lock:
+            if zhcpnode not in self.static:
+                options = self.async_options if self.asynchronous else {}
+                self.static[zhcpnode] = self.create(zhcpnode, **options)
+            return self.static[zhcpnode]
+
+    def get(self, zhcpnode):
+        """Return the collector of a target, creating it if needed.
+
+        Targets that are not static are created without background polling,
+        so xCAT is queried when they are probed. At most ``max_probed`` of
+        them are kept.
+
+        :param zhcpnode: Name of the zHCP node.
+        :type zhcpnode: string
+
+        :rtype: ZVMCollector
+
+        """
+        with self._lock:
+            if zhcpnode in self.static:
+                return self.static[zhcpnode]
+            collector = self.probed.pop(zhcpnode, None)
+            if collector is None:
+                logger.info("Adding probed target {}".format(zhcpnode))
+                collector = self.create(zhcpnode, interval=None)
+            self.probed[zhcpnode] = collector
+            while len(self.probed) > self.max_probed:
+                dropped, _ = self.probed.popitem(last=False)
+                logger.info("Dropping probed target {}".format(dropped))
+            return collector
+
+    def registry(self, zhcpnode):
+        """Return a registry exporting a single target.
+
+        :param zhcpnode: Name of the zHCP node.
+        :type zhcpnode: string
+
+        :rtype: prometheus_client.core.CollectorRegistry
+
+        """
+        registry = CollectorRegistry(auto_describe=False)
+        registry.register(self.get(zhcpnode))
+        return registry
+
+    def version(self):
+        """Identify the snapshots of the static targets.
+
+        :returns: the times of the snapshots of the static targets, which
+                  change whenever one of them is refreshed, or None if some
+                  of them are not polled in the background or there are
+                  none.
+        :rtype: tuple
+
+        """
+        collectors = list(self.static.values())
+        if not collectors or \
+                not all(collector.interval for collector in collectors):
+            return None
+        return tuple(collector.snapshot and collector.snapshot.timestamp
+                     for collector in collectors)
+
+    def ready(self):
+        """Tell whether every static target has published a snapshot.
+
+        :rtype: bool
+
+        """
+        return all(collector.ready()
+                   for collector in list(self.static.values()))
+
+    def describe(self):
+        """Describe the metrics of the static targets without querying
+        xCAT. See :func:`ZVMCollector.describe`.
+
+        :returns: metric family objects of prometheus_client.core, without
+                  samples.
+        :rtype: list
+
+        """
+        families = OrderedDict()
+        for collector in list(self.static.values()):
+            for metric in collector.describe():
+                families.setdefault(metric.name, metric)
+        return list(families.values())
+
+    def collect(self):
+        """Collect function exporting all static targets.
+
+        Metric families of the same name are merged, so that every family
+        appears only once in the exposition.
+
+        :yields: metric family objects of prometheus_client.core.
+
+        """
+        families = OrderedDict()
+        for collector in list(self.static.values()):
+            for metric in collector.collect():
+                if metric.name not in families:
+                    families[metric.name] = metric
+                    continue
+                # Copy the family rather than extending it, since it belongs
+                # to the snapshot of a collector
+                first = families[metric.name]
+                merged = Metric(first.name, first.documentation, first.type)
+                merged.samples = first.samples + metric.samples
+                families[metric.name] = merged
+
+        for metric in families.values():
+            yield metric
+
+    def start_threads(self):
+        """Start polling every static target in its own thread."""
+        for zhcpnode, collector in self.static.items():
+            if not collector.interval:
+                collector.warm_up()
+                continue
+            thread = threading.Thread(target=collector.run,
+                                      name="poll-{}".format(zhcpnode))
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        """Poll every static target in its own thread. Never returns.
+
+        Targets that are queried on scrape are refreshed once in the
+        background instead, see :func:`ZVMCollector.warm_up`. With
+        ``asynchronous``, all targets are polled on a single event loop.
+
+        """
+        if self.asynchronous:
+            from zvm_exporter.aio import AsyncPoller
+            AsyncPoller(self.static.values()).start()
+        else:
+            self.start_threads()
+        while True:
+            sleep(1)